@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+'''
+Check that the decode trees in ARM's XML files agree with the
+opcode patterns of the instruction encodings.
+
+Opcodes are generated randomly and by sweeping the free bits of
+each encoding and are decoded both by walking the decode tree and
+by matching them against the mask/value pattern of every encoding.
+Every disagreement is reported.
+
+NumPy is used to decode large batches of opcodes if it is available.
+'''
+
+import argparse
+import glob
+import os
+import random
+import re
+import sys
+import time
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from instrs2asl import readDecodeFile, readInstruction, deslash, opcodePattern, hasField, columnSlice
+from trace2filter import decoder_files
+from xmlbackend import parseXML
+
+########################################################################
+# Compiling decode trees and encodings
+########################################################################
+
+# Possible results of decoding an opcode.
+# Opcodes that decode to an encoding use the index into the list of
+# outcomes for that encoding.
+NONE          = 0
+UNALLOCATED   = 1
+UNPREDICTABLE = 2
+NOP           = 3
+outcome_names = ["no match", "unallocated", "unpredictable", "nop"]
+
+'''
+Convert an ASL pattern such as "'01x'", "!'01'" or "_" on the bitslice
+'lo +: wd' of an opcode to a condition (mask, value, negated)
+that holds if (opcode & mask) == value (or != value if negated).
+Returns None if the pattern matches all values.
+'''
+def sliceCondition(lo, wd, pat):
+    if pat == "_": return None
+    neg = pat.startswith("!")
+    bits = pat[2:-1] if neg else pat[1:-1]
+    assert len(bits) == wd
+    mask = 0
+    value = 0
+    for (i, b) in enumerate(bits):
+        if b in "01":
+            mask  |= 1 << (lo + wd - 1 - i)
+            value |= int(b) << (lo + wd - 1 - i)
+    if mask == 0 and not neg: return None
+    return (mask, value, neg)
+
+'''
+Compile a decode tree read by readDecodeFile into nested lists of
+arms (conditions, child) where the child is either a nested list or
+an index into the list of outcomes.
+The first matching arm is taken: if it is a nested list that has no
+matching arm, the opcode does not decode.
+'''
+def compileTree(groups, classes, outcomes):
+    def outcome(x):
+        if x not in outcomes: outcomes.append(x)
+        return outcomes.index(x)
+
+    def conds(slices, pats):
+        cs = [ sliceCondition(lo, wd, p) for ((lo, wd), p) in zip(slices, pats) ]
+        return [ c for c in cs if c is not None ]
+
+    def group(g):
+        (label, (size, columns), children) = g
+        arms = []
+        for (dec, isGroup, c) in children:
+            if isGroup:
+                arms.append((conds(columns, dec), group(c)))
+                continue
+            (label, allocated, predictable) = c
+            if not allocated:
+                arms.append((conds(columns, dec), UNALLOCATED))
+            elif not predictable:
+                arms.append((conds(columns, dec), UNPREDICTABLE))
+            else:
+                arms.append((conds(columns, dec), table(classes[label])))
+        return arms
+
+    def table(c):
+        (fields, (ic, hdr, rows)) = c
+        fs = { nm: (hi, wd) for (nm, hi, wd) in fields }
+        slices = [ columnSlice(fs, h) for h in hdr ]
+        arms = []
+        for (pats, nm, encname, undef, unpred, nop) in rows:
+            if undef:    r = UNALLOCATED
+            elif unpred: r = UNPREDICTABLE
+            elif nop:    r = NOP
+            else:        r = outcome(deslash(nm))
+            arms.append((conds(slices, pats), r))
+        return arms
+
+    return group(groups)
+
+'''
+Convert an encoding to (mask, value, gmask, gvalue) such that an opcode
+matches the encoding if (opcode & mask) == value and (opcode & gmask) != gvalue.
+'''
+def encodingCondition(insn_set, fields):
+    (pattern, unpreds) = opcodePattern(fields)
+    mask  = int(''.join('0' if b == 'x' else '1' for b in pattern), 2)
+    value = int(''.join('1' if b == '1' else '0' for b in pattern), 2)
+    if insn_set == "A32" and hasField(fields, "cond"):
+        return (mask, value, 0xf0000000, 0xf0000000)
+    return (mask, value, 0, 1)
+
+'''
+Read the encodings of all instructions in a list of directories.
+Returns a dictionary mapping decoder instruction sets to lists of
+(encoding name, (mask, value, gmask, gvalue)).
+'''
+def readEncodings(dirs):
+    encs = {}
+    for d in dirs:
+        for inf in sorted(glob.glob(os.path.join(d, '*.xml'))):
+            name = re.search('.*/(\S+).xml',inf).group(1)
+            if name == "onebigfile": continue
+            (instr, _) = readInstruction(parseXML(inf), {}, False)
+            if instr is None: continue
+            for (inm, insn_set, fields, dec) in instr.encs:
+                isa = "T32" if insn_set == "T16" else insn_set
+                encs.setdefault(isa, []).append((deslash(inm), encodingCondition(insn_set, fields)))
+    return encs
+
+########################################################################
+# Decoding
+########################################################################
+
+'''
+Decode a single opcode using a compiled decode tree
+'''
+def decodeWord(arms, op):
+    for (conds, child) in arms:
+        if all(((op & m) == v) != neg for (m, v, neg) in conds):
+            return decodeWord(child, op) if isinstance(child, list) else child
+    return NONE
+
+'''
+Decode an array of opcodes using a compiled decode tree.
+Writes the outcome of decoding ops[idx] to out[idx].
+'''
+def decodeArray(arms, ops, out, idx):
+    for (conds, child) in arms:
+        if len(idx) == 0: return
+        sub = ops[idx]
+        sel = np.ones(len(idx), dtype=bool)
+        for (m, v, neg) in conds:
+            hit = (sub & np.uint32(m)) == np.uint32(v)
+            sel &= ~hit if neg else hit
+        if isinstance(child, list):
+            decodeArray(child, ops, out, idx[sel])
+        else:
+            out[idx[sel]] = child
+        idx = idx[~sel]
+
+'''
+Make 32-bit T32 opcodes consistent with the decode tables:
+16-bit instructions are in the top half of the opcode and the bottom
+half is zero.
+'''
+def normaliseT32(op):
+    return op if (op >> 27) >= 0b11101 else op & 0xffff0000
+
+########################################################################
+# Checking
+########################################################################
+
+'''
+Check a decode tree against a list of encodings.
+Keeps counts of disagreements keyed by (kind, outcome, encoding)
+with an example opcode for each.
+'''
+class Checker:
+    def __init__(self, isa, arms, outcomes, encs, verbose):
+        self.isa      = isa
+        self.arms     = arms
+        self.outcomes = outcomes
+        self.encs     = encs
+        self.verbose  = verbose
+        self.words    = 0
+        self.time     = 0.0
+        self.errors   = Counter()
+        self.overlaps = Counter()
+        self.examples = {}
+        names = [ e for (e, _) in encs ]
+        # index of encoding for each outcome (or -1)
+        self.encoding = [ names.index(o) if o in names else -1 for o in outcomes ]
+        if np is not None:
+            self.masks   = np.array([ c[0] for (_, c) in encs ], dtype=np.uint32)
+            self.values  = np.array([ c[1] for (_, c) in encs ], dtype=np.uint32)
+            self.gmasks  = np.array([ c[2] for (_, c) in encs ], dtype=np.uint32)
+            self.gvalues = np.array([ c[3] for (_, c) in encs ], dtype=np.uint32)
+            self.encidx  = np.array(self.encoding, dtype=np.int64)
+
+    def record(self, counter, key, n, example):
+        counter[key] += n
+        self.examples.setdefault(key, example)
+
+    # Check a list of opcodes without using NumPy
+    def checkList(self, ops):
+        start = time.perf_counter()
+        results = [ decodeWord(self.arms, op) for op in ops ]
+        self.time  += time.perf_counter() - start
+        self.words += len(ops)
+        for (op, o) in zip(ops, results):
+            e = self.encoding[o]
+            if e >= 0 and self.verbose == 0:
+                (m, v, gm, gv) = self.encs[e][1]
+                if (op & m) != v or (op & gm) == gv:
+                    self.record(self.errors, ("mismatch", o, e), 1, op)
+                continue
+            hits = [ i for (i, (_, (m, v, gm, gv))) in enumerate(self.encs)
+                     if (op & m) == v and (op & gm) != gv ]
+            if e >= 0:
+                if e not in hits:
+                    self.record(self.errors, ("mismatch", o, e), 1, op)
+                for i in hits:
+                    if i != e: self.record(self.overlaps, ("overlap", o, i), 1, op)
+            else:
+                for i in hits:
+                    self.record(self.errors, ("missing", o, i), 1, op)
+
+    # Check an array of opcodes using NumPy
+    def checkArray(self, ops):
+        start = time.perf_counter()
+        out = np.zeros(len(ops), dtype=np.int64)
+        decodeArray(self.arms, ops, out, np.arange(len(ops)))
+        self.time  += time.perf_counter() - start
+        self.words += len(ops)
+
+        enc = self.encidx[out]
+        decoded = enc >= 0
+
+        # decoded to an encoding whose pattern does not match
+        # (only checked against the pattern of that encoding)
+        (dops, douts, dencs) = (ops[decoded], out[decoded], enc[decoded])
+        bad = (((dops & self.masks[dencs]) != self.values[dencs])
+               | ((dops & self.gmasks[dencs]) == self.gvalues[dencs]))
+        self.aggregate(self.errors, "mismatch", dops[bad], douts[bad], dencs[bad])
+
+        # did not decode to an encoding but an encoding matches
+        # (only these opcodes are matched against every encoding)
+        (uops, uouts) = (ops[~decoded], out[~decoded])
+        (n, e) = np.nonzero(self.matches(uops))
+        self.aggregate(self.errors, "missing", uops[n], uouts[n], e)
+
+        # decoded to an encoding but other encodings also match
+        if self.verbose > 0:
+            others = np.arange(len(self.encs))[None,:] != dencs[:,None]
+            (n, e) = np.nonzero(self.matches(dops) & others)
+            self.aggregate(self.overlaps, "overlap", dops[n], douts[n], e)
+
+    # Which encodings match each opcode (opcodes x encodings)
+    def matches(self, ops):
+        return (((ops[:,None] & self.masks) == self.values)
+                & ((ops[:,None] & self.gmasks) != self.gvalues))
+
+    def aggregate(self, counter, kind, ops, outs, encs):
+        if len(ops) == 0: return
+        keys = outs * len(self.encs) + encs
+        (keys, first, counts) = np.unique(keys, return_index=True, return_counts=True)
+        for (k, i, c) in zip(keys, first, counts):
+            self.record(counter, (kind, int(outs[i]), int(encs[i])), int(c), int(ops[i]))
+
+    def check(self, ops):
+        if np is not None and isinstance(ops, np.ndarray):
+            self.checkArray(ops)
+        else:
+            self.checkList(ops)
+
+    def describe(self, key):
+        (kind, o, e) = key
+        name = self.outcomes[o] if o >= len(outcome_names) else outcome_names[o]
+        enc  = self.encs[e][0]
+        if kind == "mismatch":
+            return "decodes to "+name+" but does not match its pattern"
+        elif kind == "missing":
+            return "decodes to "+name+" but matches "+enc
+        else:
+            return "decodes to "+name+" but also matches "+enc
+
+    def report(self):
+        rate = self.words / self.time if self.time > 0 else 0
+        print("%s: decoded %d words in %.2fs (%.0f words/s)" % (self.isa, self.words, self.time, rate))
+        for (key, n) in sorted(self.errors.items()):
+            print("    %s: %d words, e.g., 0x%08x" % (self.describe(key), n, self.examples[key]))
+        if self.verbose > 0:
+            for (key, n) in sorted(self.overlaps.items()):
+                print("    %s: %d words, e.g., 0x%08x" % (self.describe(key), n, self.examples[key]))
+        return len(self.errors)
+
+########################################################################
+# Generating opcodes
+########################################################################
+
+'''
+Generate opcodes in batches: 'samples' random opcodes followed by,
+for each encoding, all opcodes that match its pattern if it has at most
+'exhaustive' free bits or 'per_encoding' random opcodes that match it.
+'''
+def opcodes(encs, samples, exhaustive, per_encoding, batch, seed, isa):
+    if np is not None:
+        rng = np.random.default_rng(seed)
+        def randoms(n):
+            return rng.integers(0, 1 << 32, size=n, dtype=np.uint64).astype(np.uint32)
+        def fill(m, v, xs):
+            return (xs & np.uint32(~m & 0xffffffff)) | np.uint32(v)
+        def sweep(m, v, lo, n):
+            xs = np.arange(lo, lo + n, dtype=np.uint64)
+            out = np.full(n, v, dtype=np.uint32)
+            free = [ i for i in range(32) if not (m >> i) & 1 ]
+            for (j, i) in enumerate(free):
+                out |= (((xs >> np.uint64(j)) & np.uint64(1)) << np.uint64(i)).astype(np.uint32)
+            return out
+        def normalise(xs):
+            if isa != "T32": return xs
+            return np.where((xs >> np.uint32(27)) >= 0b11101, xs, xs & np.uint32(0xffff0000))
+    else:
+        rng = random.Random(seed)
+        def randoms(n):
+            return [ rng.getrandbits(32) for i in range(n) ]
+        def fill(m, v, xs):
+            return [ (x & ~m & 0xffffffff) | v for x in xs ]
+        def sweep(m, v, lo, n):
+            free = [ i for i in range(32) if not (m >> i) & 1 ]
+            return [ v | sum(((x >> j) & 1) << i for (j, i) in enumerate(free))
+                     for x in range(lo, lo + n) ]
+        def normalise(xs):
+            if isa != "T32": return xs
+            return [ normaliseT32(x) for x in xs ]
+
+    for i in range(0, samples, batch):
+        yield normalise(randoms(min(batch, samples - i)))
+    for (e, (m, v, gm, gv)) in encs:
+        free = 32 - bin(m).count("1")
+        if free <= exhaustive:
+            for i in range(0, 1 << free, batch):
+                yield sweep(m, v, i, min(batch, (1 << free) - i))
+        else:
+            for i in range(0, per_encoding, batch):
+                yield fill(m, v, randoms(min(batch, per_encoding - i)))
+
+########################################################################
+# Main
+########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbose', '-v', help='Use verbose output (report overlapping encodings)',
+                        action = 'count', default=0)
+    parser.add_argument('--isa', help='Instruction sets to check',
+                        choices=sorted(decoder_files.keys()), action='append')
+    parser.add_argument('--samples', help='Number of random opcodes to check for each instruction set',
+                        metavar='N', type=int, default=1 << 20)
+    parser.add_argument('--exhaustive', help='Check all opcodes of encodings with at most N free bits',
+                        metavar='N', type=int, default=12)
+    parser.add_argument('--per-encoding', help='Number of random opcodes to check for other encodings',
+                        metavar='N', type=int, default=256)
+    parser.add_argument('--batch', help='Number of opcodes to decode at once',
+                        metavar='N', type=int, default=1 << 14)
+    parser.add_argument('--seed', help='Seed for random number generator',
+                        type=int, default=0)
+    parser.add_argument('--no-numpy', help='Do not use NumPy',
+                        action='store_true', default=False)
+    parser.add_argument('dir', metavar='<dir>', nargs='+',
+                        help='input directories')
+    args = parser.parse_args()
+
+    global np
+    if args.no_numpy: np = None
+    if np is None and args.verbose > 0: print("NumPy not available: decoding one opcode at a time")
+
+    encs = readEncodings(args.dir)
+
+    errors = 0
+    for isa in args.isa or sorted(decoder_files.keys()):
+        decoders = [ readDecodeFile(d, f) for d in args.dir
+                     for f in glob.glob(os.path.join(d, decoder_files[isa])) ]
+        for (groups, classes) in decoders:
+            outcomes = list(outcome_names)
+            arms = compileTree(groups, classes, outcomes)
+            es = encs.get(isa, [])
+
+            # static checks: encodings in the decoder and in the instructions
+            names = { e for (e, _) in es }
+            for o in outcomes[len(outcome_names):]:
+                if o not in names:
+                    print("%s: %s is in the decoder but is not an instruction encoding" % (isa, o))
+                    errors += 1
+            for e in sorted(names - set(outcomes)):
+                print("%s: %s is an instruction encoding but is not in the decoder" % (isa, e))
+                errors += 1
+
+            checker = Checker(isa, arms, outcomes, es, args.verbose)
+            for ops in opcodes(es, args.samples, args.exhaustive, args.per_encoding,
+                               args.batch, args.seed, isa):
+                checker.check(ops)
+            errors += checker.report()
+
+    if errors:
+        print("Found", errors, "disagreements")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+########################################################################
+# End
+########################################################################
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+'''
+Extract the system registers and the instructions from ARM's XML files
+with a single command.
+
+This does the same as running reg2asl.py and instrs2asl.py but the
+two are run concurrently in separate processes and the proprietary
+notice is only read once.
+Any options not listed below are passed to instrs2asl.py
+(see "instrs2asl.py --help").
+
+Usage: extract.py --regs SYSREGDIR --regs-output arch/regs.asl [instrs2asl.py options] <dir>...
+'''
+
+import argparse
+import concurrent.futures
+import filecmp
+import os
+import sys
+import time
+
+import instrs2asl
+import reg2asl
+from incremental import Cache
+from xmlbackend import noticeParagraphs, setXMLBackend
+
+########################################################################
+# Stages
+########################################################################
+
+'''
+Generate the register definitions.
+(Nothing is kept in the cache because each file is only read once.)
+'''
+def registerStage(args, paras):
+    setXMLBackend(args.xml_backend)
+    reg2asl.generate(args, Cache(keep=False), paras)
+
+'''
+Generate the instruction, decoder and definition files.
+'''
+def instructionStage(args, paras):
+    instrs2asl.setOptions(args)
+    instrs2asl.generate(args, Cache(keep=False), paras)
+
+'''
+Run a stage and return (elapsed time, error message or None)
+'''
+def runStage(stage, *arguments):
+    start = time.perf_counter()
+    error = None
+    try:
+        stage(*arguments)
+    except SystemExit as err:
+        # the error has already been reported
+        if err.code: error = "exit status " + str(err.code)
+    except Exception as err:
+        error = str(err)
+    sys.stdout.flush()
+    return (time.perf_counter() - start, error)
+
+'''
+Run each stage (name, function, arguments...) in its own process.
+(Both stages spend most of their time in Python code so threads
+would take turns to hold the global interpreter lock.)
+Returns list of (name, elapsed time, error message or None)
+'''
+def runStages(stages):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(stages)) as pool:
+        futures = [ (name, pool.submit(runStage, *s)) for (name, *s) in stages ]
+        return [ (name,) + f.result() for (name, f) in futures ]
+
+########################################################################
+# Main
+########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--regs', help='System register XML directories',
+                        metavar='DIR', nargs='+', required=True)
+    parser.add_argument('--regs-output', help='File to store register definitions',
+                        metavar='FILE', default='regs.asl')
+    (args, rest) = parser.parse_known_args()
+
+    instr_args = instrs2asl.argumentParser().parse_args(rest)
+    if instr_args.watch:
+        print("Error: --watch is not supported: use reg2asl.py and instrs2asl.py instead")
+        return 1
+    if instr_args.from_store is not None or instr_args.dir == []:
+        print("Error: instruction XML directories are required: use instrs2asl.py --from-store instead")
+        return 1
+    reg_argv = ['--output', args.regs_output, '--xml-backend', instr_args.xml_backend]
+    if instr_args.verbose > 0: reg_argv.append('--verbose')
+    reg_args = reg2asl.argumentParser().parse_args(reg_argv + args.regs)
+
+    # Use one copy of the notice if the register and instruction
+    # directories contain identical notices
+    if instr_args.notice is None:
+        instr_args.notice = os.path.join(instr_args.dir[0], 'notice.xml')
+        reg_notice = os.path.join(reg_args.dir[0], 'notice.xml')
+        if os.path.exists(reg_notice) and filecmp.cmp(reg_notice, instr_args.notice, shallow=False):
+            reg_args.notice = instr_args.notice
+    else:
+        reg_args.notice = instr_args.notice
+
+    paras = noticeParagraphs(instr_args.notice, instr_args.xml_backend)
+    reg_paras = paras if reg_args.notice == instr_args.notice else None
+
+    start = time.perf_counter()
+    results = runStages([
+        ('registers',    registerStage,    reg_args,   reg_paras),
+        ('instructions', instructionStage, instr_args, paras),
+    ])
+    total = time.perf_counter() - start
+
+    print("Timing summary:")
+    for (name, elapsed, error) in results:
+        print("  %-14s %8.2fs%s" % (name, elapsed, "  (failed)" if error else ""))
+    print("  %-14s %8.2fs" % ("total", total))
+
+    status = 0
+    for (name, _, error) in results:
+        if error:
+            print("Error:", name + ":", error)
+            status = 1
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+########################################################################
+# End
+########################################################################
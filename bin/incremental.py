@@ -0,0 +1,168 @@
+'''
+Support for incremental regeneration of output files.
+'''
+
+import contextlib
+import filecmp
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+########################################################################
+# Writing output files
+########################################################################
+
+# permissions of new files (tempfile creates files that only the owner can read)
+umask = os.umask(0)
+os.umask(umask)
+
+'''
+Open an output file for writing.
+The output is written to a temporary file in the same directory which
+replaces the file when it is complete so that other tools never see
+a partially written file (and the old file is kept if there is an error).
+If 'compare' is set, the file is only replaced if the content has changed.
+This leaves the timestamp of unchanged files alone so that tools that
+depend on them are not rebuilt.
+'''
+@contextlib.contextmanager
+def updateFile(filename, compare=True, binary=False):
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                 prefix="."+os.path.basename(filename)+".")
+    try:
+        with open(fd, "wb" if binary else "w") as f:
+            yield f
+        if compare and os.path.isfile(filename) and filecmp.cmp(tmp, filename, shallow=False):
+            os.remove(tmp)
+            return
+        if os.path.exists(filename):
+            os.chmod(tmp, os.stat(filename).st_mode & 0o777)
+        else:
+            os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+########################################################################
+# Manifests
+########################################################################
+
+# A manifest is a json file containing a hash of the content of each
+# output file and of each chunk, tag or register in the outputs.
+# Each time that it is written, it also lists the names that were added,
+# changed or removed since the previous manifest so that build tools
+# can rebuild only what depends on them.
+#
+#     {
+#         "outputs": { "arch/arch.asl": "9f86d0...", ... },
+#         "chunks":  { "shared/functions/memory/AlignmentFault": "...", ... },
+#         "changed": { "outputs": [ "arch/arch.asl" ], "chunks": [ ... ] }
+#     }
+
+def contentHash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def fileHash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+'''
+Write a manifest containing the hashes in 'sections'
+(a dictionary from section name to a dictionary from name to hash)
+and the hashes of the files in 'outputs'.
+Returns a dictionary from section name to the names that changed.
+'''
+def writeManifest(filename, sections, outputs):
+    sections = dict(sections)
+    sections['outputs'] = { f: fileHash(f) for f in outputs }
+    try:
+        with open(filename, "r") as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+    changed = {}
+    for (section, hashes) in sections.items():
+        old = previous.get(section, {})
+        changed[section] = sorted(n for n in set(hashes) | set(old) if hashes.get(n) != old.get(n))
+    manifest = dict(sections)
+    manifest['changed'] = changed
+    with updateFile(filename) as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+        print(file=f)
+    return changed
+
+########################################################################
+# Watching input files
+########################################################################
+
+'''
+Return the modification time of a file (or None if it does not exist)
+'''
+def mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+'''
+Cache of values computed from input files.
+A cached value is recomputed if any of the files it was computed from
+has changed since the value was computed.
+If 'keep' is not set, values are not kept (to save memory when
+the values will only be used once).
+'''
+class Cache:
+    def __init__(self, keep=True):
+        self.keep    = keep
+        self.entries = {}
+
+    def get(self, key, files, compute):
+        if not self.keep: return compute()
+        stamp = tuple((f, mtime(f)) for f in files)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, compute())
+            self.entries[key] = entry
+        return entry[1]
+
+'''
+Poll files and directories for changes.
+Directories are watched for changes to any file matching 'pattern'.
+'''
+class Watcher:
+    def __init__(self, paths, pattern='*.xml', interval=1.0):
+        self.paths    = paths
+        self.pattern  = pattern
+        self.interval = interval
+        self.stamps   = self.snapshot()
+
+    def snapshot(self):
+        stamps = {}
+        for p in self.paths:
+            files = glob.glob(os.path.join(p, self.pattern)) if os.path.isdir(p) else [p]
+            for f in files:
+                stamps[f] = mtime(f)
+        return stamps
+
+    '''
+    Wait until some file changes and return the list of changed files
+    '''
+    def wait(self):
+        while True:
+            time.sleep(self.interval)
+            stamps = self.snapshot()
+            changed = [ f for f in set(stamps) | set(self.stamps)
+                        if stamps.get(f) != self.stamps.get(f) ]
+            self.stamps = stamps
+            if changed: return sorted(changed)
+
+########################################################################
+# End
+########################################################################
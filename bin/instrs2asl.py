@@ -6,33 +6,157 @@ and ASL code within it.
 '''
 
 import argparse
+import contextlib
+import copy
+import csv
 import glob
+import io
 import json
 import os
 import re
 import string
 import sys
-import xml.etree.cElementTree as ET
+import threading
 from collections import defaultdict
 from itertools import takewhile
 
-include_regex = None
-exclude_regex = None
+from incremental import Cache, Watcher, contentHash, updateFile, writeManifest
+from pipeline import BufferedWriter, Pipeline
+from snapshot import writeSnapshot
+from specstore import instruction_tables, Store, StoreGraph, StoreWriter
+from xmlbackend import checkXMLBackend, elementText, noticeParagraphs, parseXML, setXMLBackend, xml_backends
+
+########################################################################
+# Extraction state
+########################################################################
+
+# The options and the state of an extraction (the tags and files
+# written so far, the patches, etc.) belong to an Extractor (see
+# "Library interface" below) so that several extractions can run in
+# one process.
+# Each thread has a stack of active extractors and functions use the
+# state of the innermost one (or of 'default_extractor' if there is
+# none).
+
+active_extractors = threading.local()
+
+def current():
+    stack = getattr(active_extractors, 'stack', None)
+    return stack[-1] if stack else default_extractor
 
 ########################################################################
 # Tag file support
 ########################################################################
 
-tags = set()
+# If 'dedupe_asl' is set, ASL code is only written to the tag file the
+# first time that it is seen and later uses refer to that tag.
+# If 'count_encodings' is set, the decode ASL of each encoding
+# increments a counter (see "Encoding counters" below)
+
+'''
+Write content to a 'tag file' suppressing duplicate information.
+Returns the tag that should be used to refer to the content.
+'''
+def emit(f, tag, content, dedupe=False):
+    x = current()
+    if dedupe:
+        kind = tag.rsplit(':', 1)[-1]
+        first = x.tag_content.setdefault((kind, content), tag)
+        if first != tag:
+            x.tag_aliases[tag] = first
+            return first
+    if tag not in x.tags: # suppress duplicate entries
+        x.tags.add(tag)
+        f.write('TAG:'+tag+'\n'+content+'\n')
+    return tag
+
+'''
+Reset the tag file state before writing a new tag file
+'''
+def resetTags():
+    x = current()
+    x.tags.clear()
+    x.tag_content.clear()
+    x.tag_aliases.clear()
+
+########################################################################
+# Output files
+########################################################################
+
+'''
+Open an output file (see updateFile) and record its name in the
+files written by the current run (see --manifest).
+If the current extractor is capturing output, the file is written
+to memory instead (see Extractor.emit).
+'''
+@contextlib.contextmanager
+def outputFile(filename):
+    x = current()
+    x.output_files.append(filename)
+    if x.captured is None:
+        with updateFile(filename) as f:
+            yield f
+    else:
+        f = io.StringIO()
+        yield f
+        x.captured[filename] = f.getvalue()
+
+
+########################################################################
+# Patches
+########################################################################
+
+# Table of textual patches to apply to ASL chunks as they are extracted,
+# indexed by chunk name (see Extractor.patches).
+# Patches listed under the name '*' are applied to every chunk.
+# The table is cached with the chunks that it was applied to so each
+# patch counts how many of those chunks it applied to.
+
+'''
+Read json files of patches.
+Each file maps chunk names to a list of patches of the form
+    { "old": ..., "new": ..., "comment": ... }
+where old and new are either strings or lists of lines.
+Returns table of patches.
+'''
+def readPatches(files):
+    def text(x):
+        return '\n'.join(x) if isinstance(x, list) else x
+
+    patches = defaultdict(list)
+    for fn in files:
+        with open(fn, "r") as f:
+            try:
+                table = json.load(f)
+            except ValueError as err:
+                print(err)
+                sys.exit(1)
+        for (name, ps) in table.items():
+            for p in ps:
+                patches[name].append({ 'file': fn, 'old': text(p['old']), 'new': text(p['new']), 'applied': 0 })
+    return patches
+
 '''
-Write content to a 'tag file' suppressing duplicate information
+Apply any patches for chunk 'name' to 'code'
 '''
-def emit(f, tag, content):
-    if tag not in tags: # suppress duplicate entries
-        tags.add(tag)
-        print('TAG:'+tag, file=f)
-        print(content, file=f)
+def applyPatches(name, code):
+    patches = current().patches
+    for ps in [ patches.get(name, []), patches.get('*', []) ]:
+        for p in ps:
+            if p['old'] in code:
+                code = code.replace(p['old'], p['new'])
+                p['applied'] += 1
+    return code
 
+'''
+Report all patches that did not apply to any chunk
+'''
+def reportPatches():
+    patches = current().patches
+    for name in sorted(patches.keys()):
+        for p in patches[name]:
+            if p['applied'] == 0:
+                print("Warning: patch from "+p['file']+" for "+name+" no longer applies: "+p['old'].splitlines()[0])
 
 ########################################################################
 # Workarounds
@@ -57,11 +181,14 @@ class ASL:
         self.deps = deps
 
     def emit(self, file, tag):
-        emit(file, tag, self.code)
+        return emit(file, tag, self.code, current().dedupe_asl)
+
+    def indented(self, indent):
+        return [ " "*indent + l for l in self.code.splitlines() ]
 
     def put(self, ofile, indent):
-        for l in self.code.splitlines():
-            print(" "*indent + l, file=ofile)
+        lines = self.indented(indent)
+        if lines: ofile.write("\n".join(lines) + "\n")
 
     def __str__(self):
         return "ASL{"+", ".join([self.name, str(self.defs), str(self.deps)])+"}"
@@ -120,6 +247,43 @@ def hasField(fields, nm):
 def deslash(nm):
     return nm.replace("/instrs","").replace("/", "_").replace("-","_").replace(".","_")
 
+# Convert the fields of an encoding to an opcode pattern consisting of
+# '0', '1' or 'x' for each bit (most significant bit first)
+# and a list of (bit, value) pairs for the 'should be' bits written
+# as (0) or (1) in the XML (which are 'x' in the pattern).
+def opcodePattern(fields):
+    unpreds = []
+    pattern = "" # todo: assumes that fields are sorted in order
+    for (hi, lo, nm, split, consts) in fields:
+        wd = (hi - lo) + 1
+
+        if re.fullmatch("(\([01]\))+", nm):
+            # workaround
+            consts = nm
+
+        # convert all the 'should be' bits to 'unpredictable_unless'
+        cs = ""
+        i  = hi
+        while consts != "":
+            if consts.startswith("(1)") or consts.startswith("(0)"):
+                unpreds.append((i, consts[1]))
+                cs = cs + "x"
+                consts = consts[3:]
+            elif consts[0] in "01x":
+                cs = cs + consts[0]
+                consts = consts[1:]
+            else:
+                print("Malformed field "+consts)
+                assert False
+            i = i - 1
+        assert len(cs) == wd
+        pattern = pattern + cs
+    return (pattern, unpreds)
+
+# Guard of an encoding: A32 encodings with a cond field exclude cond == '1111'
+def encodingGuard(insn_set, fields):
+    return "cond != '1111'" if insn_set == "A32" and hasField(fields, "cond") else "TRUE"
+
 class Instruction:
     '''Representation of Instructions'''
 
@@ -130,76 +294,61 @@ class Instruction:
         self.conditional = conditional
         self.exec = exec
 
+    def dependencies(self):
+        '''All dependencies of the decode, postdecode and execute code'''
+        deps = set(self.exec.deps)
+        if self.post: deps |= self.post.deps
+        for (_,_,_,dec) in self.encs: deps |= dec.deps
+        return deps
+
     def emit_asl_syntax(self, ofile):
-        print("__instruction "+ deslash(self.name), file=ofile)
+        # build the lines of output and write them all at once
+        out = []
+        out.append("__instruction "+ deslash(self.name))
 
         for (inm,insn_set,fields,dec) in self.encs:
-            unpreds = []
-            pattern = "" # todo: assumes that fields are sorted in order
-
-            print("    __encoding "+ deslash(inm), file=ofile)
-            print("        __instruction_set "+ insn_set, file=ofile)
+            out.append("    __encoding "+ deslash(inm))
+            out.append("        __instruction_set "+ insn_set)
             for (hi, lo, nm, split, consts) in fields:
                 # assert(not split) todo
                 wd = (hi - lo) + 1
-
-                if re.fullmatch("(\([01]\))+", nm):
-                    # workaround
-                    consts = nm
-                    nm = '_'
-
-                # convert all the 'should be' bits to 'unpredictable_unless'
-                cs = ""
-                i  = hi
-                while consts != "":
-                    if consts.startswith("(1)") or consts.startswith("(0)"):
-                        unpreds.append((i, consts[1]))
-                        cs = cs + "x"
-                        consts = consts[3:]
-                    elif consts[0] in "01x":
-                        cs = cs + consts[0]
-                        consts = consts[1:]
-                    else:
-                        print("Malformed field "+consts)
-                        assert False
-                    i = i - 1
-                consts = cs
-                assert len(consts) == wd
-                pattern = pattern + consts
+                if re.fullmatch("(\([01]\))+", nm): nm = '_' # workaround
                 nm = patchTypeAsVar(nm) # workaround
                 if nm != "_":
-                    print("        __field "+nm+" "+str(lo)+" +: "+str(wd), file=ofile)
+                    out.append("        __field "+nm+" "+str(lo)+" +: "+str(wd))
+            (pattern, unpreds) = opcodePattern(fields)
             pattern = [ pattern[i:i+8] for i in range(0, len(pattern), 8) ]
-            print("        __opcode '" + " ".join(pattern) + "'", file=ofile)
-            guard = "cond != '1111'" if  insn_set == "A32" and hasField(fields, "cond") else "TRUE";
-            print("        __guard "+guard, file=ofile)
+            out.append("        __opcode '" + " ".join(pattern) + "'")
+            out.append("        __guard "+encodingGuard(insn_set, fields))
             for (i, v) in unpreds:
-                print("        __unpredictable_unless "+str(i)+" == '"+v+"'", file=ofile)
+                out.append("        __unpredictable_unless "+str(i)+" == '"+v+"'")
 
-            print("        __decode", file=ofile)
+            out.append("        __decode")
+            if current().count_encodings: out.append(" "*12 + counterIncrement(inm))
             dec.patchTypeVar()
-            dec.put(ofile, 12)
-            print(file=ofile)
+            out.extend(dec.indented(12))
+            out.append("")
         if self.post:
-            print("    __postdecode", file=ofile)
+            out.append("    __postdecode")
             self.post.patchTypeVar()
-            self.post.put(ofile, 8)
+            out.extend(self.post.indented(8))
         if self.conditional:
-            print("    __execute __conditional", file=ofile)
+            out.append("    __execute __conditional")
         else:
-            print("    __execute", file=ofile)
+            out.append("    __execute")
         self.exec.patchTypeVar()
-        self.exec.put(ofile, 8)
+        out.extend(self.exec.indented(8))
+        ofile.write("\n".join(out) + "\n")
 
     def emit_tag_syntax(self, file):
         index = [] # index of sections of this instruction
         exec_tag = self.name+':execute'
         post_tag = self.name+':postdecode'
         idx_tag  = self.name+':index'
-        self.exec.emit(file, exec_tag)
+        exec_tag = self.exec.emit(file, exec_tag)
         index.append('Execute: '+exec_tag)
         if self.post:
-            self.post.emit(file, post_tag)
+            post_tag = self.post.emit(file, post_tag)
             index.append('Postdecode: '+post_tag)
         for (inm,insn_set,fields,dec) in self.encs:
             dec_tag  = inm + ':decode'
@@ -208,11 +357,15 @@ class Instruction:
             enc.extend([str(hi)+":"+str(lo)+" "+nm+" "+consts
                         for (hi,lo,nm,_,consts) in fields ])
             emit(file, enc_tag, "\n".join(enc))
-            dec.emit(file, dec_tag)
+            if current().count_encodings:
+                dec_tag = emit(file, dec_tag, counterIncrement(inm)+"\n"+dec.code, current().dedupe_asl)
+            else:
+                dec_tag = dec.emit(file, dec_tag)
             index.append('Decode: '+dec_tag+'@'+enc_tag)
         emit(file, idx_tag, "\n".join(index))
 
-    def emit_sail_ast(self, previous_clauses, file):
+    # The encodings of new clauses are added to 'decodes' (see printSailDecoders)
+    def emit_sail_ast(self, previous_clauses, file, decodes=None):
         for enc in self.encs:
             enc_name, enc_iset, enc_fields, enc_asl = enc
             fields = [(nm, hi - lo + 1) for (hi, lo, nm, split, consts) in enc_fields if nm != '_']
@@ -224,6 +377,8 @@ class Instruction:
             if clause not in previous_clauses:
                 print(clause, file=file)
                 previous_clauses.add(clause)
+                if decodes is not None:
+                    decodes.setdefault(enc_iset, []).append(sailEncoding(enc_name, enc_iset, enc_fields))
 
     def __str__(self):
         encs = "["+ ", ".join([inm for (inm,_,_,_) in self.encs]) +"]"
@@ -234,9 +389,6 @@ class Instruction:
 # Extracting information from XML files
 ########################################################################
 
-alt_slice_syntax = False
-demangle_instr = False
-
 '''
 Read pseudocode to extract ASL.
 '''
@@ -260,13 +412,12 @@ def readASL(ps):
     # drop file references in links
     deps = { re.sub('([^#]+#)','',x) for x in deps }
 
-    code = ET.tostring(chunk, method="text").decode().rstrip()+"\n"
+    code = elementText(chunk).rstrip()+"\n"
 
-    # workaround: patch operator precedence error
-    code = code.replace("= e - e MOD eltspersegment;",  "= e - (e MOD eltspersegment);")
-    code = code.replace("= p - p MOD pairspersegment;", "= p - (p MOD pairspersegment);")
+    # workaround: fix errors in the published ASL
+    code = applyPatches(name, code)
 
-    if alt_slice_syntax:
+    if current().alt_slice_syntax:
         code = "\n".join(map(patchSlices, code.split('\n')))
 
     return ASL(name, code, defs, deps)
@@ -364,7 +515,7 @@ def readGroup(label, g):
 '''
 def readInstrName(dir, filename, encname):
     filename = dir+"/"+filename
-    xml = ET.parse(filename)
+    xml = parseXML(filename, current().xml_backend)
     for ic in xml.findall(".//iclass"):
         decode = ic.find("regdiagram").attrib['psname']
         for enc in ic.findall("encoding"):
@@ -417,7 +568,7 @@ def readITables(dir, root):
 '''
 def readDecodeFile(dir, file):
     print("Reading decoder "+file)
-    root = ET.parse(file)
+    root = parseXML(file, current().xml_backend)
 
     iset = root.getroot().attrib['instructionset']
     groups = readGroup(iset, root.find('hierarchy'))
@@ -430,11 +581,13 @@ def ppslice(f):
     (lo, wd) = f
     return (str(lo) +" +: "+ str(wd))
 
-def printITable(ofile, level, c):
+def printITable(ofile, level, c, profile=None):
     (fields, (ic, hdr, rows)) = c
     for (fnm, hi, wd) in fields:
         print("    "*level + "__field "+ fnm +" "+str(hi-wd+1) +" +: "+str(wd), file=ofile)
     print("    "*level +"case ("+ ", ".join(hdr) +") of", file=ofile)
+    if profile:
+        rows = orderArms(rows, lambda r: r[0], lambda r: rowWeight(profile, r))
     for (pats, nm, encname, undef, unpred, nop) in rows:
         nm = "__encoding "+deslash(nm)
         if encname: nm = nm + " // " +encname
@@ -449,21 +602,23 @@ def printDiagram(ofile, level, reg):
     print("    "*level +"case ("+ ", ".join(map(ppslice, fields)) +") of", file=ofile)
     return
 
-def printGroup(ofile, classes, level, root):
+def printGroup(ofile, classes, level, root, profile=None):
     (label, diagram, children) = root
     print("    "*level + "// "+label, file=ofile)
     printDiagram(ofile, level, diagram)
+    if profile:
+        children = orderArms(children, lambda c: c[0], lambda c: childWeight(profile, classes, c))
     for (dec, isGroup, c) in children:
         if isGroup:
             print("    "*(level+1) +"when ("+ ", ".join(dec) +") =>", file=ofile)
-            printGroup(ofile, classes, level+2, c)
+            printGroup(ofile, classes, level+2, c, profile)
         else:
             (label, allocated, predictable) = c
             tag = "// "+label
             if allocated and predictable:
                 (fields, (ic, hdr, rows)) = classes[label]
                 print("    "*(level+1) +"when ("+ ", ".join(dec) +") => " +tag, file=ofile)
-                printITable(ofile, level+2, classes[label])
+                printITable(ofile, level+2, classes[label], profile)
             else:
                 if not allocated: tag = "__UNPREDICTABLE"
                 if not predictable: tag = "__UNALLOCATED"
@@ -471,9 +626,132 @@ def printGroup(ofile, classes, level, root):
 
     return
 
-def printDecodeTree(ofile, groups, classes):
+def printDecodeTree(ofile, groups, classes, profile=None):
     print("__decode", groups[0], file=ofile)
-    printGroup(ofile, classes, 1, groups)
+    printGroup(ofile, classes, 1, groups, profile)
+
+'''
+Restrict a decoder read by readDecodeFile to the encodings in 'selected'
+(encoding names as used in arch_decode.asl).
+Rows of instruction tables for other encodings become __UNALLOCATED
+and any instruction table or group where every arm is __UNALLOCATED
+is replaced by __UNALLOCATED.
+(Opcodes that do not match any arm are treated as unallocated.)
+Returns (groups, classes, number of encodings kept) or None if no
+selected encodings remain.
+'''
+def pruneDecoder(groups, classes, selected):
+    newclasses = dict(classes)
+    kept = set()
+
+    # the class that printGroup and decodeNode print as __UNALLOCATED
+    def unallocated(label):
+        return (label, True, False)
+
+    def isUnallocated(child):
+        (dec, isGroup, c) = child
+        return not isGroup and c[1] and not c[2]
+
+    def pruneTable(c):
+        (fields, (ic, hdr, rows)) = c
+        newrows = []
+        for row in rows:
+            (pats, nm, encname, undef, unpred, nop) = row
+            if not (undef or unpred or nop):
+                if deslash(nm) in selected:
+                    kept.add(deslash(nm))
+                else:
+                    row = (pats, "_", None, True, False, False)
+            newrows.append(row)
+        if all(row[3] for row in newrows): return None
+        return (fields, (ic, hdr, newrows))
+
+    def pruneGroup(root):
+        (label, diagram, children) = root
+        newchildren = []
+        for (dec, isGroup, c) in children:
+            if isGroup:
+                g = pruneGroup(c)
+                child = (dec, True, g) if g else (dec, False, unallocated(c[0]))
+            else:
+                child = (dec, False, c)
+                (iclass, allocated, predictable) = c
+                if allocated and predictable:
+                    t = pruneTable(classes[iclass])
+                    if t: newclasses[iclass] = t
+                    else: child = (dec, False, unallocated(iclass))
+            newchildren.append(child)
+        if all(isUnallocated(child) for child in newchildren): return None
+        return (label, diagram, newchildren)
+
+    newgroups = pruneGroup(groups)
+    if newgroups is None or not kept: return None
+    return (newgroups, newclasses, len(kept))
+
+'''
+Decoder for an instruction set where every opcode is unallocated
+'''
+def unallocatedDecoder(groups):
+    (label, (size, columns), children) = groups
+    return ((label, (size, columns), [ (["_"] * len(columns), False, (label, True, False)) ]), {})
+
+'''
+Test whether an ASL pattern such as "'01x'", "!'01'" or "_"
+matches a 'width'-bit value
+'''
+def matchPattern(pat, value, width):
+    if pat == "_": return True
+    neg = pat.startswith("!")
+    bits = pat[2:-1] if neg else pat[1:-1]
+    ok = all(b not in "01" or int(b) == (value >> (width-1-i)) & 1
+             for (i, b) in enumerate(bits))
+    return ok != neg
+
+'''
+Convert a column of an instruction table to a bitslice (lo, wd) of the opcode.
+Columns are either field names or slices of fields such as "op<1>" or "op<3:2>".
+'''
+def columnSlice(fields, hdr):
+    m = re.fullmatch('(\w+)(<(\d+)(:(\d+))?>)?', hdr)
+    (hi, wd) = fields[m.group(1)]
+    lo = hi - wd + 1
+    if m.group(2):
+        shi = int(m.group(3))
+        slo = int(m.group(5)) if m.group(5) else shi
+        return (lo + slo, shi - slo + 1)
+    return (lo, wd)
+
+'''
+Extract the value of a column of an instruction table from an opcode.
+'''
+def readColumn(fields, hdr, opcode):
+    (lo, wd) = columnSlice(fields, hdr)
+    return ((opcode >> lo) & ((1 << wd) - 1), wd)
+
+'''
+Decode an opcode using a decode tree read by readDecodeFile.
+Returns the matching instruction table row
+    (patterns, name, encname, undef, unpred, nop)
+or None if the opcode does not match any arm of the decode tree.
+'''
+def decodeOpcode(groups, classes, opcode):
+    (label, (size, columns), children) = groups
+    values = [ ((opcode >> lo) & ((1 << wd) - 1), wd) for (lo, wd) in columns ]
+    for (dec, isGroup, c) in children:
+        if all(matchPattern(p, v, wd) for (p, (v, wd)) in zip(dec, values)):
+            if isGroup:
+                return decodeOpcode(c, classes, opcode)
+            (label, allocated, predictable) = c
+            if not (allocated and predictable):
+                return ([], "_", None, not allocated, not predictable, False)
+            (fields, (ic, hdr, rows)) = classes[label]
+            fs = { nm: (hi, wd) for (nm, hi, wd) in fields }
+            values = [ readColumn(fs, h, opcode) for h in hdr ]
+            for row in rows:
+                if all(matchPattern(p, v, wd) for (p, (v, wd)) in zip(row[0], values)):
+                    return row
+            return None
+    return None
 
 '''
 Read shared pseudocode files to extract ASL.
@@ -483,21 +761,11 @@ def readShared(files):
     asl = {}
     names = set()
     for f in files:
-        xml = ET.parse(f)
+        xml = parseXML(f, current().xml_backend)
         for ps in xml.findall('.//ps_section/ps'):
             r = readASL(ps)
             # workaround: patch use of type as a variable name
             r.patchTypeVar()
-            # workaround: patch SCTLR[] definition
-            if r.name == "aarch64/functions/sysregisters/SCTLR":
-                r.code = r.code.replace("bits(32) r;", "bits(64) r;")
-            # workaround: patch AArch64.CheckUnallocatedSystemAccess
-            if r.name == "aarch64/functions/system/AArch64.CheckUnallocatedSystemAccess":
-                r.code = r.code.replace("bits(2) op0,", "bits(2) el, bits(2) op0,")
-            # workaround: patch AArch64.CheckSystemAccess
-            if r.name == "aarch64/functions/system/AArch64.CheckSystemAccess":
-                r.code = r.code.replace("AArch64.CheckSVESystemRegisterTraps(op0, op1, crn, crm, op2);",
-                                        "AArch64.CheckSVESystemRegisterTraps(op0, op1, crn, crm, op2, read);")
 
             # workaround: collect type definitions
             for m in re.finditer('''(?m)^(enumeration|type)\s+(\S+)''',r.code):
@@ -553,15 +821,14 @@ def readShared(files):
 
 
 '''
-Read ARM's license notice from an XML file.
+Convert paragraphs of ARM's license notice (see noticeParagraphs)
+into a giant comment block.
 Convert unicode characters to ASCII equivalents (e.g,, (C)).
-Return a giant comment block containing the notice.
 '''
-def readNotice(xml):
+def readNotice(paras):
     # Read proprietary notice
     notice = ['/'*72, "// Proprietary Notice"]
-    for p in xml.iter('para'):
-        para = ET.tostring(p, method='text').decode().rstrip()
+    for para in paras:
         para = para.replace("&#8217;", "'")
         para = para.replace("&#8220;", '"')
         para = para.replace("&#8221;", '"')
@@ -653,6 +920,13 @@ def demangleExecuteASL(code):
             code[0] = rest
     return (tops, conditional, decode, code)
 
+# Test whether instruction is selected by --include and --exclude
+def includeInstruction(name):
+    x = current()
+    include_matches = x.include_regex is None or x.include_regex.search(name)
+    exclude_matches = x.exclude_regex is not None and x.exclude_regex.search(name)
+    return include_matches and not exclude_matches
+
 def readInstruction(xml,names,sailhack):
     execs = xml.findall(".//pstext[@section='Execute']/..")
     posts = xml.findall(".//pstext[@section='Postdecode']/..")
@@ -663,7 +937,7 @@ def readInstruction(xml,names,sailhack):
     exec = readASL(execs[0])
     post = readASL(posts[0]) if posts else None
 
-    if demangle_instr:
+    if current().demangle_instr:
         # demangle execute code
         code = exec.code.splitlines()
         (top, conditional, decode, execute) = demangleExecuteASL(code)
@@ -676,10 +950,8 @@ def readInstruction(xml,names,sailhack):
     exec.patchDependencies(names)
     if post: post.patchDependencies(names)
 
-    include_matches = include_regex is None or include_regex.search(exec.name)
-    exclude_matches = exclude_regex is not None and exclude_regex.search(exec.name)
-    if not include_matches or exclude_matches:
-        return None
+    if not includeInstruction(exec.name):
+        return (None, top)
 
 
     # for each encoding, read instructions encoding, matching decode ASL and index
@@ -745,6 +1017,700 @@ def readInstruction(xml,names,sailhack):
 
     return (Instruction(exec.name, encs, post, conditional, exec), top)
 
+########################################################################
+# Profile-guided decode ordering
+########################################################################
+
+'''
+Read json files containing instruction frequency histograms
+mapping encoding names (either the name used in '__encoding' or the
+name in the XML such as "ADD_32_addsub_imm") to counts.
+Counts from multiple files are added together.
+'''
+def readProfile(files):
+    profile = defaultdict(int)
+    for fn in files:
+        with open(fn, "r") as f:
+            text = f.read()
+        if text.lstrip().startswith("{"):
+            try:
+                histogram = json.loads(text).items()
+            except ValueError as err:
+                print(err)
+                sys.exit(1)
+        else:
+            # output of __DumpEncodingCounts (see "Encoding counters")
+            histogram = readCounterDump(text)
+            if histogram == []:
+                print("Warning: no encoding counts found in", fn)
+        for (name, count) in histogram:
+            profile[name] += count
+    return profile
+
+'''
+Frequency of a row of an instruction table
+'''
+def rowWeight(profile, row):
+    (pats, nm, encname, undef, unpred, nop) = row
+    if undef or unpred or nop: return 0
+    if encname and encname in profile: return profile[encname]
+    return profile.get(deslash(nm), 0)
+
+'''
+Frequency of a child of a decode group: the sum over all
+instructions in the subtree.
+'''
+def childWeight(profile, classes, child):
+    (dec, isGroup, c) = child
+    if isGroup:
+        (label, diagram, children) = c
+        return sum(childWeight(profile, classes, x) for x in children)
+    (label, allocated, predictable) = c
+    if not (allocated and predictable): return 0
+    (fields, (ic, hdr, rows)) = classes[label]
+    return sum(rowWeight(profile, r) for r in rows)
+
+'''
+Test whether two ASL patterns such as "'01x'", "!'01'" and "_"
+cannot match the same value.
+The test is conservative: it may report that disjoint patterns overlap.
+'''
+def patternsDisjoint(p, q):
+    if p == "_" or q == "_": return False
+    if p.startswith("!") and q.startswith("!"): return False
+    if q.startswith("!"): (p, q) = (q, p)
+    if p.startswith("!"):
+        # !'a' and 'b' are disjoint if every value matching 'b' matches 'a'
+        (a, b) = (p[2:-1], q[1:-1])
+        return (len(a) == len(b)
+                and all(x == y or x not in "01" for (x, y) in zip(a, b)))
+    (a, b) = (p[1:-1], q[1:-1])
+    return (len(a) == len(b)
+            and any(x in "01" and y in "01" and x != y for (x, y) in zip(a, b)))
+
+'''
+Test whether two rows of patterns cannot match the same values
+'''
+def armsDisjoint(ps, qs):
+    return any(patternsDisjoint(p, q) for (p, q) in zip(ps, qs))
+
+'''
+Reorder the arms of a case statement so that more frequent arms come first.
+An arm is only moved ahead of another arm if their patterns are
+disjoint so the meaning of the case statement is not changed.
+Arms with equal weight stay in their original order.
+'pattern' and 'weight' extract the patterns and weight of an arm.
+'''
+def orderArms(arms, pattern, weight):
+    arms = list(arms)
+    weights = [ weight(a) for a in arms ]
+    for j in range(1, len(arms)):
+        k = j
+        while (k > 0 and weights[k] > weights[k-1]
+               and armsDisjoint(pattern(arms[k]), pattern(arms[k-1]))):
+            arms[k-1], arms[k] = arms[k], arms[k-1]
+            weights[k-1], weights[k] = weights[k], weights[k-1]
+            k -= 1
+    return arms
+
+########################################################################
+# Decode tree minimisation
+########################################################################
+
+# Decode trees are converted to nodes that are either
+#     ('case', columns, arms)  where columns are bitslices (lo, wd)
+#                              and arms are (patterns, child)
+#     ('leaf', text)           where text is what follows '=>' in a 'when' arm
+# Nodes are hash-consed so identical subtrees are shared (forming a DAG).
+# As in ASL, the first matching arm is taken and, if it is a case that has
+# no matching arm, the opcode does not decode.
+
+'''
+Return the unique copy of a node
+'''
+def hashCons(nodes, node):
+    return nodes.setdefault(node, node)
+
+'''
+Convert an instruction table to a node
+'''
+def tableNode(nodes, c, profile=None):
+    (fields, (ic, hdr, rows)) = c
+    fs = { nm: (hi, wd) for (nm, hi, wd) in fields }
+    columns = tuple(columnSlice(fs, h) for h in hdr)
+    if profile:
+        rows = orderArms(rows, lambda r: r[0], lambda r: rowWeight(profile, r))
+    arms = []
+    for (pats, nm, encname, undef, unpred, nop) in rows:
+        nm = "__encoding "+deslash(nm)
+        if encname: nm = nm + " // " +encname
+        if undef: nm = "__UNALLOCATED"
+        if unpred: nm = "__UNPREDICTABLE"
+        if nop: nm = "__NOP"
+        arms.append((tuple(pats), hashCons(nodes, ('leaf', nm))))
+    return hashCons(nodes, ('case', columns, tuple(arms)))
+
+'''
+Convert a decode tree read by readDecodeFile to a node with the same
+meaning as the output of printGroup
+'''
+def decodeNode(nodes, classes, root, profile=None):
+    (label, (size, columns), children) = root
+    if profile:
+        children = orderArms(children, lambda c: c[0], lambda c: childWeight(profile, classes, c))
+    arms = []
+    for (dec, isGroup, c) in children:
+        if isGroup:
+            child = decodeNode(nodes, classes, c, profile)
+        else:
+            (label, allocated, predictable) = c
+            if allocated and predictable:
+                child = tableNode(nodes, classes[label], profile)
+            else:
+                if not allocated: tag = "__UNPREDICTABLE"
+                if not predictable: tag = "__UNALLOCATED"
+                child = hashCons(nodes, ('leaf', tag))
+        arms.append((tuple(dec), child))
+    return hashCons(nodes, ('case', tuple(columns), tuple(arms)))
+
+'''
+Convert a pattern on bitslice 'lo +: wd' to (negated, mask, value)
+where mask and value are bits of the opcode.
+Returns None for "_".
+'''
+def patternBits(lo, wd, pat):
+    if pat == "_": return None
+    neg = pat.startswith("!")
+    bits = pat[2:-1] if neg else pat[1:-1]
+    mask = 0
+    value = 0
+    for (i, b) in enumerate(bits):
+        if b in "01":
+            mask  |= 1 << (lo + wd - 1 - i)
+            value |= int(b) << (lo + wd - 1 - i)
+    return (neg, mask, value)
+
+'''
+Simplify a pattern on bitslice 'lo +: wd' given that the opcode bits
+in 'mask' are known to be 'value'.
+Returns True if the pattern always matches, False if it never matches
+or a simpler pattern that does not test the known bits.
+'''
+def simplifyPattern(lo, wd, pat, mask, value):
+    pb = patternBits(lo, wd, pat)
+    if pb is None: return True
+    (neg, pm, pv) = pb
+    if pm & mask & (pv ^ value): return neg # a known bit is different
+    if pm & ~mask == 0: return not neg      # all bits are known and the same
+    bits = pat[2:-1] if neg else pat[1:-1]
+    bits = ''.join('x' if mask >> (lo + wd - 1 - i) & 1 else b for (i, b) in enumerate(bits))
+    return ("!" if neg else "") + squote(bits)
+
+'''
+Test whether every value matching pattern p also matches pattern q
+'''
+def patternSubsumed(p, q):
+    if q == "_": return True
+    if p == "_" or p.startswith("!") or q.startswith("!"): return p == q
+    (a, b) = (p[1:-1], q[1:-1])
+    return len(a) == len(b) and all(y not in "01" or x == y for (x, y) in zip(a, b))
+
+'''
+Combine two patterns that differ in exactly one bit into a single pattern
+(or return None)
+'''
+def mergePatterns(p, q):
+    if p == "_" or q == "_" or p.startswith("!") or q.startswith("!"): return None
+    (a, b) = (p[1:-1], q[1:-1])
+    diffs = [ i for (i, (x, y)) in enumerate(zip(a, b)) if x != y ]
+    if len(a) != len(b) or len(diffs) != 1 or {a[diffs[0]], b[diffs[0]]} != {'0', '1'}: return None
+    bits = a[:diffs[0]] + 'x' + a[diffs[0]+1:]
+    return "_" if all(x not in "01" for x in bits) else squote(bits)
+
+'''
+Merge adjacent arms with the same child.
+An arm is dropped if the next arm has the same child and matches
+everything that it matches and two arms are combined if their patterns
+only differ in a single bit.
+'''
+def mergeArms(arms):
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(arms) - 1):
+            ((ps, a), (qs, b)) = (arms[i], arms[i+1])
+            if a is not b: continue
+            if all(patternSubsumed(p, q) for (p, q) in zip(ps, qs)):
+                del arms[i]
+                changed = True
+                break
+            diffs = [ j for (j, (p, q)) in enumerate(zip(ps, qs)) if p != q ]
+            if len(diffs) == 1:
+                m = mergePatterns(ps[diffs[0]], qs[diffs[0]])
+                if m is not None:
+                    arms[i:i+2] = [(ps[:diffs[0]] + (m,) + ps[diffs[0]+1:], a)]
+                    changed = True
+                    break
+    return arms
+
+'''
+Remove columns that are not tested by any arm and narrow columns to the
+range of bits that are tested
+'''
+def trimColumns(columns, arms):
+    newcols = []
+    keep = []
+    for (j, (lo, wd)) in enumerate(columns):
+        pbs = [ patternBits(lo, wd, ps[j]) for (ps, _) in arms ]
+        used = 0
+        for pb in pbs:
+            if pb is not None: used |= pb[1]
+        if used == 0:
+            continue
+        nlo = (used & -used).bit_length() - 1
+        nhi = used.bit_length() - 1
+        newcols.append((nlo, nhi - nlo + 1))
+        keep.append((j, lo + wd - 1 - nhi, lo + wd - nlo))
+    newarms = []
+    for (ps, c) in arms:
+        qs = []
+        for (j, start, end) in keep:
+            p = ps[j]
+            if p != "_":
+                neg = p.startswith("!")
+                bits = (p[2:-1] if neg else p[1:-1])[start:end]
+                p = ("!" if neg else "") + squote(bits)
+            qs.append(p)
+        newarms.append((tuple(qs), c))
+    return (tuple(newcols), newarms)
+
+'''
+Minimise a decode tree node given that the opcode bits in 'mask'
+are known to be 'value':
+- remove tests of bits that are already known
+- remove arms that cannot match and arms after an arm that always matches
+- merge adjacent arms with the same child
+- remove columns that are not tested
+- replace a case with a single arm that always matches by its child
+Returns None if no opcode can match.
+'''
+def minimiseNode(nodes, node, mask=0, value=0):
+    if node[0] == 'leaf': return node
+    (_, columns, arms) = node
+    newarms = []
+    for (i, (ps, child)) in enumerate(arms):
+        qs = [ simplifyPattern(lo, wd, p, mask, value) for ((lo, wd), p) in zip(columns, ps) ]
+        if False in qs: continue
+        qs = tuple("_" if q is True else q for q in qs)
+
+        # bits that are known if this arm matches
+        (m, v) = (mask, value)
+        for ((lo, wd), q) in zip(columns, qs):
+            pb = patternBits(lo, wd, q)
+            if pb is None: continue
+            (neg, pm, pv) = pb
+            if not neg:
+                (m, v) = (m | pm, v | pv)
+            elif pm & (pm - 1) == 0: # negation of a single bit
+                (m, v) = (m | pm, v | (pm & ~pv))
+
+        c = minimiseNode(nodes, child, m, v)
+        if c is None:
+            if i == len(arms) - 1: continue
+            c = child # keep original child so that no later arm is taken
+        newarms.append((qs, c))
+        if all(q == "_" for q in qs): break
+    if newarms == []: return None
+
+    newarms = mergeArms(newarms)
+    (columns, newarms) = trimColumns(columns, newarms)
+    if len(newarms) == 1 and all(q == "_" for q in newarms[0][0]):
+        return newarms[0][1]
+    return hashCons(nodes, ('case', columns, tuple(newarms)))
+
+'''
+Check whether two decode tree nodes decode every opcode the same way.
+The set of opcodes is split into cubes (opcodes with the bits in 'mask'
+equal to 'value') until both nodes reach a leaf (or fail) for every
+opcode in the cube.
+Returns None if the nodes are equivalent or a cube where they differ.
+'''
+def equivalentNodes(a, b):
+    compiled = {}
+    def arms(node):
+        if id(node) not in compiled:
+            (_, columns, arms) = node
+            compiled[id(node)] = [ ([ patternBits(lo, wd, p) for ((lo, wd), p) in zip(columns, ps) ], c)
+                                   for (ps, c) in arms ]
+        return compiled[id(node)]
+
+    # True if arm matches every opcode in the cube, False if it matches none
+    # or a bit to split the cube on
+    def armMatches(pbs, mask, value):
+        split = True
+        for pb in pbs:
+            if pb is None: continue
+            (neg, pm, pv) = pb
+            if pm & mask & (pv ^ value):
+                if not neg: return False
+            elif pm & ~mask == 0:
+                if neg: return False
+            else:
+                split = (pm & ~mask).bit_length() - 1
+        return split
+
+    # follow node as far as possible for all opcodes in the cube
+    # returns (node, bit) where bit is None if node is a leaf (or None)
+    def resolve(node, mask, value):
+        while node is not None and node[0] == 'case':
+            for (pbs, c) in arms(node):
+                r = armMatches(pbs, mask, value)
+                if r is False: continue
+                if r is True:
+                    node = c
+                    break
+                return (node, r)
+            else:
+                node = None
+        return (node, None)
+
+    def check(a, b, mask, value):
+        (a, bit) = resolve(a, mask, value)
+        if bit is None:
+            (b, bit) = resolve(b, mask, value)
+            if bit is None:
+                return None if a == b else (mask, value)
+        mask |= 1 << bit
+        return check(a, b, mask, value) or check(a, b, mask, value | (1 << bit))
+
+    return check(a, b, 0, 0)
+
+'''
+Count nodes (with and without sharing) and patterns tested in a decode tree
+'''
+def decodeStats(node):
+    seen = set()
+    def count(node):
+        seen.add(id(node))
+        if node[0] == 'leaf': return (1, 0)
+        (_, columns, arms) = node
+        (n, t) = (1, 0)
+        for (ps, c) in arms:
+            t += sum(1 for p in ps if p != "_")
+            (cn, ct) = count(c)
+            (n, t) = (n + cn, t + ct)
+        return (n, t)
+    (n, t) = count(node)
+    return (n, len(seen), t)
+
+def printNode(ofile, level, node):
+    (_, columns, arms) = node
+    print("    "*level +"case ("+ ", ".join(map(ppslice, columns)) +") of", file=ofile)
+    for (ps, c) in arms:
+        if c[0] == 'leaf':
+            print("    "*(level+1) +"when ("+ ", ".join(ps) +") => "+ c[1], file=ofile)
+        else:
+            print("    "*(level+1) +"when ("+ ", ".join(ps) +") =>", file=ofile)
+            printNode(ofile, level+2, c)
+
+'''
+Print a minimised decode tree after checking that it is equivalent to the
+original decode tree
+'''
+def printMinimisedDecodeTree(ofile, groups, classes, profile=None, verbose=0):
+    nodes = {}
+    tree = decodeNode(nodes, classes, groups, profile)
+    mintree = minimiseNode(nodes, tree)
+    if mintree is None or mintree[0] == 'leaf':
+        mintree = tree
+    cube = equivalentNodes(tree, mintree)
+    if cube is not None:
+        (mask, value) = cube
+        pattern = ''.join(('1' if value >> i & 1 else '0') if mask >> i & 1 else 'x' for i in reversed(range(32)))
+        print("Error: minimised", groups[0], "decoder differs from original for opcodes", pattern)
+        sys.exit(1)
+    if verbose > 0:
+        (n0, u0, t0) = decodeStats(tree)
+        (n1, u1, t1) = decodeStats(mintree)
+        print("Minimised", groups[0], "decoder from", n0, "nodes and", t0, "tests to",
+              n1, "nodes (", u1, "unique ) and", t1, "tests")
+    print("__decode", groups[0], file=ofile)
+    printNode(ofile, 1, mintree)
+
+########################################################################
+# Specialisation
+########################################################################
+
+# A specialisation file fixes the result of calls to feature and
+# execution state predicates such as HaveSVE() or HaveEL(EL2) for
+# one particular configuration.
+#
+# Calls are replaced by their values, conditions that mention them
+# are simplified and arms of if-statements that can no longer be
+# taken are removed.
+# Any definitions that are no longer used are then removed by the
+# usual reachability analysis.
+#
+# Like the rest of this script, this works on lines of ASL code.
+# If-statements are recognised by their indentation and only lines
+# that contain one of the calls are changed.
+
+'''
+Read specialisation files.
+Returns list of (regexp matching a call, value)
+'''
+def readSpecialisation(files):
+    calls = []
+    for fn in files:
+        with open(fn, "r") as f:
+            try:
+                spec = json.load(f)
+            except ValueError as err:
+                print(err)
+                sys.exit(1)
+        for (call, value) in spec['calls'].items():
+            m = re.fullmatch('\s*([a-zA-Z_][\w.]*)\s*\((.*)\)\s*', call)
+            if not m:
+                print("Error: cannot parse call", call, "in", fn)
+                sys.exit(1)
+            args = [ a.strip() for a in m.group(2).split(',') if a.strip() ]
+            regex = ('(?<![\w.])' + re.escape(m.group(1)) + '\s*\(\s*'
+                     + '\s*,\s*'.join([ re.escape(a) for a in args ]) + '\s*\)')
+            if isinstance(value, bool): value = "TRUE" if value else "FALSE"
+            calls.append((re.compile(regex), str(value)))
+    return calls
+
+# Name used in code to refer to a definition such as "HaveEL.1",
+# "AArch64.MemSingle.read.4" or "SCR_GEN["
+def linkName(d):
+    return re.sub('(\.(read|write))?\.(\d+|none)$', '', d.rstrip('['))
+
+def hasCall(e):
+    return re.search('[\w.]\s*\(', e) is not None
+
+# Find the bracket that matches the bracket at position i
+def matchingBracket(s, i):
+    depth = 0
+    for k in range(i, len(s)):
+        if s[k] in '([{': depth += 1
+        elif s[k] in ')]}':
+            depth -= 1
+            if depth == 0: return k
+    return None
+
+# Split expression at each occurrence of 'op' that is not inside brackets
+def splitTop(e, op):
+    parts = []
+    depth = 0
+    start = 0
+    i = 0
+    while i < len(e):
+        if e[i] in '([{':
+            depth += 1
+        elif e[i] in ')]}':
+            depth -= 1
+        elif depth == 0 and e.startswith(op, i):
+            parts.append(e[start:i])
+            i += len(op)
+            start = i
+            continue
+        i += 1
+    parts.append(e[start:])
+    return parts
+
+def isPrimary(e):
+    if re.fullmatch('[\w.]+', e): return True
+    m = re.match('[\w.]*\s*[([]', e)
+    return m is not None and matchingBracket(e, m.end()-1) == len(e)-1
+
+'''
+Simplify a boolean expression containing TRUE and FALSE.
+Operands of && and || are evaluated from left to right so operands
+after FALSE (resp. TRUE) are dropped but operands before it are
+only dropped if they do not call any functions.
+'''
+def simplifyCondition(e):
+    e = e.strip()
+    for (op, zero, unit) in [('||', 'TRUE', 'FALSE'), ('&&', 'FALSE', 'TRUE')]:
+        parts = splitTop(e, op)
+        if len(parts) > 1:
+            xs = []
+            for p in parts:
+                x = simplifyCondition(p)
+                if x == unit: continue
+                xs.append(x)
+                if x == zero:
+                    if not any(hasCall(y) for y in xs): return zero
+                    break
+            return (' '+op+' ').join(xs) if xs else unit
+    if e.startswith('!') and not e.startswith('!=') and isPrimary(e[1:].strip()):
+        x = simplifyCondition(e[1:])
+        return {'TRUE': 'FALSE', 'FALSE': 'TRUE'}.get(x, '!'+x)
+    if e.startswith('(') and matchingBracket(e, 0) == len(e)-1:
+        x = simplifyCondition(e[1:-1])
+        return x if x in ['TRUE', 'FALSE'] else '('+x+')'
+    return e
+
+re_if        = re.compile('(\s*)(if|elsif)\s+(.*)\s+then(\s*//.*)?')
+re_else      = re.compile('(\s*)else(\s*//.*)?')
+re_if_stmt   = re.compile('(\s*)if\s+(.*?)\s+then\s+(.*)')
+re_condition = re.compile('(\s*)(assert|return)\s+(.*);(\s*//.*)?')
+
+def indentation(l):
+    return len(l) - len(l.lstrip())
+
+def hasCode(lines):
+    return any(l.strip() != '' and not l.strip().startswith('//') for l in lines)
+
+# Find end of block of lines that are indented more than 'ind'
+# (excluding any blank lines at the end of the block)
+def blockEnd(lines, i, ind):
+    j = i
+    while j < len(lines) and (lines[j].strip() == '' or indentation(lines[j]) > ind): j += 1
+    while j > i and lines[j-1].strip() == '': j -= 1
+    return j
+
+'''
+Simplify the marked lines of a block of code, removing arms of
+if-statements whose condition is FALSE.
+If removing code leaves a block empty, the original block is kept.
+'''
+def pruneBlock(lines, marked):
+    out = []
+    i = 0
+    while i < len(lines):
+        l = lines[i]
+        if l.strip() == '':
+            out.append(l)
+            i += 1
+            continue
+        ind = indentation(l)
+        j = blockEnd(lines, i+1, ind)
+        m = re_if.fullmatch(l)
+        if m and m.group(2) == 'if' and j > i+1:
+            # collect the arms of the if-statement
+            arms = [('if', m.group(3), m.group(4) or '', i, j)]
+            while j < len(lines) and indentation(lines[j]) == ind and arms[-1][0] != 'else':
+                k = blockEnd(lines, j+1, ind)
+                m = re_if.fullmatch(lines[j])
+                e = re_else.fullmatch(lines[j])
+                if k == j+1: break
+                if m and m.group(2) == 'elsif':
+                    arms.append(('elsif', m.group(3), m.group(4) or '', j, k))
+                elif e:
+                    arms.append(('else', None, e.group(2) or '', j, k))
+                else:
+                    break
+                j = k
+            out.extend(pruneArms(lines, marked, arms, l[:ind]))
+            i = j
+            continue
+        m = re_if_stmt.fullmatch(l)
+        if (marked[i] and m and not re.search('\\b(then|else|elsif)\\b', m.group(3))
+            and not (j < len(lines) and re.match('\s*(else|elsif)\\b', lines[j]))):
+            cond = simplifyCondition(m.group(2))
+            if cond == 'TRUE' and j == i+1:
+                out.append(m.group(1) + m.group(3))
+            elif cond != 'FALSE' or j != i+1:
+                out.append(m.group(1) + 'if ' + cond + ' then ' + m.group(3))
+                out.extend(lines[i+1:j])
+            i = j
+            continue
+        m = re_condition.fullmatch(l)
+        if marked[i] and m:
+            cond = simplifyCondition(m.group(3))
+            if not (m.group(2) == 'assert' and cond == 'TRUE'):
+                out.append(m.group(1) + m.group(2) + ' ' + cond + ';' + (m.group(4) or ''))
+            out.extend(lines[i+1:j])
+            i = j
+            continue
+        out.append(l)
+        body = pruneBlock(lines[i+1:j], marked[i+1:j])
+        out.extend(body if hasCode(body) or not hasCode(lines[i+1:j]) else lines[i+1:j])
+        i = j
+    return out
+
+'''
+Simplify an if-statement consisting of 'arms' (kind, condition,
+comment, first line, end line) with indentation 'indent'.
+'''
+def pruneArms(lines, marked, arms, indent):
+    kept = [] # (kind, condition, comment, first line, original body, simplified body)
+    for (kind, cond, comment, i, j) in arms:
+        if cond is not None and marked[i]:
+            cond = simplifyCondition(cond)
+            if cond == 'FALSE': continue
+        body = lines[i+1:j]
+        kept.append((kind, cond, comment, i, body, pruneBlock(body, marked[i+1:j])))
+        if kind == 'else' or (marked[i] and cond == 'TRUE'): break
+
+    # drop final arms that no longer do anything
+    while kept:
+        (kind, cond, _, _, body, new) = kept[-1]
+        if new == body or hasCode(new) or (kind != 'else' and hasCall(cond)): break
+        kept.pop()
+
+    out = []
+    for (n, (kind, cond, comment, i, body, new)) in enumerate(kept):
+        if not hasCode(new): new = body
+        unconditional = kind == 'else' or (marked[i] and cond == 'TRUE')
+        if n == 0 and unconditional:
+            # replace the if-statement by the body of this arm
+            shift = min(indentation(l) for l in new if l.strip() != '') - len(indent)
+            return [ l[shift:] if l[:shift].strip() == '' else l.lstrip() for l in new ]
+        if unconditional:
+            out.append(indent + 'else' + comment)
+        elif marked[i] or (n == 0 and kind != 'if'):
+            out.append(indent + ('if ' if n == 0 else 'elsif ') + cond + ' then' + comment)
+        else:
+            out.append(lines[i])
+        out.extend(new)
+    return out
+
+'''
+Specialise ASL code by replacing calls with their values and
+simplifying the result.
+Top level lines (e.g., function prototypes) are not changed if 'body_only'.
+'''
+def specialiseCode(calls, code, body_only):
+    lines = code.splitlines()
+    marked = [False] * len(lines)
+    for (k, l) in enumerate(lines):
+        if body_only and not l[:1].isspace(): continue
+        (text, comment) = re.match('(.*?)(\s*//.*)?$', l).groups()
+        for (regex, value) in calls:
+            text = regex.sub(lambda m, v=value: v, text)
+        if text + (comment or '') != l:
+            lines[k] = text + (comment or '')
+            marked[k] = True
+    if not any(marked): return code
+    lines = pruneBlock(lines, marked)
+    return "\n".join(lines) + ("\n" if code.endswith("\n") else "")
+
+'''
+Specialise an ASL chunk, dropping dependencies on any names that are
+no longer used.
+'''
+def specialiseASL(calls, shared, a, body_only):
+    code = specialiseCode(calls, a.code, body_only)
+    if code == a.code: return a
+    used = identifiers(code)
+    unused = identifiers(a.code) - used
+    def dropped(d):
+        if d in shared:
+            names = { linkName(x) for x in shared[d].defs }
+            return names.isdisjoint(used) and not names.isdisjoint(unused)
+        return linkName(d) in unused
+    return ASL(a.name, code, a.defs, { d for d in a.deps if not dropped(d) })
+
+def specialiseInstruction(calls, shared, instr):
+    i = copy.copy(instr)
+    i.encs = [ (inm, insn_set, fields, specialiseASL(calls, shared, dec, False))
+               for (inm, insn_set, fields, dec) in instr.encs ]
+    if i.post: i.post = specialiseASL(calls, shared, i.post, False)
+    i.exec = specialiseASL(calls, shared, i.exec, False)
+    return i
+
 ########################################################################
 # Reachability analysis
 ########################################################################
@@ -772,6 +1738,154 @@ def reachable(graph, roots):
     for f in roots: worker([], f)
     return (sorted, visited)
 
+# Find the strongly connected components of the part of the graph
+# reachable from roots (Tarjan's algorithm, using an explicit stack
+# to avoid Python's recursion limit).
+# Returns list of components in dependency order: each component
+# comes after every component that it depends on.
+def sccs(graph, roots):
+    index    = {}
+    lowlink  = {}
+    onstack  = set()
+    stack    = []
+    result   = []
+    counter  = 0
+
+    for root in sorted(roots):
+        if root in index: continue
+        work = [(root, iter(sorted(graph[root])))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        onstack.add(root)
+        while work:
+            (f, children) = work[-1]
+            advanced = False
+            for g in children:
+                if g not in index:
+                    index[g] = lowlink[g] = counter
+                    counter += 1
+                    stack.append(g)
+                    onstack.add(g)
+                    work.append((g, iter(sorted(graph[g]))))
+                    advanced = True
+                    break
+                elif g in onstack:
+                    lowlink[f] = min(lowlink[f], index[g])
+            if advanced: continue
+            work.pop()
+            if work:
+                p = work[-1][0]
+                lowlink[p] = min(lowlink[p], lowlink[f])
+            if lowlink[f] == index[f]:
+                component = []
+                while True:
+                    g = stack.pop()
+                    onstack.discard(g)
+                    component.append(g)
+                    if g == f: break
+                result.append(component)
+    return result
+
+# Compute the transitive closure of every node in the graph reachable
+# from roots.
+# Closures are computed once per strongly connected component (in
+# dependency order) so that shared sub-closures are reused and are
+# represented as bitsets (Python ints) over the list of nodes 'order'.
+# Returns (order, closure) where closure maps each node to its bitset.
+def closures(graph, roots):
+    components = sccs(graph, roots)
+    order = [ f for c in components for f in c ]
+    position = { f: i for (i, f) in enumerate(order) }
+    closure = {}
+    for c in components:
+        component = set(c)
+        bits = 0
+        for f in c:
+            bits |= 1 << position[f]
+        for f in c:
+            for g in graph[f]:
+                if g not in component: bits |= closure[g]
+        for f in c:
+            closure[f] = bits
+    return (order, closure)
+
+# Convert a bitset produced by 'closures' back to a list of nodes
+# (in dependency order)
+def members(order, bits):
+    digits = bin(bits)[:1:-1] # least significant bit first
+    return [ order[i] for (i, b) in enumerate(digits) if b == '1' ]
+
+# Partition the nodes of a graph into groups (using 'key' to find the
+# initial group of each node) such that there are no cycles between
+# groups: groups that depend on each other are merged.
+# Returns list of (name, nodes, required groups) in dependency order
+# where the name of a merged group is the first of the original names.
+def partition(graph, nodes, key):
+    nodeset = set(nodes)
+    groups = defaultdict(set)
+    for f in nodes:
+        for g in graph[f]:
+            if g in nodeset and key(g) != key(f): groups[key(f)].add(key(g))
+    components = sccs(groups, { key(f) for f in nodes })
+    name = {}
+    for c in components:
+        for k in c: name[k] = min(c)
+    contents = defaultdict(list)
+    for f in nodes:
+        contents[name[key(f)]].append(f)
+    result = []
+    for c in components:
+        n = min(c)
+        requires = { name[k] for x in c for k in groups[x] } - {n}
+        result.append((n, contents[n], sorted(requires)))
+    return result
+
+# Compute the dominator tree of the part of the graph reachable from root
+# (Cooper, Harvey and Kennedy's iterative algorithm).
+# Returns (order, idom) where order is a postorder of the reachable
+# nodes (each node comes after every node that it dominates)
+# and idom maps each node to its immediate dominator.
+def dominators(graph, root):
+    order = []
+    visited = {root}
+    work = [(root, iter(sorted(graph[root], key=str)))]
+    while work:
+        (f, children) = work[-1]
+        for g in children:
+            if g not in visited:
+                visited.add(g)
+                work.append((g, iter(sorted(graph[g], key=str))))
+                break
+        else:
+            work.pop()
+            order.append(f)
+    position = { f: i for (i, f) in enumerate(order) }
+
+    preds = defaultdict(list)
+    for f in order:
+        for g in graph[f]: preds[g].append(f)
+
+    def intersect(a, b):
+        while a != b:
+            while position[a] < position[b]: a = idom[a]
+            while position[b] < position[a]: b = idom[b]
+        return a
+
+    idom = { root: root }
+    changed = True
+    while changed:
+        changed = False
+        for f in reversed(order[:-1]):
+            new = None
+            for p in preds[f]:
+                if p in idom:
+                    new = p if new is None else intersect(p, new)
+            if idom.get(f) != new:
+                idom[f] = new
+                changed = True
+    return (order, idom)
+
 ########################################################################
 # Canary detection
 ########################################################################
@@ -795,102 +1909,979 @@ def checkCanaries(callers, isChunk, roots, f, path):
             checkCanaries(callers, isChunk, roots, g, path)
 
 ########################################################################
-# Main
+# Cut suggestion
 ########################################################################
 
-def main():
-    global alt_slice_syntax
-    global include_regex
-    global exclude_regex
-    global demangle_instr
+# Suggest functions to cut that would remove the most code.
+#
+# Cutting a chunk replaces it by its prototype (see toPrototype) so
+# each chunk is split into two nodes: a 'proto' node that depends
+# on the types used in the prototype and a 'body' node that depends
+# on everything else.
+# Cutting the chunk removes the edge from proto to body so the code
+# removed is exactly the part of the graph dominated by the body node.
+# All candidates are ranked using a single dominator tree so the
+# savings of combinations of cuts are only approximate.
+#
+# Returns list of (def, chunks removed, lines removed) for the
+# best 'n' cuts, skipping cuts that are nested inside better cuts.
+def suggestCuts(shared, chunks, roots, n):
+    def proto(x): return ('proto', x)
+    def body(x):  return ('body', x)
+    def node(x):  return proto(x) if x in shared else x
+
+    graph = defaultdict(set)
+    lines = defaultdict(int)
+    for a in shared.values():
+        p = a.toPrototype()
+        p.patchDependencies(chunks)
+        graph[proto(a.name)] = { node(d) for d in p.deps } | { body(a.name) }
+        graph[body(a.name)]  = { node(d) for d in a.deps }
+        for d in a.defs:
+            graph[d] = { proto(a.name) }
+        plines = len(p.code.splitlines())
+        lines[proto(a.name)] = plines
+        lines[body(a.name)]  = len(a.code.splitlines()) - plines
+    root = ('root', None)
+    graph[root] = { node(r) for r in roots }
+
+    (order, idom) = dominators(graph, root)
+
+    # size of the dominated subtree of each node
+    removed_chunks = defaultdict(int)
+    removed_lines  = defaultdict(int)
+    for f in order:
+        if f == root: continue
+        if isinstance(f, tuple) and f[0] == 'proto': removed_chunks[f] += 1
+        removed_lines[f] += lines[f]
+        removed_chunks[idom[f]] += removed_chunks[f]
+        removed_lines[idom[f]]  += removed_lines[f]
+
+    # roots cannot be cut
+    keep = { r if r in shared else chunks[r].name for r in roots if r in shared or r in chunks }
+    candidates = [ f[1] for f in order
+                   if isinstance(f, tuple) and f[0] == 'body'
+                   and f[1] not in keep and shared[f[1]].defs and removed_lines[f] > 0 ]
+    candidates.sort(key=lambda x: (-removed_lines[body(x)], -removed_chunks[body(x)], x))
+
+    def dominatedBy(f, g):
+        while f != root:
+            if f == g: return True
+            f = idom[f]
+        return False
+
+    result = []
+    chosen = []
+    for x in candidates:
+        if len(result) >= n: break
+        if any(dominatedBy(body(x), body(y)) for y in chosen): continue
+        chosen.append(x)
+        result.append((sorted(shared[x].defs)[0], removed_chunks[body(x)], removed_lines[body(x)]))
+    return result
 
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('--verbose', '-v', help='Use verbose output',
-                        action = 'count', default=0)
-    parser.add_argument('--altslicesyntax', help='Convert to alternative slice syntax',
-                        action='store_true', default=False)
-    parser.add_argument('--sail_asts', help='Output Sail file for AST clauses',
-                        metavar='FILE', default=None)
-    parser.add_argument('--demangle', help='Demangle instruction ASL',
-                        action='store_true', default=False)
-    parser.add_argument('--output', '-o', help='Basename for output files',
-                        metavar='FILE', default='arch')
-    parser.add_argument('dir', metavar='<dir>',  nargs='+',
-                        help='input directories')
-    parser.add_argument('--filter',  help='Optional input json file to filter definitions',
-                        metavar='FILE', default=[], nargs='*')
-    parser.add_argument('--arch', help='Optional list of architecture states to extract',
-                        choices=["AArch32", "AArch64"], default=[], action='append')
-    parser.add_argument('--include', help='Regex to select instructions by name',
-                        metavar='REGEX', default=None)
-    parser.add_argument('--exclude', help='Regex to exclude instructions by name',
-                        metavar='REGEX', default=None)
-    args = parser.parse_args()
+########################################################################
+# Cost report
+########################################################################
 
-    alt_slice_syntax = args.altslicesyntax
-    if args.include is not None:
-        include_regex = re.compile(args.include)
-    if args.exclude is not None:
-        exclude_regex = re.compile(args.exclude)
-    demangle_instr   = args.demangle
+cost_fields = ['kind', 'name', 'lines', 'closure_chunks', 'closure_lines', 'fan_in']
 
-    encodings = []
-    if "AArch32" in args.arch: encodings.extend(["T16", "T32", "A32"])
-    if "AArch64" in args.arch: encodings.extend(["A64"])
-    if args.verbose > 0:
-        if encodings != []:
-            print("Selecting encodings", ", ".join(encodings))
-        else:
-            print("Selecting entire architecture")
+'''
+Compute the cost of each instruction, encoding and shared chunk
+(its size and the number of chunks and lines in its transitive closure)
+and the fan-in of each shared chunk (the number of instructions whose
+closure contains it).
+All closures are computed in a single pass over the strongly connected
+components of the dependency graph (see 'closures').
+Returns list of rows with the fields in 'cost_fields'.
+'''
+def costReport(deps, shared, instrs):
+    def size(a): return len(a.code.splitlines()) if a else 0
+
+    entries = [] # (kind, name, lines, roots)
+    for i in instrs:
+        common = set(i.exec.deps)
+        if i.post: common |= i.post.deps
+        lines = size(i.exec) + size(i.post)
+        all_deps = set(common)
+        for (inm,_,_,dec) in i.encs:
+            entries.append(('encoding', deslash(inm), lines + size(dec), common | dec.deps))
+            all_deps |= dec.deps
+        lines += sum(size(dec) for (_,_,_,dec) in i.encs)
+        entries.append(('instruction', i.name, lines, all_deps))
+
+    roots = set(shared)
+    for (_, _, _, rs) in entries: roots |= rs
+    (order, closure) = closures(deps, roots)
+
+    def cost(rs):
+        bits = 0
+        for r in rs: bits |= closure[r]
+        xs = [ x for x in members(order, bits) if x in shared ]
+        return (xs, sum(size(shared[x]) for x in xs))
+
+    rows = []
+    fan_in = defaultdict(int)
+    for (kind, name, lines, rs) in entries:
+        (xs, nlines) = cost(rs)
+        if kind == 'instruction':
+            for x in xs: fan_in[x] += 1
+        rows.append({ 'kind': kind, 'name': name, 'lines': lines,
+                      'closure_chunks': len(xs), 'closure_lines': nlines, 'fan_in': None })
+    for x in sorted(shared):
+        (xs, nlines) = cost({x})
+        rows.append({ 'kind': 'function', 'name': x, 'lines': size(shared[x]),
+                      'closure_chunks': len(xs), 'closure_lines': nlines, 'fan_in': fan_in[x] })
+    rows.sort(key=lambda r: (r['kind'], r['name']))
+    return rows
 
-    notice = readNotice(ET.parse(os.path.join(args.dir[0], 'notice.xml')))
-    (shared,names) = readShared([ f for d in args.dir for f in glob.glob(os.path.join(d, 'shared_pseudocode.xml'))])
+'''
+Write cost report as json (if the filename ends with ".json") or csv
+'''
+def writeCostReport(outf, filename, rows):
+    if filename.endswith(".json"):
+        json.dump(rows, outf, indent=4)
+        print(file=outf)
+    else:
+        w = csv.DictWriter(outf, fieldnames=cost_fields, lineterminator='\n')
+        w.writeheader()
+        w.writerows(rows)
 
-    # reverse mapping of names back to the chunks containing them
-    chunks = {}
-    for a in shared.values():
-        for d in a.defs:
-            chunks[d] = a
+########################################################################
+# Purity analysis
+########################################################################
 
-    for a in shared.values():
-        a.patchDependencies(chunks)
+# Each function in the shared pseudocode is classified as
+#   pure             - its result only depends on its arguments
+#   read-only-global - it also reads global variables or registers
+#                      (or UNKNOWN or IMPLEMENTATION_DEFINED values)
+#   side-effecting   - it writes global variables or registers, raises
+#                      an exception (UNDEFINED, UNPREDICTABLE, SEE, throw)
+#                      or has no body (builtins and cut functions)
+# and a function has the worst class of its own code and of every
+# function that it uses.
+# Calls to functions that are not defined in the shared pseudocode
+# (such as UInt and Zeros) are assumed to be pure.
+#
+# Like specialisation, this works on lines of ASL code.
+# Global variables are the top-level variable declarations in the
+# shared pseudocode and system registers (which are declared in
+# regs.asl) are recognised by their names: any undeclared upper-case
+# name followed by a field, slice or index (e.g., "HCR.TGE") and
+# any name ending in an exception level (e.g., "SCTLR_EL1").
 
-    decoder_files = [ 'encodingindex.xml', 't32_encindex.xml', 'a32_encindex.xml' ]
-    decoders = [ readDecodeFile(d, f) for df in decoder_files for d in args.dir for f in glob.glob(os.path.join(d, df)) ]
+purity_classes = ['pure', 'read-only-global', 'side-effecting']
 
-    sailhack = args.sail_asts is not None
-    instrs = []
-    tops   = []
-    for d in args.dir:
-        for inf in glob.glob(os.path.join(d, '*.xml')):
-            name = re.search('.*/(\S+).xml',inf).group(1)
-            if name == "onebigfile": continue
-            xml = ET.parse(inf)
-            (instr, top) = readInstruction(xml,chunks,sailhack)
-            if top: tops.append(top)
-            if instr is None: continue
+asl_keywords = { 'return', 'assert', 'if', 'elsif', 'then', 'else', 'case', 'when',
+                 'of', 'otherwise', 'while', 'do', 'repeat', 'until', 'for', 'to',
+                 'downto', 'SEE', 'UNDEFINED', 'UNPREDICTABLE', 'throw', 'try',
+                 'catch', 'AND', 'OR', 'EOR', 'NOT', 'DIV', 'MOD', 'IN', 'constant' }
 
-            if encodings != []: # discard encodings from unwanted InsnSets
-                encs = [ e for e in instr.encs if e[1] in encodings ]
-                if encs == []:
-                    if args.verbose > 1: print("Discarding", instr.name, encodings)
-                    continue
-                instr.encs = encs
+# Top-level declaration of a global variable or array
+global_decl = re.compile(r'^(array\s+)?([\w.]+(\([^)]*\))?)\s+([a-zA-Z_]\w*)\s*(\[[^\]]*\.\.[^\]]*\])?\s*(=.*)?;\s*$')
 
-            instrs.append(instr)
+# Declarations of parameters and local variables
+local_decl  = re.compile(r'(?<![\w.])([\w.]+(\([^()]*\))?)\s+([a-zA-Z_]\w*)\s*(?=[=;,)\]]|$)')
 
-    # Having read everything in, decide which parts to write
-    # back out again and in what order
+# Names that are assumed to be system registers
+register_name = re.compile(r'(?<![\w.])([A-Z][A-Z0-9_]*_EL[0-3]{1,2}\b|[A-Z][A-Z0-9_]*(?=[.<\[]))')
 
-    if args.verbose > 3:
-        for f in shared.values():
-            print("Dependencies", f.name, "=", str(f.deps))
-            print("Definitions", f.name, "=", str(f.defs))
+exception_code = re.compile(r'\b(UNDEFINED|UNPREDICTABLE)\s*;|\b(SEE|throw)\b')
+unknown_code   = re.compile(r'\b(UNKNOWN|IMPLEMENTATION_DEFINED)\b')
+
+# Drop comments, strings and bitvector literals from a line of code
+def stripLine(l):
+    l = re.split('//', l)[0]
+    l = re.sub(r'"[^"]*"', '""', l)
+    return re.sub(r"'[01xz ]*'", "''", l)
+
+def isFunction(d):
+    return re.search(r'\.(\d+|none)$', d) is not None
+
+'''
+Find the global variables and the constants declared in the shared
+pseudocode.
+'''
+def globalNames(shared):
+    globals = set()
+    constants = set()
+    for a in shared.values():
+        for l in a.code.splitlines():
+            if l.startswith(' ') or l.startswith('\t'): continue
+            l = stripLine(l).strip()
+            m = re.match(r'constant\s+.*?([a-zA-Z_]\w*)\s*=', l)
+            if m:
+                constants.add(m.group(1))
+                continue
+            m = global_decl.match(l)
+            if m and m.group(2) not in ['type', 'enumeration']:
+                globals.add(m.group(4))
+    return (globals, constants)
+
+'''
+Classify the code of a single chunk (ignoring the functions it calls).
+'globals' is the set of global variable names and 'defined' is the set
+of other names defined in the shared pseudocode (that cannot be
+registers).
+Returns (class, reads, writes, effects).
+'''
+def localPurity(a, globals, defined):
+    if not any(isFunction(d) for d in a.defs): return (0, set(), set(), set())
+
+    lines = [ stripLine(l) for l in a.code.splitlines() ]
+    body  = [ l for l in lines if l.strip() != "" and l[0] in ' \t' ]
+    heads = [ l.strip() for l in lines if l.strip() != "" and l[0] not in ' \t' ]
+
+    locals = set()
+    for l in lines:
+        for m in local_decl.finditer(l):
+            if m.group(1) not in asl_keywords: locals.add(m.group(3))
+        for m in re.finditer(r'\bfor\s+([a-zA-Z_]\w*)\s*=', l):
+            locals.add(m.group(1))
+
+    def isGlobal(x):
+        return x not in locals and (x in globals or (x not in defined and re.match('[A-Z][A-Z0-9_]*$', x)))
+
+    reads   = set()
+    writes  = set()
+    effects = set()
+    for l in body:
+        for m in re.finditer(r'(?<![\w.])([a-zA-Z_]\w*)', l):
+            if m.group(1) in globals and m.group(1) not in locals: reads.add(m.group(1))
+        for m in register_name.finditer(l):
+            if m.group(1) not in defined and m.group(1) not in locals: reads.add(m.group(1))
+        for m in exception_code.finditer(l):
+            effects.add(m.group(1) or m.group(2))
+        for m in unknown_code.finditer(l):
+            effects.add(m.group(1))
+        # assignments: split into statements and find the root of each lhs
+        for s in re.split(r';|=>|\b(?:then|else|do)\b', l):
+            s = s.strip()
+            m = re.match(r'\(([^()]*)\)\s*=(?!=)', s)
+            if m:
+                roots = [ re.match(r'\s*([a-zA-Z_]\w*)', x) for x in m.group(1).split(',') ]
+                roots = [ r.group(1) for r in roots if r ]
+            else:
+                m = re.match(r'([a-zA-Z_]\w*)([.\[<][^=]*)?\s*=(?!=)', s)
+                roots = [ m.group(1) ] if m else []
+            writes |= { r for r in roots if isGlobal(r) }
+
+    # builtins and cut functions have prototypes but no body
+    prototypes = [ l for l in heads if l.endswith(';') and re.search(r'[)\]]', l)
+                   and not global_decl.match(l)
+                   and l.split()[0] not in ['type', 'enumeration', 'constant', 'array'] ]
+    if body == [] or prototypes: effects.add('no body')
+
+    if writes or effects - { 'UNKNOWN', 'IMPLEMENTATION_DEFINED' }:
+        cls = 2
+    elif reads or effects:
+        cls = 1
+    else:
+        cls = 0
+    return (cls, reads, writes, effects)
+
+'''
+Classify every function in the shared pseudocode.
+The classes of all functions are computed in a single pass over the
+strongly connected components of the dependency graph (see 'sccs')
+so that mutually recursive functions get the same class.
+Returns mapping from each chunk name to a record of its class, the
+globals it reads and writes, its other effects and (if it is not
+responsible for its own class) a function that it uses that has
+the same class.
+'''
+def purityAnalysis(deps, shared):
+    (globals, constants) = globalNames(shared)
+    defined = constants | { re.sub(r'(\.(read|write))?\.(\d+|none)$', '', d).rstrip('[')
+                            for a in shared.values() for d in a.defs }
+    defined -= globals
+
+    local = { x: localPurity(a, globals, defined) for (x, a) in shared.items() }
+    cls = {}
+    via = {}
+    for c in sccs(deps, set(shared)):
+        component = set(c)
+        worst = max([ local[f][0] for f in c if f in local ] + [0])
+        cause = None
+        for f in sorted(c):
+            for g in sorted(deps[f]):
+                if g not in component and cls[g] > worst:
+                    worst = cls[g]
+                    cause = g if isFunction(g) else via[g] or g
+        for f in c:
+            cls[f] = worst
+            via[f] = cause if f not in local or local[f][0] < worst else None
+
+    result = {}
+    for (x, (_, reads, writes, effects)) in local.items():
+        result[x] = { 'class': purity_classes[cls[x]], 'reads': sorted(reads),
+                      'writes': sorted(writes), 'effects': sorted(effects), 'via': via[x] }
+    return result
+
+'''
+Write purity report as json: one entry for each function defined in
+'chunks'.
+'''
+def writePurityReport(outf, purity, chunks):
+    report = {}
+    for a in chunks:
+        for d in a.defs:
+            if isFunction(d): report[d] = dict(purity[a.name], chunk=a.name)
+    json.dump(report, outf, indent=4, sort_keys=True)
+    print(file=outf)
+
+########################################################################
+# Sail decoders
+########################################################################
+
+# With '--sail_asts', a decode function is written for each instruction
+# set that tests the opcode against the mask and value of each encoding.
+# Instead of testing every encoding in turn, the decoder first matches on
+# a slice of 'sail_dispatch_width' opcode bits (the slice that is fixed
+# in the most encodings) and each arm only tests the encodings that can
+# match those bits.
+# Encodings are tested in the order they were written so the result
+# is the same as testing every encoding in turn.
+
+sail_dispatch_width = 4
+
+'''
+Information needed to decode an encoding:
+(constructor name, fields, width, mask, value, guard)
+where fields is a list of bitslices (hi, lo) in the order of the
+arguments of the constructor and guard is an extra Sail condition (or None).
+T16 opcodes are 16 bits wide: their fields are in bits 31..16 of the
+encoding (bits 15..0 are padding) so they are shifted down by 16 bits.
+'''
+def sailEncoding(enc_name, insn_set, enc_fields):
+    width = 16 if insn_set == "T16" else 32
+    shift = 32 - width
+    (pattern, _) = opcodePattern(enc_fields)
+    (mask, value) = (0, 0)
+    for (i, b) in enumerate(reversed(pattern[:width])):
+        if b in "01":
+            mask  |= 1 << i
+            value |= int(b) << i
+    fields = [ (hi - shift, lo - shift) for (hi, lo, nm, split, consts) in enc_fields
+               if nm != '_' and lo >= shift ]
+    guard = None
+    if encodingGuard(insn_set, enc_fields) != "TRUE":
+        [(hi, lo)] = [ (hi, lo) for (hi, lo, nm, _, _) in enc_fields if nm == "cond" ]
+        guard = "opcode[" + str(hi - shift) + " .. " + str(lo - shift) + "] != 0b1111"
+    return (sanitize(enc_name), fields, width, mask, value, guard)
+
+def sailHex(x, width):
+    return "0x" + format(x, "0" + str(width // 4) + "x")
+
+'''
+Choose the slice (lo, wd) of the opcode to dispatch on: the slice
+that is fixed in the most encodings (preferring higher bits)
+'''
+def dispatchSlice(encs, width):
+    wd = min(sail_dispatch_width, width)
+    best = None
+    for lo in reversed(range(width - wd + 1)):
+        m = ((1 << wd) - 1) << lo
+        n = sum(1 for (_, _, _, mask, _, _) in encs if mask & m == m)
+        if best is None or n > best[0]: best = (n, lo)
+    return (best[1], wd)
+
+def printSailDecoder(file, insn_set, encs):
+    width = encs[0][2]
+    (lo, wd) = dispatchSlice(encs, width)
+    slice_mask = ((1 << wd) - 1) << lo
+    fn = "decode" + insn_set
+    print(file=file)
+    print("val " + fn + " : bits(" + str(width) + ") -> option(ast)", file=file)
+    print("function " + fn + "(opcode) =", file=file)
+    print("    match opcode[" + str(lo + wd - 1) + " .. " + str(lo) + "] {", file=file)
+    for v in range(1 << wd):
+        arms = []
+        for (nm, fields, _, mask, value, guard) in encs:
+            if ((v << lo) ^ value) & mask & slice_mask: continue
+            conds = []
+            if mask & ~slice_mask:
+                m = mask & ~slice_mask
+                conds.append("(opcode & " + sailHex(m, width) + ") == " + sailHex(value & m, width))
+            if guard: conds.append(guard)
+            args = ", ".join("opcode[" + str(hi) + " .. " + str(l) + "]" for (hi, l) in fields)
+            arms.append((" & ".join(conds), "Some(" + nm + "(" + args + "))"))
+            if conds == []: break # later encodings cannot be reached
+        if arms == []: continue
+        print("        " + "0b" + format(v, "0" + str(wd) + "b") + " =>", file=file)
+        prefix = "if "
+        for (cond, result) in arms:
+            if cond == "":
+                print("            " + ("else " if prefix != "if " else "") + result + ",", file=file)
+                break
+            print("            " + prefix + cond + " then", file=file)
+            print("                " + result, file=file)
+            prefix = "else if "
+        else:
+            print("            else None(),", file=file)
+    print("        _ => None()", file=file)
+    print("    }", file=file)
+
+'''
+Write a decode function for each instruction set in 'decodes'
+(a dictionary from instruction set to a list of sailEncoding results)
+'''
+def printSailDecoders(file, decodes):
+    for (insn_set, encs) in decodes.items():
+        printSailDecoder(file, insn_set, encs)
+
+########################################################################
+# Encoding counters
+########################################################################
+
+# With '--counters', the decode ASL of each encoding increments a
+# global counter and a separate file defines the counters and functions
+# to reset them and to print them.
+# The printed counts can be used as a profile (see readProfile).
+
+def counterName(inm):
+    return "__EncodingCount_" + deslash(inm)
+
+def counterIncrement(inm):
+    c = counterName(inm)
+    return c + " = " + c + " + 1;"
+
+'''
+ASL definitions of the counters of the encodings in 'names'
+'''
+def countersASL(names):
+    out = []
+    out.append("// Number of times that each encoding has been decoded")
+    out.append("// (generated by instrs2asl.py --counters)")
+    out.append("")
+    for n in names:
+        out.append("integer " + counterName(n) + ";")
+    out.append("")
+    out.append("__ResetEncodingCounts()")
+    for n in names:
+        out.append("    " + counterName(n) + " = 0;")
+    out.append("    return;")
+    out.append("")
+    out.append("// Print the non-zero counts in the format read by instrs2asl.py --profile")
+    out.append("__DumpEncodingCounts()")
+    for n in names:
+        out.append("    if " + counterName(n) + " != 0 then")
+        out.append('        print("__count ' + deslash(n) + ' ");')
+        out.append("        print_int_dec(" + counterName(n) + ");")
+        out.append('        print("\\n");')
+    out.append("    return;")
+    out.append("")
+    return "\n".join(out)
+
+'''
+Read the output of __DumpEncodingCounts.
+Other lines (e.g., output of the program being simulated) are ignored.
+Returns a list of (encoding name, count).
+'''
+def readCounterDump(text):
+    return [ (m.group(1), int(m.group(2)))
+             for m in re.finditer('(?m)^__count (\S+) (\d+)$', text) ]
+
+########################################################################
+# Bundles
+########################################################################
+
+# Entry points of the support code that are called by the
+# simulator (see support/README.txt) and by the interpreter
+# (to implement IMPLEMENTATION_DEFINED)
+bundle_roots = [
+    "__TopLevel",
+    "__TakeColdReset",
+    "__setPC",
+    "__getPC",
+    "__CycleEnd",
+    "__ModeString",
+    "__ELFWriteMemory",
+    "__IMPDEF_boolean",
+    "__IMPDEF_integer",
+    "__IMPDEF_bits",
+    "__IMPDEF_MemoryAttributes",
+]
+
+'''
+Find the names defined by a top-level declaration or definition in
+a hand-written ASL file such as types.asl or support/memory.asl
+'''
+def topLevelDefinitions(line):
+    def skipParens(s):
+        depth = 0
+        for (i, c) in enumerate(s):
+            if c == '(': depth += 1
+            if c == ')': depth -= 1
+            if depth == 0: return s[i+1:].lstrip()
+        return ""
+
+    defs = set()
+    m = re.match('(__builtin\s+)?(type|enumeration)\s+([\w.]+)', line)
+    if m:
+        defs.add(m.group(3))
+        if m.group(2) == 'enumeration':
+            body = re.search('{([^}]*)}', line)
+            if body: defs |= { x.strip() for x in body.group(1).split(',') if x.strip() }
+        return defs
+    if re.match('(array\s.*\s)?__register\s', line):
+        m = re.search('([a-zA-Z_]\w*)\s*;', line)
+        if m: defs.add(m.group(1))
+        return defs
+    s = re.sub('^constant\s+', '', line)
+    # skip the return type or variable type
+    if s.startswith('('):
+        s = skipParens(s)
+    elif re.match('[\w.]+\s*\(', s):
+        rest = skipParens(s[s.index('('):])
+        if re.match('[a-zA-Z_]', rest): s = rest
+    elif re.match('[\w.]+\s+[a-zA-Z_]', s):
+        s = re.sub('^[\w.]+\s+', '', s)
+    m = re.match('[a-zA-Z_][\w.]*', s)
+    if m: defs.add(m.group(0))
+    return defs
+
+'''
+Read a hand-written ASL file and split it into chunks: one chunk per
+top-level definition (together with any comments immediately in front of it).
+Comments at the start of the file are discarded.
+Chunks are named "file:line".
+'''
+def readASLFile(filename):
+    with open(filename, "r") as f:
+        lines = f.read().splitlines()
+    starts = []
+    for (i, l) in enumerate(lines):
+        if l and not l[0].isspace() and not l.startswith("//"):
+            s = i
+            while s > 0 and lines[s-1].startswith("//"): s -= 1
+            starts.append((s, i))
+    result = []
+    for (k, (s, i)) in enumerate(starts):
+        end = starts[k+1][0] if k+1 < len(starts) else len(lines)
+        code = "\n".join(lines[s:end]).rstrip()+"\n"
+        result.append(ASL(filename+":"+str(i+1), code, topLevelDefinitions(lines[i]), set()))
+    return result
+
+'''
+Find all the (possibly qualified) identifiers used in a piece of ASL code.
+Qualified names such as "PSTATE.nRW" also produce each prefix ("PSTATE").
+'''
+def identifiers(code):
+    names = set()
+    for line in code.splitlines():
+        l = re.split('//', line)[0]  # drop comments
+        l = re.sub('"[^"]*"', '', l) # drop strings
+        for m in re.finditer('[a-zA-Z_][\w]*(\.[a-zA-Z_]\w*)*', l):
+            parts = m.group(0).split('.')
+            for i in range(len(parts)):
+                names.add('.'.join(parts[:i+1]))
+    return names
+
+'''
+Build a dependency graph over the chunks of shared pseudocode
+and the chunks of hand-written ASL files (plus any instructions).
+
+The dependencies of shared pseudocode come from the XML hyperlinks
+but the hand-written files and references from the shared pseudocode
+to the hand-written files are found by matching identifiers
+against the names defined by each chunk.
+
+Returns (graph, resolve) where resolve maps a name to the chunks
+that define it.
+'''
+def bundleGraph(deps, shared, files):
+    index = defaultdict(set)
+    for a in shared.values():
+        for d in a.defs:
+            index[d].add(a.name)
+            index[d.rstrip('[')].add(a.name)
+            # strip accessor and arity suffixes from names like
+            # "AArch64.MemSingle.read.4" and "SP.write.none"
+            index[re.sub('(\.(read|write))?\.(\d+|none)$', '', d)].add(a.name)
+        for m in re.finditer('(?m)^enumeration\s+\w+\s*{([^}]*)}', a.code):
+            for x in m.group(1).split(','):
+                if x.strip(): index[x.strip()].add(a.name)
+    for a in files:
+        for d in a.defs:
+            index[d].add(a.name)
+
+    def resolve(names):
+        return { x for n in names for x in index.get(n, set()) }
+
+    graph = defaultdict(set)
+    for (f, ds) in deps.items():
+        graph[f] = set(ds)
+    file_nodes = { a.name for a in files }
+    for a in shared.values():
+        graph[a.name] |= { x for x in resolve(identifiers(a.code)) if x in file_nodes }
+    for a in files:
+        graph[a.name] = resolve(identifiers(a.code)) - {a.name}
+    return (graph, resolve)
+
+'''
+Write a single ASL file containing everything needed by the
+selected instructions: the hand-written files in 'head' (e.g., regs.asl
+and types.asl), the shared pseudocode, the instructions and the
+hand-written files in 'tail' (e.g., support/*.asl).
+Definitions that cannot be reached from the instructions, roots or
+the simulator entry points are omitted unless 'keepAll' is set.
+The load order of the original files is preserved.
+'''
+def writeBundle(outf, notice, tops, deps, shared, roots, instrs, head, tail, keepAll):
+    files = head + tail
+    (graph, resolve) = bundleGraph(deps, shared, files)
+
+    if keepAll:
+        roots = set(graph.keys())
+    else:
+        roots = set(roots) | resolve(bundle_roots)
+        for i in instrs:
+            roots |= resolve(identifiers(i.exec.code))
+            if i.post: roots |= resolve(identifiers(i.post.code))
+            for (_,_,_,dec) in i.encs: roots |= resolve(identifiers(dec.code))
+        # keep any top-level code that does not define anything
+        roots |= { a.name for a in files if not a.defs }
+    (order, live) = reachable(graph, roots)
+
+    print(notice, file=outf)
+    print(file=outf)
+    for a in head:
+        if a.name in live: print(a.code, file=outf)
+    print('\n'.join([ t for t in tops ]), file=outf)
+    print('\n'.join([ shared[x].code for x in order if x in shared ]), file=outf)
+    if current().count_encodings:
+        print(countersASL([ inm for i in instrs for (inm,_,_,_) in i.encs ]), file=outf)
+    for i in instrs:
+        i.emit_asl_syntax(outf)
+        print(file=outf)
+    for a in tail:
+        if a.name in live: print(a.code, file=outf)
+    print('/'*72, file=outf)
+    print('// End', file=outf)
+    print('/'*72, file=outf)
+
+########################################################################
+# Snapshots
+########################################################################
+
+# Snapshots store plain values: see snapshot.py for the file format.
+
+def chunkRecord(a):
+    return (a.name, a.code, a.defs, a.deps)
+
+def instrRecord(i):
+    return {
+        'name':        i.name,
+        'encodings':   [ (inm, insn_set, fields, chunkRecord(dec))
+                         for (inm, insn_set, fields, dec) in i.encs ],
+        'postdecode':  chunkRecord(i.post) if i.post else None,
+        'conditional': i.conditional,
+        'execute':     chunkRecord(i.exec),
+    }
+
+'''
+Write a snapshot containing the notice and top level declarations,
+the shared chunks, the selected instructions and the decoders
+(keyed by instruction set).
+'''
+def writeSpecSnapshot(filename, notice, tops, shared, instrs, decoders):
+    writeSnapshot(filename, {
+        'spec':         [ ('notice', notice), ('tops', tops) ],
+        'chunks':       [ (x, chunkRecord(a)) for (x, a) in shared.items() ],
+        'instructions': [ (i.name, instrRecord(i)) for i in instrs ],
+        'decoders':     [ (groups[0], (groups, classes)) for (groups, classes) in decoders ],
+    })
+
+########################################################################
+# Spec store
+########################################################################
+
+# Stores hold the same records as snapshots: see specstore.py.
+
+def writeStoreChunks(store, paras, shared, decoders):
+    store.setMeta('notice', paras)
+    definers = {}
+    for a in shared.values():
+        store.addChunk(a.name, a.code, a.defs, a.deps)
+        for d in a.defs: definers[d] = a.name
+    store.addDefiners(definers.items())
+    for (groups, classes) in decoders:
+        store.addDecoder(groups[0], (groups, classes))
+
+def storeInstruction(store, i, top):
+    store.addInstruction(i.name, dict(instrRecord(i), top=top), i.dependencies())
+
+def chunkFromRecord(r):
+    (name, code, defs, deps) = r
+    return ASL(name, code, set(defs), set(deps))
+
+def instrFromRecord(r):
+    encs = [ (inm, insn_set, [ tuple(f) for f in fields ], chunkFromRecord(dec))
+             for (inm, insn_set, fields, dec) in r['encodings'] ]
+    post = chunkFromRecord(r['postdecode']) if r['postdecode'] else None
+    return Instruction(r['name'], encs, post, r['conditional'], chunkFromRecord(r['execute']))
+
+# Records are stored as json so tuples have to be restored
+def groupFromRecord(g):
+    (label, (size, columns), children) = g
+    return (label, (size, [ tuple(c) for c in columns ]),
+            [ (dec, isGroup, groupFromRecord(c) if isGroup else tuple(c)) for (dec, isGroup, c) in children ])
+
+def decoderFromRecord(r):
+    (groups, classes) = r
+    classes = { k: ([ tuple(f) for f in fields ], (iclass, headers, [ tuple(row) for row in rows ]))
+                for (k, (fields, (iclass, headers, rows))) in classes.items() }
+    return (groupFromRecord(groups), classes)
+
+'''
+Mapping from names to the chunks that define them (read from a store)
+'''
+class StoreChunks:
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, name):
+        return self.store.definer(name) is not None
+
+    def __getitem__(self, name):
+        x = self.store.definer(name)
+        if x is None: raise KeyError(name)
+        return chunkFromRecord(self.store.chunk(x))
+
+'''
+Generate the instruction, decoder and definition files from a store
+instead of from the XML files.
+Instructions and chunks are read from the store as they are needed
+and the dependency graph is only read from the store while following
+dependencies so only the names of the live chunks are held in memory.
+'''
+def generateFromStore(args):
+    unsupported = [
+        ('--store',          args.store),
+        ('--specialise',     args.specialise),
+        ('--slices',         args.slices),
+        ('--slice-manifest', args.slice_manifest),
+        ('--suggest-cuts',   args.suggest_cuts),
+        ('--cost-report',    args.cost_report),
+        ('--purity',         args.purity),
+        ('--bundle',         args.bundle),
+        ('--shards',         args.shards),
+        ('--snapshot',       args.snapshot),
+    ]
+    for (option, value) in unsupported:
+        if value:
+            print("Error:", option, "cannot be used with --from-store")
+            sys.exit(1)
+    try:
+        store = Store(args.from_store)
+    except ValueError as err:
+        print("Error:", err)
+        sys.exit(1)
+
+    encodings = selectedEncodings(args)
+    notice = readNotice(store.meta('notice', []))
+    tops = store.meta('tops', [])
+    profile = readProfile(args.profile)
+    defined = StoreChunks(store)
+    (roots, cuts, canaries, patterns) = readFilters(args.filter, defined)
+
+    # Replace all cutpoints with a stub (see generate)
+    override = {} # dependencies of the stubs
+    cut_code = {}
+    for x in sorted({ store.definer(c) for c in cuts } - {None}):
+        if args.verbose > 0: print("Cutting", x)
+        t = chunkFromRecord(store.chunk(x)).toPrototype()
+        t.patchDependencies(defined)
+        override[x] = t.deps
+        cut_code[x] = t.code
+
+    instr_deps = set()
+    instr_encs = set() # names of the selected encodings
+    with instructionOutputs(args, notice) as pipeline:
+        for r in store.instructions():
+            instr = instrFromRecord(r)
+            if not includeInstruction(instr.name): continue
+            if not selectInstruction(instr, encodings, patterns, args.verbose): continue
+            instr_deps |= instr.dependencies()
+            instr_encs |= { deslash(inm) for (inm,_,_,_) in instr.encs }
+            pipeline.put(instr)
+
+    if encodings == [] and args.filter == []:
+        if args.verbose > 0: print("Keeping entire specification")
+        roots |= set(store.chunkNames())
+    else:
+        if args.verbose > 0: print("Discarding definitions unreachable from",
+                               ", ".join(encodings), " instructions")
+        roots |= instr_deps
+    (live, _) = reachable(StoreGraph(store, override), roots)
+
+    if canaries != set():
+        if args.verbose > 0: print("Checking unreachability of", ", ".join(canaries))
+        rcg = StoreGraph(store, override, reverse=True)
+        for canary in canaries:
+            if canary in live:
+                checkCanaries(rcg, store.hasChunk, roots, canary, [])
+
+    writeDecoders(args, ( decoderFromRecord(r) for r in store.decoders() ), profile,
+                  instr_encs if subsetSelected(args) else None)
+
+    # the code of each live chunk is read from the store as it is written
+    hashes = {} # hash of each chunk written (for the manifest)
+    def liveCode():
+        for x in live:
+            code = cut_code[x] if x in cut_code else store.code(x)
+            if code is None: continue # not a chunk
+            if args.manifest is not None: hashes[x] = contentHash(code)
+            yield code
+    writeDefinitions(args, notice, tops, liveCode())
+    store.close()
+
+    if args.manifest is not None:
+        writeOutputManifest(args, hashes)
+
+########################################################################
+# Main
+########################################################################
+
+'''
+Command line options (also used by extract.py)
+'''
+def argumentParser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbose', '-v', help='Use verbose output',
+                        action = 'count', default=0)
+    parser.add_argument('--altslicesyntax', help='Convert to alternative slice syntax',
+                        action='store_true', default=False)
+    parser.add_argument('--sail_asts', help='Output Sail file for AST clauses',
+                        metavar='FILE', default=None)
+    parser.add_argument('--demangle', help='Demangle instruction ASL',
+                        action='store_true', default=False)
+    parser.add_argument('--dedupe', help='Write identical decode/postdecode/execute ASL to tag file only once',
+                        action='store_true', default=False)
+    parser.add_argument('--counters', help='Count how often each encoding is decoded (writes <output>_counters.asl)',
+                        action='store_true', default=False)
+    parser.add_argument('--output', '-o', help='Basename for output files',
+                        metavar='FILE', default='arch')
+    parser.add_argument('--notice', help='XML file containing proprietary notice (default: notice.xml in first input directory)',
+                        metavar='FILE', default=None)
+    parser.add_argument('dir', metavar='<dir>',  nargs='*',
+                        help='input directories (not used with --from-store)')
+    parser.add_argument('--filter',  help='Optional input json file to filter definitions',
+                        metavar='FILE', default=[], nargs='*')
+    parser.add_argument('--specialise', help='Optional input json files of fixed values of feature and state predicates',
+                        metavar='FILE', default=[], nargs='*')
+    parser.add_argument('--arch', help='Optional list of architecture states to extract',
+                        choices=["AArch32", "AArch64"], default=[], action='append')
+    parser.add_argument('--include', help='Regex to select instructions by name',
+                        metavar='REGEX', default=None)
+    parser.add_argument('--exclude', help='Regex to exclude instructions by name',
+                        metavar='REGEX', default=None)
+    parser.add_argument('--patch', help='Json files of patches to apply to extracted ASL',
+                        metavar='FILE', nargs='*',
+                        default=[os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'patches.json'))])
+    parser.add_argument('--slices', help='Directory to store minimal ASL slice of each instruction',
+                        metavar='DIR', default=None)
+    parser.add_argument('--slice-manifest', help='File to store list of chunks required by each instruction',
+                        metavar='FILE', default=None)
+    parser.add_argument('--profile', help='Json files of instruction frequencies used to order decode tree',
+                        metavar='FILE', nargs='*', default=[])
+    parser.add_argument('--minimise-decode', help='Simplify decode tree (checking that it decodes the same way)',
+                        action='store_true', default=False)
+    parser.add_argument('--suggest-cuts', help='Suggest N functions to cut that would remove the most code',
+                        metavar='N', type=int, default=None)
+    parser.add_argument('--cost-report', help='File to store size of closure of each instruction and fan-in of each function (csv or json)',
+                        metavar='FILE', default=None)
+    parser.add_argument('--purity', help='File to store purity of each function (json) and annotate definitions with it',
+                        metavar='FILE', default=None)
+    parser.add_argument('--bundle', help='File to store pruned bundle of all ASL needed by a simulator',
+                        metavar='FILE', default=None)
+    parser.add_argument('--bundle-head', help='ASL files to include in the bundle before the shared pseudocode',
+                        metavar='FILE', nargs='*', default=[])
+    parser.add_argument('--bundle-tail', help='ASL files to include in the bundle after the instructions',
+                        metavar='FILE', nargs='*', default=[])
+    parser.add_argument('--shards', help='Directory to store ASL definitions split into separately loadable shards',
+                        metavar='DIR', default=None)
+    parser.add_argument('--shard-by', help='How to split ASL definitions into shards',
+                        choices=['dir', 'scc'], default='dir')
+    parser.add_argument('--snapshot', help='File to store binary snapshot of chunks, instructions and decoders',
+                        metavar='FILE', default=None)
+    parser.add_argument('--manifest', help='Json file to store hashes of outputs, chunks and tags (and which changed)',
+                        metavar='FILE', default=None)
+    parser.add_argument('--store', help='SQLite file to store chunks, dependencies, instructions and decoders',
+                        metavar='FILE', default=None)
+    parser.add_argument('--from-store', help='Read chunks, instructions and decoders from SQLite file instead of XML',
+                        metavar='FILE', default=None)
+    parser.add_argument('--output-thread', help='Write instructions to output files in a separate thread',
+                        action='store_true', default=False)
+    parser.add_argument('--xml-backend', help='XML parser to use (auto uses lxml if it is installed)',
+                        choices=xml_backends, default='auto')
+    parser.add_argument('--watch', help='Watch input files and regenerate output when they change',
+                        action='store_true', default=False)
+    return parser
+
+'''
+Configure the default extractor (used when no Extractor is active)
+'''
+def setOptions(args):
+    global default_extractor
+    setXMLBackend(args.xml_backend)
+    default_extractor = Extractor(args)
+
+def main():
+    parser = argumentParser()
+    args = parser.parse_args()
+    if (args.dir == []) == (args.from_store is None):
+        parser.error("either input directories or --from-store (but not both) are required")
+    if args.from_store is not None and args.watch:
+        parser.error("--watch cannot be used with --from-store")
+    setOptions(args)
+
+    cache = Cache(keep=args.watch)
+    generate(args, cache)
+
+    if args.watch:
+        watcher = Watcher(args.dir + args.filter + args.specialise + args.patch + args.profile
+                          + args.bundle_head + args.bundle_tail)
+        print("Watching for changes (press Ctrl-C to stop)")
+        try:
+            while True:
+                changed = watcher.wait()
+                if args.verbose > 0: print("Changed:", " ".join(changed))
+                try:
+                    generate(args, cache)
+                except (Exception, SystemExit) as err:
+                    print("Error:", err)
+        except KeyboardInterrupt:
+            pass
+
+    return
 
+'''
+Instruction sets selected by --arch (empty if all are selected)
+'''
+def selectedEncodings(args, verbose=True):
+    encodings = []
+    if "AArch32" in args.arch: encodings.extend(["T16", "T32", "A32"])
+    if "AArch64" in args.arch: encodings.extend(["A64"])
+    if verbose and args.verbose > 0:
+        if encodings != []:
+            print("Selecting encodings", ", ".join(encodings))
+        else:
+            print("Selecting entire architecture")
+    return encodings
+
+'''
+Read filter files.
+Returns (roots, cuts, canaries, patterns) where patterns is a list of
+instruction regexps from each filter.
+Warnings are reported for any names that are not in 'known'.
+'''
+def readFilters(files, known):
     roots    = set()
     cuts     = set()
     canaries = set()
-    for fn in args.filter:
+    patterns = []
+    for fn in files:
         with open(fn, "r") as f:
             try:
                 filter = json.load(f)
@@ -898,23 +2889,263 @@ def main():
                 print(err)
                 sys.exit(1)
             for fun in filter['roots']:
-                if fun not in chunks: print("Warning: unknown root", fun)
+                if fun not in known: print("Warning: unknown root", fun)
                 roots.add(fun)
             for fun in filter['cuts']:
-                if fun not in chunks: print("Warning: unknown cut", fun)
+                if fun not in known: print("Warning: unknown cut", fun)
                 cuts.add(fun)
             for fun in filter['canaries']:
-                if fun not in chunks: print("Warning: unknown canary", fun)
+                if fun not in known: print("Warning: unknown canary", fun)
                 canaries.add(fun)
 
             # treat instrs as a list of rexexps
-            patterns = [ re.compile(p) for p in filter['instructions'] ]
-            instrs = [ i for i in instrs
-                         if any(regex.match(i.name) for regex in patterns)
-                     ]
-            # print("\n".join(sorted([ i.name for i in instrs ])))
-    # print("\n".join(sorted(chunks.keys())))
+            patterns.append([ re.compile(p) for p in filter['instructions'] ])
+    return (roots, cuts, canaries, patterns)
+
+'''
+Test whether an instruction is selected by the filters after
+discarding encodings from unwanted InsnSets.
+'''
+def selectInstruction(instr, encodings, patterns, verbose):
+    if encodings != []:
+        encs = [ e for e in instr.encs if e[1] in encodings ]
+        if encs == []:
+            if verbose > 1: print("Discarding", instr.name, encodings)
+            return False
+        instr.encs = encs
+    return all(any(regex.match(instr.name) for regex in ps) for ps in patterns)
+
+'''
+Open the tag, instruction and Sail files and return a pipeline that
+writes each instruction to them (and passes it to any 'extra' consumers)
+as soon as it is put into the pipeline.
+'''
+@contextlib.contextmanager
+def instructionOutputs(args, notice, extra=[]):
+    tagfile   = args.output + ".tag"
+    instrfile = args.output + "_instrs.asl"
+    with contextlib.ExitStack() as stack:
+        def open_output(filename):
+            f = BufferedWriter(stack.enter_context(outputFile(filename)))
+            stack.callback(f.flush)
+            return f
+
+        consumers = []
+        if args.verbose > 0: print("Writing instruction encodings to", tagfile)
+        tagf = open_output(tagfile)
+        emit(tagf, 'notice:asl', notice)
+        consumers.append(lambda i: i.emit_tag_syntax(tagf))
+
+        if args.verbose > 0: print("Writing instructions to", instrfile)
+        instrf = open_output(instrfile)
+        print(notice, file=instrf)
+        print(file=instrf)
+        def emit_instr(i):
+            i.emit_asl_syntax(instrf)
+            print(file=instrf)
+        consumers.append(emit_instr)
+
+        if args.sail_asts is not None:
+            if args.verbose > 0: print("Writing Sail ast clauses to", args.sail_asts)
+            sailf = open_output(args.sail_asts)
+            print(notice, file=sailf, end='\n\n')
+            print('scattered union ast', file=sailf, end='\n\n')
+            previous_clauses = set()
+            sail_decodes = {} # instruction set -> encodings to decode
+            consumers.append(lambda i: i.emit_sail_ast(previous_clauses, sailf, sail_decodes))
+
+        counted = [] # encodings that have counters
+        if args.counters:
+            consumers.append(lambda i: counted.extend([ inm for (inm,_,_,_) in i.encs ]))
+
+        # consumers may run in the pipeline's thread so they are
+        # run in the current extraction
+        x = current()
+        def consume(i):
+            with x.active():
+                for c in consumers + extra: c(i)
+        pipeline = Pipeline([consume], threaded=args.output_thread)
+        try:
+            yield pipeline
+        finally:
+            # the consumers must finish before the files are flushed and closed
+            pipeline.close()
+
+        if args.counters:
+            counterfile = args.output + "_counters.asl"
+            if args.verbose > 0: print("Writing", len(counted), "encoding counters to", counterfile)
+            with outputFile(counterfile) as f:
+                print(notice, file=f)
+                print(file=f)
+                print(countersASL(counted), file=f)
+                print('/'*72, file=f)
+                print('// End', file=f)
+                print('/'*72, file=f)
+
+        print('/'*72, file=instrf)
+        print('// End', file=instrf)
+        print('/'*72, file=instrf)
+        if args.sail_asts is not None:
+            print('\nend ast', file=sailf)
+            printSailDecoders(sailf, sail_decodes)
+
+'''
+Test whether only a subset of the instructions is selected.
+If so, decoders are pruned to the selected encodings.
+'''
+def subsetSelected(args):
+    return (args.arch != [] or args.filter != []
+            or args.include is not None or args.exclude is not None)
+
+'''
+Write the decoders.
+If 'selected' is not None, the decoders are pruned to the encodings
+in 'selected' and decoders for instruction sets that are excluded
+by --arch are omitted.
+'''
+def writeDecoders(args, decoders, profile, selected=None):
+    decodefile = args.output + "_decode.asl"
+    if args.verbose > 0: print("Writing instruction decoder to", decodefile)
+    encodings = selectedEncodings(args, False)
+    with outputFile(decodefile) as ofile:
+        for (groups, classes) in decoders:
+            if selected is not None:
+                if encodings != [] and groups[0] not in encodings:
+                    if args.verbose > 0: print("Omitting", groups[0], "decoder")
+                    continue
+                pruned = pruneDecoder(groups, classes, selected)
+                if pruned is None:
+                    if args.verbose > 0: print("No encodings selected in", groups[0], "decoder")
+                    (groups, classes) = unallocatedDecoder(groups)
+                else:
+                    (groups, classes, n) = pruned
+                    if args.verbose > 0: print("Pruned", groups[0], "decoder to", n, "encodings")
+            if args.minimise_decode:
+                printMinimisedDecodeTree(ofile, groups, classes, profile, args.verbose)
+            else:
+                printDecodeTree(ofile, groups, classes, profile)
+
+'''
+Write the top level declarations and the code of the live chunks
+('code' may be a generator so that each chunk is written as it is read)
+'''
+def writeDefinitions(args, notice, tops, code):
+    aslfile = args.output + ".asl"
+    if args.verbose > 0: print("Writing ASL definitions to", aslfile)
+    with outputFile(aslfile) as outf:
+        print(notice, file=outf)
+        print(file=outf)
+        print('\n'.join([ t for t in tops ]), file=outf)
+        empty = True
+        for c in code:
+            print(c, file=outf)
+            empty = False
+        if empty: print(file=outf) # blank line before the end marker
+        print('/'*72, file=outf)
+        print('// End', file=outf)
+        print('/'*72, file=outf)
+
+'''
+Write the manifest of hashes of the output files and of the chunks
+in arch.asl ('chunks' maps the name of each chunk to the hash of its
+code) and the tags in arch.tag
+'''
+def writeOutputManifest(args, chunks):
+    tags = {}
+    with open(args.output + ".tag", "r") as f:
+        tag = None
+        for line in f:
+            if line.startswith("TAG:"):
+                tag = line[4:].rstrip("\n")
+                tags[tag] = []
+            else:
+                tags[tag].append(line)
+    sections = {
+        'chunks': chunks,
+        'tags':   { t: contentHash(''.join(ls)) for (t, ls) in tags.items() },
+    }
+    changed = writeManifest(args.manifest, sections, current().output_files)
+    if args.verbose > 0:
+        print("Changed", ", ".join(str(len(ns)) + " " + section for (section, ns) in sorted(changed.items())),
+              "(see", args.manifest + ")")
 
+'''
+Read the paragraphs of the proprietary notice
+'''
+def readNoticeFile(args, cache):
+    noticefile = args.notice or os.path.join(args.dir[0], 'notice.xml')
+    return cache.get(('notice', noticefile), [noticefile],
+                     lambda: noticeParagraphs(noticefile, current().xml_backend))
+
+'''
+The options that change the result of reading an instruction or
+the shared pseudocode (so they are part of the cache keys when a
+cache is shared by extractors with different options)
+'''
+def parseOptions(args):
+    x = current()
+    def pattern(r): return r.pattern if r is not None else None
+    return (x.alt_slice_syntax, x.demangle_instr, pattern(x.include_regex),
+            pattern(x.exclude_regex), args.sail_asts is not None)
+
+'''
+Read the shared pseudocode.
+Returns (files read, mapping from chunk names to chunks,
+mapping from the names that chunks define to the chunks)
+'''
+def readSharedFiles(args, cache):
+    shared_files = [ f for d in args.dir for f in glob.glob(os.path.join(d, 'shared_pseudocode.xml')) ]
+    def readChunks():
+        (shared,names) = readShared(shared_files)
+
+        # reverse mapping of names back to the chunks containing them
+        chunks = {}
+        for a in shared.values():
+            for d in a.defs:
+                chunks[d] = a
+
+        for a in shared.values():
+            a.patchDependencies(chunks)
+        return (shared, chunks)
+    (shared, chunks) = cache.get(('shared', current().alt_slice_syntax),
+                                 shared_files + args.patch, readChunks)
+    return (shared_files, shared, chunks)
+
+'''
+Specialise the shared pseudocode (in place)
+'''
+def specialiseShared(args, calls, shared):
+    for (x, a) in list(shared.items()):
+        shared[x] = specialiseASL(calls, shared, a, True)
+        if args.verbose > 1 and shared[x] is not a: print("Specialised", x)
+
+def readDecoders(args, cache):
+    # decoders refer to the instruction files to find encoding names
+    decoder_files = [ 'encodingindex.xml', 't32_encindex.xml', 'a32_encindex.xml' ]
+    return [ cache.get(('decoder', f), [f] + glob.glob(os.path.join(d, '*.xml')), lambda: readDecodeFile(d, f))
+             for df in decoder_files for d in args.dir for f in glob.glob(os.path.join(d, df)) ]
+
+'''
+Read the instruction files.
+Generates (instruction, top level declarations) for each file
+(the instruction is None for aliases and excluded instructions).
+'''
+def readInstructionFiles(args, cache, shared_files, chunks):
+    sailhack = args.sail_asts is not None
+    options = parseOptions(args)
+    for d in args.dir:
+        for inf in glob.glob(os.path.join(d, '*.xml')):
+            name = re.search('.*/(\S+).xml',inf).group(1)
+            if name == "onebigfile": continue
+            yield cache.get(('instruction', inf, options), [inf] + shared_files + args.patch,
+                            lambda: readInstruction(parseXML(inf, current().xml_backend),chunks,sailhack))
+
+'''
+Replace all cutpoints with a stub (in place), build the dependency
+graph and find the live chunks.
+Returns (dependency graph, roots, live chunk names in dependency order)
+'''
+def liveChunks(args, shared, chunks, roots, cuts, encodings, instr_deps):
     # Replace all cutpoints with a stub so that we keep dependencies
     # on the argument/result types but drop the definition and any
     # dependencies on the definition.
@@ -940,15 +3171,122 @@ def main():
     if encodings == [] and args.filter == []:
         # default: you get everything
         if args.verbose > 0: print("Keeping entire specification")
-        roots |= { x for x in shared }
+        roots = roots | { x for x in shared }
     else:
         if args.verbose > 0: print("Discarding definitions unreachable from",
                                ", ".join(encodings), " instructions")
-        for i in instrs:
-            for (_,_,_,dec) in i.encs: roots |= dec.deps
-            if i.post: roots |= i.post.deps
-            roots |= i.exec.deps
+        roots = roots | instr_deps
     (live, _) = reachable(deps, roots)
+    return (deps, roots, live)
+
+'''
+Code of the live chunks to write to the definitions file
+(annotated with the purity of each function if --purity is used)
+'''
+def definitionCode(args, deps, shared, live_chunks):
+    if args.purity is None:
+        return [ x.code for x in live_chunks ]
+    if args.verbose > 0: print("Writing purity report to", args.purity)
+    purity = purityAnalysis(deps, shared)
+    with outputFile(args.purity) as outf:
+        writePurityReport(outf, purity, live_chunks)
+    return [ "// Purity: " + purity[x.name]['class'] + "\n" + x.code
+             if any(isFunction(d) for d in x.defs) else x.code
+             for x in live_chunks ]
+
+'''
+Read the input files, decide what to keep and write the output files.
+Results of reading each input file are kept in 'cache' and are only
+recomputed if the files they depend on change.
+The paragraphs of the notice are read unless they are passed in 'paras'.
+'''
+def generate(args, cache, paras=None):
+    resetTags()
+    current().output_files.clear()
+    if args.from_store is not None:
+        generateFromStore(args)
+        return
+    current().patches = cache.get('patches', args.patch, lambda: readPatches(args.patch))
+
+    encodings = selectedEncodings(args)
+
+    if paras is None: paras = readNoticeFile(args, cache)
+    notice = readNotice(paras)
+
+    (shared_files, shared, chunks) = readSharedFiles(args, cache)
+    shared = dict(shared) # copy because specialisation and cuts are applied below
+
+    calls = cache.get('specialise', args.specialise, lambda: readSpecialisation(args.specialise))
+    if calls: specialiseShared(args, calls, shared)
+
+    decoders = readDecoders(args, cache)
+
+    profile = cache.get('profile', args.profile, lambda: readProfile(args.profile))
+
+    # Read filters before the instructions so that instructions can
+    # be selected as they are read
+    (roots, cuts, canaries, patterns) = readFilters(args.filter, chunks)
+
+    store = None
+    if args.store is not None:
+        if args.verbose > 0: print("Writing store to", args.store)
+        store = StoreWriter(args.store, instruction_tables)
+        writeStoreChunks(store, paras, shared, decoders)
+
+    # Instructions are written to the tag, instruction and Sail files
+    # as soon as they are read.
+    # They are only kept in memory if a later output needs all of them.
+    keep_instrs = (args.slices is not None or args.slice_manifest is not None
+                   or args.bundle is not None or args.snapshot is not None
+                   or args.cost_report is not None)
+    instrs = []
+    instr_deps = set() # dependencies of all selected instructions
+    instr_encs = set() # names of the selected encodings
+    tops   = []
+    instr_tops = {} # top level declarations required by each instruction
+    extra = [ lambda i: storeInstruction(store, i, instr_tops.get(i.name)) ] if store else []
+    with instructionOutputs(args, notice, extra) as pipeline:
+        for (instr, top) in readInstructionFiles(args, cache, shared_files, chunks):
+            if top: tops.append(top)
+            if instr is None: continue
+            if top: instr_tops[instr.name] = top
+
+            instr = copy.copy(instr) # selectInstruction changes the (cached) encodings
+            if not selectInstruction(instr, encodings, patterns, args.verbose):
+                continue
+
+            if calls: instr = specialiseInstruction(calls, shared, instr)
+
+            instr_deps |= instr.dependencies()
+            instr_encs |= { deslash(inm) for (inm,_,_,_) in instr.encs }
+            if keep_instrs: instrs.append(instr)
+            pipeline.put(instr)
+
+    if store:
+        store.setMeta('tops', tops)
+        store.close()
+
+    reportPatches()
+    tag_aliases = current().tag_aliases
+    if args.verbose > 0 and tag_aliases:
+        print("Shared", len(tag_aliases), "duplicate ASL tags in", args.output + ".tag")
+
+    # Having read everything in, decide which parts to write
+    # back out again and in what order
+
+    if args.verbose > 3:
+        for f in shared.values():
+            print("Dependencies", f.name, "=", str(f.deps))
+            print("Definitions", f.name, "=", str(f.defs))
+
+    # print("\n".join(sorted(chunks.keys())))
+
+    (deps, roots, live) = liveChunks(args, shared, chunks, roots, cuts, encodings, instr_deps)
+
+    if args.suggest_cuts is not None:
+        print("Suggested cuts (chunks removed, lines removed):")
+        for (f, nchunks, nlines) in suggestCuts(shared, chunks, roots, args.suggest_cuts):
+            print("  %-40s %6d %8d" % (f, nchunks, nlines))
 
     # Check whether canaries can be reached from roots
     if canaries != set():
@@ -967,53 +3305,257 @@ def main():
 
     live_chunks = [ shared[x] for x in live if x in shared ]
 
-    tagfile    = args.output + ".tag"
-    instrfile  = args.output + "_instrs.asl"
-    decodefile = args.output + "_decode.asl"
-    aslfile    = args.output + ".asl"
+    writeDecoders(args, decoders, profile, instr_encs if subsetSelected(args) else None)
+    writeDefinitions(args, notice, tops, definitionCode(args, deps, shared, live_chunks))
+
+    if args.shards is not None:
+        # dependencies between live chunks
+        live_names = [ x.name for x in live_chunks ]
+        chunk_deps = defaultdict(set)
+        for x in live_names:
+            for d in deps[x]:
+                chunk_deps[x] |= {d} if d in shared else deps.get(d, set())
+        if args.shard_by == 'dir':
+            key = os.path.dirname
+        else:
+            key = lambda x: x
+        parts = partition(chunk_deps, live_names, key)
+
+        if args.verbose > 0: print("Writing", len(parts), "shards of ASL definitions to", args.shards)
+        os.makedirs(args.shards, exist_ok=True)
+        manifest = { 'order': [], 'shards': {}, 'symbols': {} }
+        if tops:
+            parts = [('top', [], [])] + parts
+        for (name, xs, requires) in parts:
+            file = deslash(name) + ".asl"
+            with outputFile(os.path.join(args.shards, file)) as outf:
+                print(notice, file=outf)
+                print(file=outf)
+                if name == 'top': print('\n'.join([ t for t in tops ]), file=outf)
+                print('\n'.join([ shared[x].code for x in xs ]), file=outf)
+                print('/'*72, file=outf)
+                print('// End', file=outf)
+                print('/'*72, file=outf)
+            manifest['order'].append(name)
+            manifest['shards'][name] = { 'file': file, 'requires': requires, 'chunks': xs }
+            for x in xs:
+                for d in shared[x].defs:
+                    manifest['symbols'][d] = name
+        with outputFile(os.path.join(args.shards, "manifest.json")) as outf:
+            json.dump(manifest, outf, indent=4, sort_keys=True)
+            print(file=outf)
 
-    if args.verbose > 0: print("Writing instruction encodings to", tagfile)
-    with open(tagfile, "w") as outf:
-        emit(outf, 'notice:asl', notice)
+    if args.bundle is not None:
+        head = [ a for f in args.bundle_head for a in cache.get(('asl', f), [f], lambda: readASLFile(f)) ]
+        tail = [ a for f in args.bundle_tail for a in cache.get(('asl', f), [f], lambda: readASLFile(f)) ]
+        if calls:
+            head = [ specialiseASL(calls, shared, a, True) for a in head ]
+            tail = [ specialiseASL(calls, shared, a, True) for a in tail ]
+        keepAll = encodings == [] and args.filter == []
+        if args.verbose > 0: print("Writing ASL bundle to", args.bundle)
+        with outputFile(args.bundle) as outf:
+            writeBundle(outf, notice, tops, deps, shared, roots, instrs, head, tail, keepAll)
+
+    if args.cost_report is not None:
+        if args.verbose > 0: print("Writing cost report to", args.cost_report)
+        with outputFile(args.cost_report) as outf:
+            writeCostReport(outf, args.cost_report, costReport(deps, shared, instrs))
+
+    if args.snapshot is not None:
+        if args.verbose > 0: print("Writing snapshot to", args.snapshot)
+        writeSpecSnapshot(args.snapshot, notice, tops, shared, instrs, decoders)
+        current().output_files.append(args.snapshot)
+
+    if args.slices is not None or args.slice_manifest is not None:
+        # compute the closures of all instructions in a single pass
+        # over the dependency graph
+        instr_roots = { i.name: i.dependencies() for i in instrs }
+        (order, closure) = closures(deps, set().union(*instr_roots.values()))
+        slices = {}
         for i in instrs:
-            i.emit_tag_syntax(outf)
+            bits = 0
+            for r in instr_roots[i.name]: bits |= closure[r]
+            slices[i.name] = [ x for x in members(order, bits) if x in shared ]
+
+        if args.slice_manifest is not None:
+            if args.verbose > 0: print("Writing instruction slice manifest to", args.slice_manifest)
+            with outputFile(args.slice_manifest) as outf:
+                json.dump(slices, outf, indent=4, sort_keys=True)
+                print(file=outf)
+
+        if args.slices is not None:
+            if args.verbose > 0: print("Writing instruction slices to", args.slices)
+            os.makedirs(args.slices, exist_ok=True)
+            for i in instrs:
+                with outputFile(os.path.join(args.slices, deslash(i.name)+".asl")) as outf:
+                    print(notice, file=outf)
+                    print(file=outf)
+                    if i.name in instr_tops: print(instr_tops[i.name], file=outf)
+                    print('\n'.join([ shared[x].code for x in slices[i.name] ]), file=outf)
+                    print('/'*72, file=outf)
+                    print('// End', file=outf)
+                    print('/'*72, file=outf)
+
+    if args.manifest is not None:
+        writeOutputManifest(args, { x.name: contentHash(x.code) for x in live_chunks })
 
-    if args.verbose > 0: print("Writing instructions to", instrfile)
-    with open(instrfile, "w") as outf:
-        print(notice, file=outf)
-        print(file=outf)
-        for i in instrs:
-            i.emit_asl_syntax(outf)
-            print(file=outf)
-        print('/'*72, file=outf)
-        print('// End', file=outf)
-        print('/'*72, file=outf)
+    return
 
-    if args.verbose > 0: print("Writing instruction decoder to", decodefile)
-    with open(decodefile, "w") as ofile:
-        for (groups, classes) in decoders: printDecodeTree(ofile, groups, classes)
+########################################################################
+# Library interface
+########################################################################
 
-    if args.verbose > 0: print("Writing ASL definitions to", aslfile)
-    with open(aslfile, "w") as outf:
-        print(notice, file=outf)
-        print(file=outf)
-        print('\n'.join([ t for t in tops ]), file=outf)
-        print('\n'.join([ x.code for x in live_chunks ]), file=outf)
-        print('/'*72, file=outf)
-        print('// End', file=outf)
-        print('/'*72, file=outf)
+'''
+An extraction: its options and all the state that it changes.
 
-    if args.sail_asts is not None:
-        if args.verbose > 0: print("Writing Sail ast clauses to", args.sail_asts)
-        with open(args.sail_asts, "w") as outf:
-            print(notice, file=outf, end='\n\n')
-            print('scattered union ast', file=outf, end='\n\n')
-            previous_clauses = set()
-            for i in instrs:
-                i.emit_sail_ast(previous_clauses, outf)
-            print('\nend ast', file=outf)
+Each Extractor has its own options, cache, patches, tags, etc. so
+several extractors (with different options) can be used in one
+process (and in different threads) without interfering with each
+other.
 
-    return
+    x    = Extractor(['--arch=AArch64', 'v8.6/ISA_A64_xml'])
+    spec = x.parse()          # read the XML files
+    sel  = x.filter(spec)     # select instructions and live chunks
+    out  = x.emit(sel)        # { output filename: text }
+
+'args' is either a list of command line arguments or the result
+of parsing them (see argumentParser).
+x.generate() does the same as running instrs2asl.py with 'args'.
+'''
+class Extractor:
+    def __init__(self, args=[], cache=None):
+        if isinstance(args, list): args = argumentParser().parse_args(args)
+        self.args  = args
+        self.cache = cache if cache is not None else Cache()
+
+        self.include_regex    = re.compile(args.include) if args.include is not None else None
+        self.exclude_regex    = re.compile(args.exclude) if args.exclude is not None else None
+        self.alt_slice_syntax = args.altslicesyntax
+        self.demangle_instr   = args.demangle
+        self.dedupe_asl       = args.dedupe
+        self.count_encodings  = args.counters
+        self.xml_backend      = checkXMLBackend(args.xml_backend)
+
+        self.tags         = set()
+        self.tag_content  = {} # (kind, content) -> first tag with that content
+        self.tag_aliases  = {} # tag -> first tag with the same content
+        self.output_files = [] # files written by the current run (see --manifest)
+        self.captured     = None # filename -> contents if output is written to memory
+        self.patches      = defaultdict(list)
+
+    @contextlib.contextmanager
+    def active(self):
+        '''Make this the current extractor of this thread (see current)'''
+        if not hasattr(active_extractors, 'stack'): active_extractors.stack = []
+        active_extractors.stack.append(self)
+        try:
+            yield self
+        finally:
+            active_extractors.stack.pop()
+
+    def generate(self):
+        '''Read the input files and write the output files (as instrs2asl.py does)'''
+        with self.active():
+            generate(self.args, self.cache)
+
+    def parse(self):
+        '''Read the notice, shared pseudocode, decoders and the
+           instructions selected by --include and --exclude.'''
+        args = self.args
+        with self.active():
+            self.patches = self.cache.get('patches', args.patch, lambda: readPatches(args.patch))
+            notice = readNotice(readNoticeFile(args, self.cache))
+            (shared_files, shared, chunks) = readSharedFiles(args, self.cache)
+            decoders = readDecoders(args, self.cache)
+            instrs = []
+            tops   = []
+            for (instr, top) in readInstructionFiles(args, self.cache, shared_files, chunks):
+                if top: tops.append(top)
+                if instr is not None: instrs.append((instr, top))
+            reportPatches()
+        return Specification(notice, tops, shared, chunks, decoders, instrs)
+
+    def filter(self, spec):
+        '''Select the instructions (using --arch and the filters),
+           specialise them (using --specialise) and find the shared
+           chunks they need. 'spec' is not changed.'''
+        args = self.args
+        with self.active():
+            encodings = selectedEncodings(args)
+            (roots, cuts, canaries, patterns) = readFilters(args.filter, spec.chunks)
+            shared = dict(spec.shared)
+            calls = self.cache.get('specialise', args.specialise, lambda: readSpecialisation(args.specialise))
+            if calls: specialiseShared(args, calls, shared)
+
+            instrs     = []
+            instr_tops = {}
+            instr_deps = set()
+            for (instr, top) in spec.instrs:
+                instr = copy.copy(instr) # selectInstruction changes the encodings
+                if not selectInstruction(instr, encodings, patterns, args.verbose): continue
+                if calls: instr = specialiseInstruction(calls, shared, instr)
+                if top: instr_tops[instr.name] = top
+                instr_deps |= instr.dependencies()
+                instrs.append(instr)
+
+            (deps, roots, live) = liveChunks(args, shared, spec.chunks, roots, cuts, encodings, instr_deps)
+        return Selection(spec, instrs, instr_tops, shared, deps, roots,
+                         [ shared[x] for x in live if x in shared ])
+
+    def emit(self, sel):
+        '''Write the tag, instruction, decoder and definition files
+           (and the purity report, Sail and counter files if they are
+           selected) for a selection.
+           Returns a mapping from each filename to its contents:
+           nothing is written to disk.'''
+        args = self.args
+        with self.active():
+            resetTags()
+            self.output_files.clear()
+            self.captured = {}
+            try:
+                notice = sel.spec.notice
+                with instructionOutputs(args, notice) as pipeline:
+                    for i in sel.instrs: pipeline.put(i)
+                profile = self.cache.get('profile', args.profile, lambda: readProfile(args.profile))
+                encs = { deslash(inm) for i in sel.instrs for (inm,_,_,_) in i.encs }
+                writeDecoders(args, sel.spec.decoders, profile, encs if subsetSelected(args) else None)
+                writeDefinitions(args, notice, sel.spec.tops,
+                                 definitionCode(args, sel.deps, sel.shared, sel.live_chunks))
+                return self.captured
+            finally:
+                self.captured = None
+
+'''
+Result of Extractor.parse.
+'instrs' is a list of (instruction, top level declarations) pairs.
+'''
+class Specification:
+    def __init__(self, notice, tops, shared, chunks, decoders, instrs):
+        self.notice   = notice
+        self.tops     = tops
+        self.shared   = shared
+        self.chunks   = chunks
+        self.decoders = decoders
+        self.instrs   = instrs
+
+'''
+Result of Extractor.filter.
+'shared' and 'deps' are the chunks (after specialisation and cuts)
+and the dependency graph; 'live_chunks' are the chunks needed by the
+selected instructions in the order they are written.
+'''
+class Selection:
+    def __init__(self, spec, instrs, instr_tops, shared, deps, roots, live_chunks):
+        self.spec        = spec
+        self.instrs      = instrs
+        self.instr_tops  = instr_tops
+        self.shared      = shared
+        self.deps        = deps
+        self.roots       = roots
+        self.live_chunks = live_chunks
+
+default_extractor = Extractor()
 
 if __name__ == "__main__":
     sys.exit(main())
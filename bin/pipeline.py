@@ -0,0 +1,85 @@
+'''
+Support for streaming output files.
+'''
+
+import queue
+import threading
+
+########################################################################
+# Buffered output
+########################################################################
+
+'''
+Collect small writes to a file and write them in large chunks.
+'''
+class BufferedWriter:
+    def __init__(self, file, size=1<<16):
+        self.file   = file
+        self.size   = size
+        self.parts  = []
+        self.length = 0
+
+    def write(self, s):
+        self.parts.append(s)
+        self.length += len(s)
+        if self.length >= self.size: self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.file.write(''.join(self.parts))
+            self.parts  = []
+            self.length = 0
+
+########################################################################
+# Pipelines
+########################################################################
+
+'''
+Pass each item to a list of consumers as it is produced.
+If 'threaded' is set, the consumers run in a separate thread and
+at most 'depth' items are waiting to be consumed at any time.
+Any exception raised by a consumer is raised again by 'close'.
+'''
+class Pipeline:
+    def __init__(self, consumers, threaded=False, depth=256):
+        self.consumers = consumers
+        self.error     = None
+        self.thread    = None
+        if threaded:
+            self.queue  = queue.Queue(depth)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def consume(self, x):
+        for c in self.consumers: c(x)
+
+    def run(self):
+        while True:
+            x = self.queue.get()
+            if x is None: return
+            if self.error is None:
+                try:
+                    self.consume(x)
+                except BaseException as err:
+                    self.error = err
+
+    def put(self, x):
+        if self.thread:
+            if self.error is not None: raise self.error
+            self.queue.put(x)
+        else:
+            self.consume(x)
+
+    '''
+    Wait until all items have been consumed
+    '''
+    def close(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.error is not None: raise self.error
+
+########################################################################
+# End
+########################################################################
@@ -5,7 +5,11 @@ Unpack ARM System Register XML files creating ASL type definitions.
 '''
 
 import argparse, glob, os, re, sys
-import xml.etree.cElementTree as ET
+
+from incremental import Cache, Watcher, contentHash, updateFile, writeManifest
+from snapshot import writeSnapshot
+from specstore import register_tables, Store, StoreWriter
+from xmlbackend import noticeParagraphs, parseXML, setXMLBackend, xml_backends
 
 # Workaround.
 # The following registers are described as 64-bit in the XML files
@@ -191,94 +195,84 @@ regs32 = [
     "VTCR_EL2"
     ]
 
-def main():
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('--verbose', '-v', help='Use verbose output',
-                        action = 'store_true')
-    parser.add_argument('--output',  '-o', help='File to store tag output',
-                        metavar='FILE', default='output')
-    parser.add_argument('dir', metavar='<dir>',  nargs='+',
-                        help='input directory')
-    args = parser.parse_args()
-
-    # read all the registers
-    regs = {}
-    for d in args.dir:
-        for f in glob.glob(os.path.join(d, '*.xml')):
-            xml = ET.parse(f)
-            for r in xml.iter('register'):
-                if r.attrib['is_register'] == 'True':
-                    long = r.find('reg_long_name').text
-                    name = r.find('reg_short_name').text
-                    if name == 'LSR':
-                        # The name of the LSR register conflicts with the LSR
-                        # function.  Since LSR is not referred to in the current
-                        # ASL, the simplest workaround is to omit the LSR register but
-                        # another solution will be needed in the long run.
-                        print("Workaround: Skipping LSR register")
-                        continue
-                    bounds = None
-                    if r.find('reg_array'):
-                        lo = r.find('reg_array/reg_array_start').text
-                        hi = r.find('reg_array/reg_array_end').text
-                        bounds = (lo,hi)
-                        name = name.replace("<n>","")
-                    # there can be multiple views of a register each either 32 or 64 bits
-                    # so take the longest.  (Required for TTBR0/1)
-                    length = max([int(l.attrib['length']) for l in r.findall('reg_fieldsets/fields') ])
-                    if name in regs32:
-                        # workaround: even if the register is 64-bit, treat it as 32-bit
-                        # if it is on the regs32 list
-                        length = 32
-                    fields = {}
-                    slices = {}
-                    for f in r.findall('reg_fieldsets/fields/field'):
-                        if f.find('field_name') is not None:
-                            nm = f.find('field_name').text
-                            if nm == "VMID" and name in ['EDVIDSR', 'PMVIDSR']: nm = "VMID[7:0]" # workaround
-                            slice = None
-                            m1 = re.match('^(\w+)\[(\d+)\]$', nm)
-                            m2 = re.match('^(\w+)\[(\d+):(\d+)\]$', nm)
-                            if m1:
-                                nm = m1.group(1)
-                                hi = m1.group(2)
-                                slice = (hi,hi)
-                            elif m2:
-                                nm = m2.group(1)
-                                hi = m2.group(2)
-                                lo = m2.group(3)
-                                slice = (hi,lo)
-                            msb = f.find('field_msb').text
-                            lsb = f.find('field_lsb').text
-                            isident = (re.match('^[a-zA-Z_]\w*$', nm)
-                                       and nm != "UNKNOWN")
-                            if slice:
-                                if nm not in slices: slices[nm] = []
-                                slices[nm].append((msb,lsb,slice))
-                            elif isident:
-                                fields[nm] = [(msb,lsb)]
-                            else:
-                                # print(name,nm)
-                                pass
-                    for f in slices.keys():
-                        ss = slices[f]
-                        ss.sort(key=lambda s: int(s[2][0]))
-                        ss = [ (msb,lsb) for (msb,lsb,slice) in reversed(ss) ]
-                        fields[f] = ss
+'''
+Read all the registers in an XML file.
+Returns list of (name, (long name, length, fields, bounds))
+'''
+def readRegisters(filename):
+    regs = []
+    xml = parseXML(filename)
+    for r in xml.iter('register'):
+        if r.attrib['is_register'] == 'True':
+            long = r.find('reg_long_name').text
+            name = r.find('reg_short_name').text
+            if name == 'LSR':
+                # The name of the LSR register conflicts with the LSR
+                # function.  Since LSR is not referred to in the current
+                # ASL, the simplest workaround is to omit the LSR register but
+                # another solution will be needed in the long run.
+                print("Workaround: Skipping LSR register")
+                continue
+            bounds = None
+            reg_array = r.find('reg_array')
+            if reg_array is not None and len(reg_array) > 0:
+                lo = r.find('reg_array/reg_array_start').text
+                hi = r.find('reg_array/reg_array_end').text
+                bounds = (lo,hi)
+                name = name.replace("<n>","")
+            # there can be multiple views of a register each either 32 or 64 bits
+            # so take the longest.  (Required for TTBR0/1)
+            length = max([int(l.attrib['length']) for l in r.findall('reg_fieldsets/fields') ])
+            if name in regs32:
+                # workaround: even if the register is 64-bit, treat it as 32-bit
+                # if it is on the regs32 list
+                length = 32
+            fields = {}
+            slices = {}
+            for f in r.findall('reg_fieldsets/fields/field'):
+                if f.find('field_name') is not None:
+                    nm = f.find('field_name').text
+                    if nm == "VMID" and name in ['EDVIDSR', 'PMVIDSR']: nm = "VMID[7:0]" # workaround
+                    slice = None
+                    m1 = re.match('^(\w+)\[(\d+)\]$', nm)
+                    m2 = re.match('^(\w+)\[(\d+):(\d+)\]$', nm)
+                    if m1:
+                        nm = m1.group(1)
+                        hi = m1.group(2)
+                        slice = (hi,hi)
+                    elif m2:
+                        nm = m2.group(1)
+                        hi = m2.group(2)
+                        lo = m2.group(3)
+                        slice = (hi,lo)
+                    msb = f.find('field_msb').text
+                    lsb = f.find('field_lsb').text
+                    isident = (re.match('^[a-zA-Z_]\w*$', nm)
+                               and nm != "UNKNOWN")
+                    if slice:
+                        if nm not in slices: slices[nm] = []
+                        slices[nm].append((msb,lsb,slice))
+                    elif isident:
+                        fields[nm] = [(msb,lsb)]
+                    else:
+                        # print(name,nm)
+                        pass
+            for f in slices.keys():
+                ss = slices[f]
+                ss.sort(key=lambda s: int(s[2][0]))
+                ss = [ (msb,lsb) for (msb,lsb,slice) in reversed(ss) ]
+                fields[f] = ss
 
-                    if re.match('^[a-zA-Z_]\w*$', name):
-                        # merge any new fields in (mostly to handle external views of regs)
-                        if name in regs:
-                            for f,ss in regs[name][2].items():
-                                if f not in fields:
-                                    fields[f] = ss
-                        regs[name] = (long, length, fields, bounds)
+            if re.match('^[a-zA-Z_]\w*$', name):
+                regs.append((name, (long, length, fields, bounds)))
+    return regs
 
-    # Read proprietary notice
+'''
+Convert paragraphs of proprietary notice (see noticeParagraphs) to lines
+'''
+def readNotice(paras):
     notice = ["Proprietary Notice"]
-    xml = ET.parse(os.path.join(args.dir[0], 'notice.xml'))
-    for p in xml.iter('para'):
-        para = ET.tostring(p, method='text').decode().rstrip()
+    for para in paras:
         para = para.replace("&#8217;", '"')
         para = para.replace("&#8220;", '"')
         para = para.replace("&#8221;", '"')
@@ -287,9 +281,68 @@ def main():
         para = para.replace("&#174;", '(R)')
         lines = para.split('\n')
         notice.extend(lines)
+    return notice
+
+'''
+Read all the register files and generate file of definitions
+Results of reading each file are kept in 'cache' and are only
+recomputed if the file changes.
+The paragraphs of the notice are read unless they are passed in 'paras'.
+'''
+def generate(args, cache, paras=None):
+    if args.from_store is not None:
+        try:
+            store = Store(args.from_store)
+        except ValueError as err:
+            print("Error:", err)
+            sys.exit(1)
+        regs = { name: tuple(r) for (name, r) in store.registers() }
+        notice = readNotice(store.meta('register_notice', []))
+        store.close()
+        writeRegisters(args, notice, regs)
+        return
+
+    # read all the registers
+    regs = {}
+    for d in args.dir:
+        for f in glob.glob(os.path.join(d, '*.xml')):
+            for (name, (long, length, fields, bounds)) in cache.get(('registers', f), [f], lambda: readRegisters(f)):
+                # merge any new fields in (mostly to handle external views of regs)
+                # (into a copy because the cached fields must not change)
+                if name in regs:
+                    fields = dict(fields)
+                    for field,ss in regs[name][2].items():
+                        if field not in fields:
+                            fields[field] = ss
+                regs[name] = (long, length, fields, bounds)
+
+    if paras is None:
+        noticefile = args.notice or os.path.join(args.dir[0], 'notice.xml')
+        paras = cache.get(('notice', noticefile), [noticefile], lambda: noticeParagraphs(noticefile))
+    notice = readNotice(paras)
+
+    writeRegisters(args, notice, regs)
+
+    if args.snapshot is not None:
+        if args.verbose: print("Writing snapshot to", args.snapshot)
+        writeSnapshot(args.snapshot, { 'notice': [('notice', notice)],
+                                       'registers': list(regs.items()) })
 
-    # Generate file of definitions
-    with open(args.output, "w") as f:
+    if args.store is not None:
+        if args.verbose: print("Writing store to", args.store)
+        store = StoreWriter(args.store, register_tables)
+        store.setMeta('register_notice', paras)
+        for (name, r) in regs.items():
+            store.addRegister(name, r)
+        store.close()
+
+'''
+Generate file of definitions
+(and the manifest of hashes of the output and of each register)
+'''
+def writeRegisters(args, notice, regs):
+    hashes = {}
+    with updateFile(args.output) as f:
         print('/'*72, file=f)
         for p in notice:
             print('// '+p, file=f)
@@ -303,9 +356,67 @@ def main():
             if bounds:
                 type = 'array ['+bounds[0]+".."+bounds[1]+'] of '+type
             prefix = "// " if long == 'IMPLEMENTATION DEFINED registers' else ""
-            print("//", long, file=f)
-            print(prefix+type+' '+name+";", file=f)
-            print(file=f)
+            text = "// "+long+"\n"+prefix+type+' '+name+";\n"
+            print(text, file=f)
+            hashes[name] = contentHash(text)
+
+    if args.manifest is not None:
+        changed = writeManifest(args.manifest, { 'registers': hashes }, [args.output])
+        if args.verbose:
+            print("Changed", ", ".join(str(len(ns)) + " " + section for (section, ns) in sorted(changed.items())),
+                  "(see", args.manifest + ")")
+
+'''
+Command line options (also used by extract.py)
+'''
+def argumentParser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbose', '-v', help='Use verbose output',
+                        action = 'store_true')
+    parser.add_argument('--output',  '-o', help='File to store tag output',
+                        metavar='FILE', default='output')
+    parser.add_argument('--notice', help='XML file containing proprietary notice (default: notice.xml in first input directory)',
+                        metavar='FILE', default=None)
+    parser.add_argument('--manifest', help='Json file to store hashes of output and registers (and which changed)',
+                        metavar='FILE', default=None)
+    parser.add_argument('--snapshot', help='File to store binary snapshot of registers',
+                        metavar='FILE', default=None)
+    parser.add_argument('--store', help='SQLite file to store registers',
+                        metavar='FILE', default=None)
+    parser.add_argument('--from-store', help='Read registers from SQLite file instead of XML',
+                        metavar='FILE', default=None)
+    parser.add_argument('--xml-backend', help='XML parser to use (auto uses lxml if it is installed)',
+                        choices=xml_backends, default='auto')
+    parser.add_argument('--watch', help='Watch input files and regenerate output when they change',
+                        action='store_true', default=False)
+    parser.add_argument('dir', metavar='<dir>',  nargs='*',
+                        help='input directory (not used with --from-store)')
+    return parser
+
+def main():
+    parser = argumentParser()
+    args = parser.parse_args()
+    if (args.dir == []) == (args.from_store is None):
+        parser.error("either input directories or --from-store (but not both) are required")
+    if args.from_store is not None and args.watch:
+        parser.error("--watch cannot be used with --from-store")
+    setXMLBackend(args.xml_backend)
+    cache = Cache()
+    generate(args, cache)
+
+    if args.watch:
+        watcher = Watcher(args.dir)
+        print("Watching for changes (press Ctrl-C to stop)")
+        try:
+            while True:
+                changed = watcher.wait()
+                if args.verbose: print("Changed:", " ".join(changed))
+                try:
+                    generate(args, cache)
+                except Exception as err:
+                    print("Error:", err)
+        except KeyboardInterrupt:
+            pass
     return
 
 
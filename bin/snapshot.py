@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+'''
+Compact binary snapshots of the parsed specification.
+
+A snapshot consists of named sections (e.g., "chunks", "instructions",
+"decoders", "registers") each containing records indexed by name.
+Records are values built from None, booleans, integers, strings,
+lists, tuples, sets and dictionaries.
+
+Snapshots are loaded by memory-mapping the file: records (and the
+strings they contain) are only decoded when they are accessed.
+
+Usage: snapshot.py FILE [SECTION [NAME]]
+'''
+
+import mmap
+import struct
+import sys
+
+from incremental import updateFile
+
+########################################################################
+# File format
+########################################################################
+
+# All numbers are little endian.
+#
+#   header:         magic, version, number of sections, number of strings
+#   section table:  for each section: name (string id), number of records,
+#                   offset of index
+#   string table:   offsets of each string (plus end offset) followed by
+#                   the UTF-8 encoded strings
+#   records:        each record is a tagged value (see below)
+#   indexes:        for each section: (name (string id), record offset)
+#                   for each record, sorted by name
+#
+# Values are encoded as a tag byte followed by (for integers) a
+# zigzag-encoded varint, (for strings) the varint string id or
+# (for lists, tuples, sets and dictionaries) the varint number of
+# elements followed by the elements (keys and values alternate in
+# dictionaries).
+
+MAGIC   = b'MRAS'
+VERSION = 1
+
+header_format  = '<4sIII'
+section_format = '<III'
+index_format   = '<II'
+
+TAG_NONE  = 0
+TAG_FALSE = 1
+TAG_TRUE  = 2
+TAG_INT   = 3
+TAG_STR   = 4
+TAG_LIST  = 5
+TAG_TUPLE = 6
+TAG_SET   = 7
+TAG_DICT  = 8
+
+########################################################################
+# Writing snapshots
+########################################################################
+
+def putVarint(out, x):
+    while x >= 0x80:
+        out.append((x & 0x7f) | 0x80)
+        x >>= 7
+    out.append(x)
+
+'''
+Encodes values into a buffer, adding strings to a shared string table
+'''
+class Encoder:
+    def __init__(self):
+        self.strings = {}
+        self.buffer  = bytearray()
+
+    def string(self, s):
+        if s not in self.strings: self.strings[s] = len(self.strings)
+        return self.strings[s]
+
+    def put(self, x):
+        out = self.buffer
+        if x is None:
+            out.append(TAG_NONE)
+        elif x is False:
+            out.append(TAG_FALSE)
+        elif x is True:
+            out.append(TAG_TRUE)
+        elif isinstance(x, int):
+            out.append(TAG_INT)
+            putVarint(out, (x << 1) if x >= 0 else ((-x << 1) - 1))
+        elif isinstance(x, str):
+            out.append(TAG_STR)
+            putVarint(out, self.string(x))
+        elif isinstance(x, dict):
+            out.append(TAG_DICT)
+            putVarint(out, len(x))
+            for (k, v) in x.items():
+                self.put(k)
+                self.put(v)
+        else:
+            if isinstance(x, list):
+                out.append(TAG_LIST)
+            elif isinstance(x, tuple):
+                out.append(TAG_TUPLE)
+            elif isinstance(x, (set, frozenset)):
+                out.append(TAG_SET)
+                x = sorted(x, key=str)
+            else:
+                raise TypeError("Cannot store " + type(x).__name__ + " in snapshot")
+            putVarint(out, len(x))
+            for y in x: self.put(y)
+
+'''
+Write a snapshot to a file.
+'sections' is a dictionary mapping section names to lists of (name, value).
+'''
+def writeSnapshot(filename, sections):
+    enc = Encoder()
+    indexes = []
+    for (section, records) in sections.items():
+        enc.string(section)
+        index = []
+        for (name, value) in records:
+            index.append((enc.string(name), len(enc.buffer)))
+            enc.put(value)
+        indexes.append((section, index))
+
+    strings = [ s.encode('utf-8') for s in enc.strings ]
+
+    # layout of file
+    start_sections = struct.calcsize(header_format)
+    start_strings  = start_sections + len(indexes) * struct.calcsize(section_format)
+    start_text     = start_strings + (len(strings) + 1) * 4
+    start_records  = start_text + sum(len(s) for s in strings)
+    start_indexes  = start_records + len(enc.buffer)
+    if start_indexes + sum(len(i) for (_, i) in indexes) * struct.calcsize(index_format) >= 1 << 32:
+        raise ValueError("Snapshot is too large")
+
+    with updateFile(filename, binary=True) as f:
+        f.write(struct.pack(header_format, MAGIC, VERSION, len(indexes), len(strings)))
+        offset = start_indexes
+        for (section, index) in indexes:
+            f.write(struct.pack(section_format, enc.strings[section], len(index), offset))
+            offset += len(index) * struct.calcsize(index_format)
+        offset = start_text
+        for s in strings:
+            f.write(struct.pack('<I', offset))
+            offset += len(s)
+        f.write(struct.pack('<I', offset))
+        for s in strings: f.write(s)
+        f.write(enc.buffer)
+        for (section, index) in indexes:
+            index.sort(key=lambda x: strings[x[0]])
+            for (name, record) in index:
+                f.write(struct.pack(index_format, name, start_records + record))
+
+########################################################################
+# Reading snapshots
+########################################################################
+
+'''
+A snapshot loaded from a file.
+Sections are accessed by name: snapshot['instructions'].
+'''
+class Snapshot:
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, nsections, nstrings) = struct.unpack_from(header_format, self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(filename + " is not a snapshot")
+        if version != VERSION:
+            raise ValueError(filename + " is snapshot version " + str(version)
+                             + " but version " + str(VERSION) + " is required")
+        self.nstrings = nstrings
+        self.start_strings = struct.calcsize(header_format) + nsections * struct.calcsize(section_format)
+        self.cache = {}
+        self.sections = {}
+        for i in range(nsections):
+            off = struct.calcsize(header_format) + i * struct.calcsize(section_format)
+            (name, count, index) = struct.unpack_from(section_format, self.data, off)
+            self.sections[self.string(name)] = Section(self, count, index)
+
+    def string(self, i):
+        s = self.cache.get(i)
+        if s is None:
+            (start, end) = struct.unpack_from('<II', self.data, self.start_strings + i * 4)
+            s = self.data[start:end].decode('utf-8')
+            self.cache[i] = s
+        return s
+
+    def varint(self, off):
+        x = 0
+        shift = 0
+        while True:
+            b = self.data[off]
+            off += 1
+            x |= (b & 0x7f) << shift
+            if b < 0x80: return (x, off)
+            shift += 7
+
+    # decode the value at offset 'off', returning (value, next offset)
+    def value(self, off):
+        tag = self.data[off]
+        off += 1
+        if tag == TAG_NONE:  return (None, off)
+        if tag == TAG_FALSE: return (False, off)
+        if tag == TAG_TRUE:  return (True, off)
+        (n, off) = self.varint(off)
+        if tag == TAG_INT: return ((n >> 1) if not n & 1 else -((n + 1) >> 1), off)
+        if tag == TAG_STR: return (self.string(n), off)
+        if tag == TAG_DICT:
+            d = {}
+            for i in range(n):
+                (k, off) = self.value(off)
+                (d[k], off) = self.value(off)
+            return (d, off)
+        xs = []
+        for i in range(n):
+            (x, off) = self.value(off)
+            xs.append(x)
+        if tag == TAG_LIST:  return (xs, off)
+        if tag == TAG_TUPLE: return (tuple(xs), off)
+        if tag == TAG_SET:   return (set(xs), off)
+        raise ValueError("Malformed snapshot: unknown tag " + str(tag))
+
+    def __getitem__(self, section):
+        return self.sections[section]
+
+    def __contains__(self, section):
+        return section in self.sections
+
+    def close(self):
+        self.data.close()
+
+'''
+A section of a snapshot: a mapping from names to records.
+Records are decoded when they are first accessed.
+'''
+class Section:
+    def __init__(self, snapshot, count, index):
+        self.snapshot = snapshot
+        self.count    = count
+        self.index    = index
+        self.records  = {}
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        return struct.unpack_from(index_format, self.snapshot.data, self.index + i * struct.calcsize(index_format))
+
+    def name(self, i):
+        return self.snapshot.string(self.entry(i)[0])
+
+    def find(self, name):
+        # binary search of the sorted index
+        lo = 0
+        hi = self.count
+        key = name.encode('utf-8')
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid).encode('utf-8') < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self.name(lo) == name else None
+
+    def record(self, i):
+        if i not in self.records:
+            (_, off) = self.entry(i)
+            (self.records[i], _) = self.snapshot.value(off)
+        return self.records[i]
+
+    def get(self, name, default=None):
+        i = self.find(name)
+        return default if i is None else self.record(i)
+
+    def __getitem__(self, name):
+        i = self.find(name)
+        if i is None: raise KeyError(name)
+        return self.record(i)
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def keys(self):
+        return [ self.name(i) for i in range(self.count) ]
+
+    def items(self):
+        return [ (self.name(i), self.record(i)) for i in range(self.count) ]
+
+########################################################################
+# Main
+########################################################################
+
+def main():
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print(__doc__.strip())
+        return 1
+    snapshot = Snapshot(sys.argv[1])
+    if len(sys.argv) == 2:
+        for (name, section) in snapshot.sections.items():
+            print("%-20s %8d" % (name, len(section)))
+    elif len(sys.argv) == 3:
+        for name in snapshot[sys.argv[2]].keys():
+            print(name)
+    else:
+        print(repr(snapshot[sys.argv[2]][sys.argv[3]]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+########################################################################
+# End
+########################################################################
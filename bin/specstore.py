@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+'''
+SQLite database of the parsed specification.
+
+A store holds the chunks of shared pseudocode, the dependency graph
+between them, the instructions, the decoders and the system registers
+so that they can be queried and used to generate output without
+holding everything in memory or parsing the XML again.
+
+Records are plain values (as for snapshots) encoded as json.
+
+Usage: specstore.py FILE [code|defines|deps|users|instruction NAME]
+'''
+
+import json
+import os
+import sqlite3
+import sys
+
+########################################################################
+# Schema
+########################################################################
+
+# The dependency graph is stored as edges from each chunk to the
+# names it depends on and from each name to the chunk that defines it
+# (the same bipartite graph that instrs2asl.py builds in memory).
+
+schema = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS chunks (seq INTEGER PRIMARY KEY, name TEXT UNIQUE, code TEXT);
+CREATE TABLE IF NOT EXISTS defs (name TEXT, chunk TEXT);
+CREATE TABLE IF NOT EXISTS edges (src TEXT, dst TEXT);
+CREATE TABLE IF NOT EXISTS instructions (seq INTEGER PRIMARY KEY, name TEXT UNIQUE, record TEXT);
+CREATE TABLE IF NOT EXISTS instruction_deps (instruction TEXT, name TEXT);
+CREATE TABLE IF NOT EXISTS decoders (seq INTEGER PRIMARY KEY, name TEXT, record TEXT);
+CREATE TABLE IF NOT EXISTS registers (seq INTEGER PRIMARY KEY, name TEXT UNIQUE, record TEXT);
+'''
+
+indexes = '''
+CREATE INDEX IF NOT EXISTS defs_name ON defs (name);
+CREATE INDEX IF NOT EXISTS defs_chunk ON defs (chunk);
+CREATE INDEX IF NOT EXISTS edges_src ON edges (src);
+CREATE INDEX IF NOT EXISTS edges_dst ON edges (dst);
+CREATE INDEX IF NOT EXISTS instruction_deps_instruction ON instruction_deps (instruction);
+CREATE INDEX IF NOT EXISTS instruction_deps_name ON instruction_deps (name);
+'''
+
+# Tables written by each tool: a tool replaces its own tables and
+# leaves the others alone so that reg2asl.py and instrs2asl.py can
+# write to the same store.
+instruction_tables = ['chunks', 'defs', 'edges', 'instructions', 'instruction_deps', 'decoders']
+register_tables    = ['registers']
+
+# sets are stored as sorted lists
+def encode(x):
+    return json.dumps(x, default=lambda s: sorted(s))
+
+def connect(filename):
+    # wait for other tools writing to the same store and allow
+    # records to be written by a pipeline thread
+    return sqlite3.connect(filename, timeout=600, check_same_thread=False)
+
+########################################################################
+# Writing stores
+########################################################################
+
+'''
+Write records to a store, replacing the contents of 'tables'.
+Nothing is visible to readers until close is called.
+'''
+class StoreWriter:
+    def __init__(self, filename, tables):
+        self.db = connect(filename)
+        self.db.executescript(schema)
+        for t in tables:
+            self.db.execute('DELETE FROM ' + t)
+
+    def setMeta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, encode(value)))
+
+    def addChunk(self, name, code, defs, deps):
+        self.db.execute('INSERT INTO chunks (name, code) VALUES (?, ?)', (name, code))
+        self.db.executemany('INSERT INTO defs VALUES (?, ?)', [ (d, name) for d in defs ])
+        self.db.executemany('INSERT INTO edges VALUES (?, ?)', [ (name, d) for d in deps ])
+
+    # Add edges from each name to the chunk that defines it.
+    # (If several chunks define a name, only one of them should be used.)
+    def addDefiners(self, definers):
+        self.db.executemany('INSERT INTO edges VALUES (?, ?)', definers)
+
+    def addInstruction(self, name, record, deps):
+        self.db.execute('INSERT INTO instructions (name, record) VALUES (?, ?)', (name, encode(record)))
+        self.db.executemany('INSERT INTO instruction_deps VALUES (?, ?)', [ (name, d) for d in deps ])
+
+    def addDecoder(self, name, record):
+        self.db.execute('INSERT INTO decoders (name, record) VALUES (?, ?)', (name, encode(record)))
+
+    def addRegister(self, name, record):
+        self.db.execute('INSERT INTO registers (name, record) VALUES (?, ?)', (name, encode(record)))
+
+    def close(self):
+        self.db.executescript(indexes)
+        self.db.commit()
+        self.db.close()
+
+########################################################################
+# Reading stores
+########################################################################
+
+'''
+A store opened for reading.
+Records are read from the database when they are needed.
+'''
+class Store:
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise ValueError(filename + " does not exist")
+        self.db = connect(filename)
+
+    def meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def chunkNames(self):
+        return [ x for (x,) in self.db.execute('SELECT name FROM chunks ORDER BY seq') ]
+
+    def hasChunk(self, name):
+        return self.db.execute('SELECT 1 FROM chunks WHERE name = ?', (name,)).fetchone() is not None
+
+    def code(self, name):
+        row = self.db.execute('SELECT code FROM chunks WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    # Returns (name, code, defs, deps) or None
+    def chunk(self, name):
+        code = self.code(name)
+        if code is None: return None
+        defs = { x for (x,) in self.db.execute('SELECT name FROM defs WHERE chunk = ?', (name,)) }
+        return (name, code, defs, self.dependencies(name) - defs)
+
+    # The chunk that defines a name (or None)
+    def definer(self, name):
+        row = self.db.execute('SELECT chunk FROM defs WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    # Successors of a node in the dependency graph
+    def dependencies(self, name):
+        return { x for (x,) in self.db.execute('SELECT dst FROM edges WHERE src = ?', (name,)) }
+
+    # Predecessors of a node in the dependency graph
+    def users(self, name):
+        return { x for (x,) in self.db.execute('SELECT src FROM edges WHERE dst = ?', (name,)) }
+
+    # Names of instructions that (directly) depend on a name
+    def instructionUsers(self, name):
+        return { x for (x,) in self.db.execute('SELECT instruction FROM instruction_deps WHERE name = ?', (name,)) }
+
+    # Generate instruction records in the order they were added
+    def instructions(self):
+        for (record,) in self.db.execute('SELECT record FROM instructions ORDER BY seq'):
+            yield json.loads(record)
+
+    def instruction(self, name):
+        row = self.db.execute('SELECT record FROM instructions WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def decoders(self):
+        for (record,) in self.db.execute('SELECT record FROM decoders ORDER BY seq'):
+            yield json.loads(record)
+
+    def registers(self):
+        for (name, record) in self.db.execute('SELECT name, record FROM registers ORDER BY seq'):
+            yield (name, json.loads(record))
+
+    def count(self, table):
+        return self.db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+'''
+The dependency graph of a store as a mapping from each node to
+its successors (or its predecessors if 'reverse' is set).
+Entries in 'override' replace the edges in the store.
+'''
+class StoreGraph:
+    def __init__(self, store, override={}, reverse=False):
+        self.store    = store
+        self.override = override
+        self.reverse  = reverse
+
+    def __getitem__(self, name):
+        if self.reverse:
+            return ({ x for x in self.store.users(name) if x not in self.override }
+                    | { x for (x, ds) in self.override.items() if name in ds })
+        if name in self.override: return self.override[name]
+        return self.store.dependencies(name)
+
+    def get(self, name, default=None):
+        return self[name]
+
+########################################################################
+# Main
+########################################################################
+
+queries = {
+    'code':        lambda s, x: s.code(x),
+    'defines':     lambda s, x: s.definer(x),
+    'deps':        lambda s, x: "\n".join(sorted(s.dependencies(x))),
+    'users':       lambda s, x: "\n".join(sorted(s.users(x) | s.instructionUsers(x))),
+    'instruction': lambda s, x: json.dumps(s.instruction(x), indent=4),
+}
+
+def main():
+    if len(sys.argv) not in [2, 4] or (len(sys.argv) == 4 and sys.argv[2] not in queries):
+        print(__doc__.strip())
+        return 1
+    store = Store(sys.argv[1])
+    if len(sys.argv) == 2:
+        for t in ['chunks', 'defs', 'edges', 'instructions', 'decoders', 'registers']:
+            print("%-20s %8d" % (t, store.count(t)))
+    else:
+        result = queries[sys.argv[2]](store, sys.argv[3])
+        if result is None or result == "null":
+            print("Error: not found:", sys.argv[3])
+            return 1
+        print(result)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+########################################################################
+# End
+########################################################################
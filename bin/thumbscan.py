@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+'''
+Split a Thumb instruction stream into 16-bit and 32-bit instructions
+and decode them using the T32 decode tables in ARM's XML files.
+
+The input is a raw binary or the Thumb code in an ELF file and is
+memory-mapped and processed in batches using NumPy.
+'''
+
+import argparse
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from instrs2asl import readDecodeFile
+from checkdecode import compileTree, decodeArray, outcome_names
+from trace2filter import readSections, SHT_SYMTAB, SHT_NOBITS, SHF_EXECINSTR
+
+########################################################################
+# Finding Thumb code
+########################################################################
+
+ET_REL     = 1
+EF_ARM_BE8 = 0x00800000
+
+'''
+Read the ARM mapping symbols ($a, $t and $d) of an ELF file.
+Returns dictionary mapping section indexes to sorted lists of
+(offset within section, kind) where kind is 'a', 't' or 'd'.
+'''
+def mappingSymbols(data, sections, little, is64):
+    e = '<' if little else '>'
+    (e_type,) = struct.unpack_from(e+'H', data, 0x10)
+    marks = {}
+    for (name, type, flags, addr, offset, size, link, entsize) in sections:
+        if type != SHT_SYMTAB or entsize == 0: continue
+        strtab = sections[link][4]
+        for off in range(offset, offset + size, entsize):
+            if is64:
+                (nm, info, other, shndx, value, sz) = struct.unpack_from(e+'IBBHQQ', data, off)
+            else:
+                (nm, value, sz, info, other, shndx) = struct.unpack_from(e+'IIIBBH', data, off)
+            if shndx >= len(sections): continue
+            s = bytes(data[strtab+nm : strtab+nm+3])
+            if s[:1] == b'$' and s[1:2] in [b'a', b't', b'd'] and s[2:3] in [b'\0', b'.']:
+                # symbols in relocatable files are relative to the section
+                start = value if e_type == ET_REL else value - sections[shndx][3]
+                if 0 <= start <= sections[shndx][5]:
+                    marks.setdefault(shndx, []).append((start, s[1:2].decode()))
+    for m in marks.values(): m.sort()
+    return marks
+
+'''
+Find the Thumb code in an ELF file.
+Returns list of (address, contents) and whether instructions are little endian.
+Executable sections without mapping symbols are assumed to be Thumb code.
+'''
+def readThumbELF(data):
+    (sections, little, is64) = readSections(data)
+    (e_flags,) = struct.unpack_from(('<' if little else '>') + 'I', data, 0x30 if is64 else 0x24)
+    if e_flags & EF_ARM_BE8: little = True # BE8 images have little endian instructions
+    marks = mappingSymbols(data, sections, little, is64)
+    regions = []
+    for (i, (name, type, flags, addr, offset, size, link, entsize)) in enumerate(sections):
+        if not flags & SHF_EXECINSTR or type == SHT_NOBITS: continue
+        ms = marks.get(i, [(0, 't')])
+        for (j, (start, kind)) in enumerate(ms):
+            end = ms[j+1][0] if j+1 < len(ms) else size
+            if kind == 't' and start < end:
+                regions.append((addr + start, data[offset+start : offset+end]))
+    return (regions, little)
+
+########################################################################
+# Splitting instruction streams
+########################################################################
+
+'''
+Find the start of each instruction in an array of halfwords
+that starts at an instruction boundary.
+
+A halfword is the first half of a 32-bit instruction if its top
+five bits are 0b11101, 0b11110 or 0b11111.
+The halfword after any other halfword (which is either a 16-bit
+instruction or the second half of a 32-bit instruction) starts an
+instruction so a halfword starts an instruction if and only if the run
+of 32-bit prefixes immediately before it has even length.
+
+Returns the indexes of the instructions and whether each is 32-bit.
+A 32-bit instruction that is cut off by the end of the array is omitted.
+'''
+def segment(hws):
+    n = len(hws)
+    is32 = (hws >> 11) >= 0b11101
+    idx = np.arange(n)
+    last = np.maximum.accumulate(np.where(is32, -1, idx)) # last non-prefix at or before i
+    run = idx - last # length of run of prefixes ending at i
+    start = np.ones(n, dtype=bool)
+    start[1:] = run[:-1] % 2 == 0
+    starts = np.nonzero(start)[0]
+    wide = is32[starts]
+    if len(starts) > 0 and wide[-1] and starts[-1] == n - 1:
+        starts = starts[:-1]
+        wide = wide[:-1]
+    return (starts, wide)
+
+'''
+Condition of each instruction in an IT block
+'''
+def itConditions(firstcond, mask):
+    n = 4 - ((mask & -mask).bit_length() - 1)
+    return [firstcond] + [ (firstcond & 0b1110) | ((mask >> (4 - j)) & 1) for j in range(1, n) ]
+
+condition_names = [ "EQ", "NE", "CS", "CC", "MI", "PL", "VS", "VC",
+                    "HI", "LS", "GE", "LT", "GT", "LE", "AL", "NV" ]
+
+########################################################################
+# Scanning
+########################################################################
+
+'''
+Decode Thumb code region by region, keeping statistics of the
+encodings found.
+'''
+class Scanner:
+    def __init__(self, decoders, batch, listing, verbose):
+        self.trees    = []
+        self.outcomes = list(outcome_names)
+        for (groups, classes) in decoders:
+            self.trees.append(compileTree(groups, classes, self.outcomes))
+        self.batch    = batch
+        self.listing  = listing
+        self.verbose  = verbose
+        self.counts   = Counter()
+        self.narrow   = 0
+        self.wide     = 0
+        self.in_it    = 0
+        self.nested   = 0   # IT instructions inside IT blocks
+        self.trailing = 0   # regions that end in the middle of an instruction
+        self.bytes    = 0
+        self.time     = 0.0
+
+    '''
+    Decode a region of Thumb code starting at 'address'
+    '''
+    def scan(self, address, data, little):
+        hws = np.frombuffer(data, dtype='<u2' if little else '>u2', count=len(data) // 2)
+        self.bytes += 2 * len(hws)
+        pending = [] # conditions of remaining instructions in an IT block
+        pos = 0
+        while pos < len(hws):
+            start = time.perf_counter()
+            sub = hws[pos : pos + self.batch]
+            final = pos + len(sub) == len(hws)
+            (starts, wide) = segment(sub)
+            if len(starts) == 0: # a single halfword that starts a 32-bit instruction
+                self.trailing += 1
+                break
+            ops = sub[starts].astype(np.uint32) << np.uint32(16)
+            seconds = np.minimum(starts + 1, len(sub) - 1)
+            ops |= np.where(wide, sub[seconds], 0).astype(np.uint32)
+
+            # condition of each instruction in an IT block (or -1)
+            cond = np.full(len(ops), -1, dtype=np.int8)
+            k = min(len(pending), len(ops))
+            cond[:k] = pending[:k]
+            pending = pending[k:]
+            its = np.nonzero(~wide & ((ops >> np.uint32(24)) == 0xbf)
+                             & (((ops >> np.uint32(16)) & np.uint32(0xf)) != 0))[0]
+            end = k # end of current IT block
+            for i in its:
+                if cond[i] >= 0: self.nested += 1
+                cond[i+1 : end] = -1 # an IT instruction ends any enclosing IT block
+                op = int(ops[i])
+                cs = itConditions((op >> 20) & 0xf, (op >> 16) & 0xf)
+                j = min(len(cs), len(ops) - i - 1)
+                cond[i+1 : i+1+j] = cs[:j]
+                pending = cs[j:]
+                end = i + 1 + j
+
+            out = np.zeros(len(ops), dtype=np.int64)
+            for tree in self.trees:
+                decodeArray(tree, ops, out, np.nonzero(out == 0)[0])
+            self.time += time.perf_counter() - start
+
+            for (o, n) in enumerate(np.bincount(out, minlength=len(self.outcomes))):
+                if n: self.counts[self.outcomes[o]] += int(n)
+            self.wide   += int(np.count_nonzero(wide))
+            self.narrow += len(ops) - int(np.count_nonzero(wide))
+            self.in_it  += int(np.count_nonzero(cond >= 0))
+
+            if self.listing is not None:
+                self.list(address + 2 * (pos + starts), ops, wide, out, cond)
+
+            # continue after the last complete instruction
+            end = int(starts[-1] + 1 + wide[-1])
+            if end < len(sub) and final:
+                self.trailing += 1
+                break
+            pos += end
+
+    def list(self, addresses, ops, wide, out, cond):
+        lines = []
+        for (a, op, w, o, c) in zip(addresses.tolist(), ops.tolist(), wide.tolist(), out.tolist(), cond.tolist()):
+            hex = "%04x %04x" % (op >> 16, op & 0xffff) if w else "%04x     " % (op >> 16)
+            suffix = "  " + condition_names[c] if c >= 0 else ""
+            lines.append("%08x: %s  %s%s\n" % (a, hex, self.outcomes[o], suffix))
+        self.listing.write("".join(lines))
+
+    def report(self):
+        total = self.narrow + self.wide
+        rate = total / self.time if self.time > 0 else 0
+        print("Decoded %d instructions (%d 16-bit, %d 32-bit) from %d bytes in %.2fs (%.0f instructions/s)"
+              % (total, self.narrow, self.wide, self.bytes, self.time, rate))
+        print("%d instructions in IT blocks" % self.in_it)
+        if self.nested: print("Warning: %d IT instructions inside IT blocks" % self.nested)
+        if self.trailing: print("Warning: %d regions end in the middle of an instruction" % self.trailing)
+        for o in outcome_names:
+            if self.counts[o]: print("%10d %s" % (self.counts[o], o))
+        encs = [ (n, e) for (e, n) in self.counts.items() if e not in outcome_names ]
+        if self.verbose > 0:
+            for (n, e) in sorted(encs, reverse=True):
+                print("%10d %s" % (n, e))
+        else:
+            print("%10d distinct encodings (use -v to list them)" % len(encs))
+
+########################################################################
+# Main
+########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbose', '-v', help='Use verbose output',
+                        action = 'count', default=0)
+    parser.add_argument('--format', help='Format of the input files',
+                        choices=['auto', 'raw', 'elf'], default='auto')
+    parser.add_argument('--big-endian', help='Raw input files are big endian',
+                        action='store_true', default=False)
+    parser.add_argument('--offset', help='Start of Thumb code in raw input files',
+                        metavar='N', type=lambda x: int(x, 0), default=0)
+    parser.add_argument('--length', help='Length of Thumb code in raw input files',
+                        metavar='N', type=lambda x: int(x, 0), default=None)
+    parser.add_argument('--batch', help='Number of halfwords to decode at once',
+                        metavar='N', type=int, default=1 << 16)
+    parser.add_argument('--listing', help='File to store address, opcode and encoding of each instruction',
+                        metavar='FILE', default=None)
+    parser.add_argument('--profile', help='Optional file to store instruction frequencies (for instrs2asl.py --profile)',
+                        metavar='FILE', default=None)
+    parser.add_argument('--xml', help='Directory containing XML files',
+                        metavar='DIR', required=True, action='append')
+    parser.add_argument('input', metavar='<file>', nargs='+',
+                        help='binary or ELF files')
+    args = parser.parse_args()
+
+    if np is None:
+        print("Error: thumbscan.py requires NumPy")
+        return 1
+
+    decoders = [ readDecodeFile(d, f) for d in args.xml
+                 for f in glob.glob(os.path.join(d, 't32_encindex.xml')) ]
+    if decoders == []:
+        print("Error: no T32 decoder found in", ", ".join(args.xml))
+        return 1
+
+    listing = open(args.listing, "w") if args.listing is not None else None
+    scanner = Scanner(decoders, max(args.batch, 2), listing, args.verbose)
+    for fn in args.input:
+        with open(fn, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0: continue
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(mm)
+        format = args.format
+        if format == 'auto':
+            format = 'elf' if data[:4] == b'\x7fELF' else 'raw'
+        if format == 'elf':
+            (regions, little) = readThumbELF(data)
+        else:
+            end = len(data) if args.length is None else args.offset + args.length
+            regions = [ (args.offset, data[args.offset:end]) ]
+            little = not args.big_endian
+        if args.verbose > 0: print("Scanning", len(regions), "regions of", fn)
+        for (address, region) in regions:
+            scanner.scan(address, region, little)
+    if listing is not None: listing.close()
+
+    scanner.report()
+
+    if args.profile is not None:
+        if args.verbose > 0: print("Writing instruction frequencies to", args.profile)
+        profile = { e: n for (e, n) in scanner.counts.most_common() if e not in outcome_names }
+        with open(args.profile, "w") as f:
+            json.dump(profile, f, indent=4)
+            print(file=f)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+########################################################################
+# End
+########################################################################
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+'''
+Generate a filter file for instrs2asl.py from a binary or list of opcodes.
+
+The opcodes are decoded using the decode tables in ARM's XML files
+and the filter selects exactly the instructions that were found.
+'''
+
+import argparse
+import glob
+import json
+import os
+import re
+import string
+import struct
+import sys
+from collections import Counter
+
+from instrs2asl import readDecodeFile, readInstruction, decodeOpcode, deslash
+from xmlbackend import parseXML
+
+########################################################################
+# Reading opcodes
+########################################################################
+
+# decode index file for each instruction set
+decoder_files = {
+    'A64': 'encodingindex.xml',
+    'A32': 'a32_encindex.xml',
+    'T32': 't32_encindex.xml',
+}
+
+'''
+Test whether a T32 halfword is the first half of a 32-bit instruction
+'''
+def isT32Prefix(hw):
+    return (hw >> 11) in [0b11101, 0b11110, 0b11111]
+
+'''
+Split an instruction stream into opcodes.
+A64 and A32 instructions are 32-bit words.
+T32 instructions are one or two halfwords: 16-bit instructions
+are placed in the top half of the opcode to match the decode tables.
+'''
+def splitOpcodes(data, isa, little):
+    opcodes = []
+    if isa == 'T32':
+        fmt = '<' if little else '>'
+        hws = struct.unpack(fmt + str(len(data) // 2) + 'H', data[:len(data) & ~1])
+        i = 0
+        while i < len(hws):
+            if isT32Prefix(hws[i]) and i+1 < len(hws):
+                opcodes.append((hws[i] << 16) | hws[i+1])
+                i += 2
+            else:
+                opcodes.append(hws[i] << 16)
+                i += 1
+    else:
+        fmt = '<' if little else '>'
+        opcodes.extend(struct.unpack(fmt + str(len(data) // 4) + 'I', data[:len(data) & ~3]))
+    return opcodes
+
+'''
+Read the section headers of an ELF file.
+Returns list of sections (name, type, flags, addr, offset, size, link, entsize),
+whether the file is little endian and whether it is a 64-bit ELF file.
+'''
+def readSections(data):
+    is64   = data[4] == 2
+    little = data[5] == 1
+    e = '<' if little else '>'
+    if is64:
+        (shoff,) = struct.unpack_from(e+'Q', data, 0x28)
+        (shentsize, shnum, shstrndx) = struct.unpack_from(e+'HHH', data, 0x3a)
+    else:
+        (shoff,) = struct.unpack_from(e+'I', data, 0x20)
+        (shentsize, shnum, shstrndx) = struct.unpack_from(e+'HHH', data, 0x2e)
+
+    sections = []
+    for i in range(shnum):
+        off = shoff + i * shentsize
+        if is64:
+            (name, type, flags, addr, offset, size, link, info, align, entsize) = struct.unpack_from(e+'IIQQQQIIQQ', data, off)
+        else:
+            (name, type, flags, addr, offset, size, link, info, align, entsize) = struct.unpack_from(e+'IIIIIIIIII', data, off)
+        sections.append((name, type, flags, addr, offset, size, link, entsize))
+    return (sections, little, is64)
+
+SHT_SYMTAB     = 2
+SHT_NOBITS     = 8
+SHF_EXECINSTR  = 0x4
+
+'''
+Extract the contents of all executable sections of an ELF file.
+Returns list of section contents and whether the file is little endian.
+'''
+def readELF(data):
+    (sections, little, is64) = readSections(data)
+    text = [ data[offset:offset+size] for (name, type, flags, addr, offset, size, link, entsize) in sections
+             if flags & SHF_EXECINSTR and type != SHT_NOBITS ]
+    return (text, little)
+
+'''
+Read a text file containing a list of hexadecimal opcodes.
+Comments starting with '#' or '//' are ignored.
+For T32, 4-digit opcodes are 16-bit instructions and 8-digit opcodes
+are 32-bit instructions.
+'''
+def readHex(text, isa):
+    opcodes = []
+    for l in text.splitlines():
+        l = re.split('#|//', l)[0]
+        for t in l.split():
+            t = t[2:] if t.lower().startswith("0x") else t
+            if not re.fullmatch('[0-9a-fA-F]+', t):
+                print("Warning: ignoring", t)
+                continue
+            x = int(t, 16)
+            if isa == 'T32' and len(t) <= 4: x = x << 16
+            opcodes.append(x)
+    return opcodes
+
+'''
+Read opcodes from a file in one of the formats 'raw', 'elf' or 'hex'
+(or 'auto' to guess the format)
+'''
+def readOpcodes(filename, isa, format, little):
+    with open(filename, "rb") as f:
+        data = f.read()
+    if format == 'auto':
+        if data.startswith(b'\x7fELF'):
+            format = 'elf'
+        elif all(chr(c) in string.printable for c in data):
+            format = 'hex'
+        else:
+            format = 'raw'
+    if format == 'elf':
+        (text, little) = readELF(data)
+        return [ x for t in text for x in splitOpcodes(t, isa, little) ]
+    elif format == 'hex':
+        return readHex(data.decode('ascii', errors='replace'), isa)
+    else:
+        return splitOpcodes(data, isa, little)
+
+########################################################################
+# Main
+########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--verbose', '-v', help='Use verbose output',
+                        action = 'count', default=0)
+    parser.add_argument('--output', '-o', help='File to store filter',
+                        metavar='FILE', default='filter.json')
+    parser.add_argument('--isa', help='Instruction set of the input',
+                        choices=sorted(decoder_files.keys()), default='A64')
+    parser.add_argument('--format', help='Format of the input files',
+                        choices=['auto', 'raw', 'elf', 'hex'], default='auto')
+    parser.add_argument('--big-endian', help='Raw input files are big endian',
+                        action='store_true', default=False)
+    parser.add_argument('--base', help='Optional filter file to copy roots, cuts and canaries from',
+                        metavar='FILE', default=None)
+    parser.add_argument('--profile', help='Optional file to store instruction frequencies (for instrs2asl.py --profile)',
+                        metavar='FILE', default=None)
+    parser.add_argument('--xml', help='Directory containing XML files',
+                        metavar='DIR', required=True, action='append')
+    parser.add_argument('input', metavar='<file>', nargs='+',
+                        help='binary, ELF or hex files')
+    args = parser.parse_args()
+
+    counts = Counter()
+    for fn in args.input:
+        counts.update(readOpcodes(fn, args.isa, args.format, not args.big_endian))
+    if args.verbose > 0: print("Read", sum(counts.values()), "opcodes,", len(counts), "unique")
+
+    decoders = [ readDecodeFile(d, f) for d in args.xml
+                 for f in glob.glob(os.path.join(d, decoder_files[args.isa])) ]
+    if decoders == []:
+        print("Error: no decoder for", args.isa, "found in", ", ".join(args.xml))
+        return 1
+
+    # decode each distinct opcode once
+    encodings = Counter()
+    profile   = Counter() # frequencies keyed by XML encoding name (if available)
+    unknown   = 0
+    for (opcode, n) in counts.items():
+        row = None
+        for (groups, classes) in decoders:
+            row = decodeOpcode(groups, classes, opcode)
+            if row: break
+        if row is None or row[3] or row[4] or row[5]:
+            if args.verbose > 1: print("Not an instruction: %08x" % opcode)
+            unknown += n
+            continue
+        encodings[deslash(row[1])] += n
+        profile[row[2] or deslash(row[1])] += n
+    if unknown: print("Warning:", unknown, "opcodes did not decode to an instruction")
+
+    # map encodings back to the instructions they belong to
+    names = {}
+    for d in args.xml:
+        for inf in glob.glob(os.path.join(d, '*.xml')):
+            name = re.search('.*/(\S+).xml',inf).group(1)
+            if name == "onebigfile": continue
+            (instr, _) = readInstruction(parseXML(inf), {}, False)
+            if instr is None: continue
+            for (inm, _, _, _) in instr.encs:
+                names[deslash(inm)] = instr.name
+
+    instrs = set()
+    for e in encodings:
+        if e in names:
+            instrs.add(names[e])
+        else:
+            print("Warning: unknown encoding", e)
+    if args.verbose > 0:
+        for (e, n) in encodings.most_common():
+            print("%10d %s" % (n, e))
+
+    filter = { "instructions": [ "^"+re.escape(i)+"$" for i in sorted(instrs) ],
+               "roots": [], "cuts": [], "canaries": [] }
+    if args.base is not None:
+        with open(args.base, "r") as f:
+            base = json.load(f)
+        for k in ["roots", "cuts", "canaries"]:
+            filter[k] = base.get(k, [])
+
+    if args.verbose > 0: print("Writing filter to", args.output)
+    with open(args.output, "w") as f:
+        json.dump(filter, f, indent=4)
+        print(file=f)
+
+    if args.profile is not None:
+        if args.verbose > 0: print("Writing instruction frequencies to", args.profile)
+        with open(args.profile, "w") as f:
+            json.dump(dict(profile.most_common()), f, indent=4)
+            print(file=f)
+
+    return
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+########################################################################
+# End
+########################################################################
@@ -0,0 +1,83 @@
+'''
+Access to XML files.
+
+lxml is used to parse XML files if it is installed and Python's
+ElementTree is used otherwise.
+Both produce elements with the same interface (find, findall, iter,
+attrib, text, tail) and the output does not depend on which is used.
+'''
+
+import sys
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import lxml.etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+########################################################################
+# Backends
+########################################################################
+
+xml_backends = ['auto', 'lxml', 'stdlib']
+
+backend = 'lxml' if lxml_etree is not None else 'stdlib'
+
+'''
+Check that an XML parser ('lxml', 'stdlib' or 'auto') is available
+and return its name ('auto' is lxml if it is installed)
+'''
+def checkXMLBackend(name):
+    if name == 'auto':
+        name = 'lxml' if lxml_etree is not None else 'stdlib'
+    if name == 'lxml' and lxml_etree is None:
+        print("Error: XML backend lxml is not installed")
+        sys.exit(1)
+    return name
+
+'''
+Select the default XML parser: 'lxml', 'stdlib' or 'auto'
+'''
+def setXMLBackend(name):
+    global backend
+    backend = checkXMLBackend(name)
+
+'''
+Parse an XML file (with the default parser unless 'name' is given).
+Comments and processing instructions are discarded (as ElementTree does)
+so that they do not appear in the text of elements.
+'''
+def parseXML(filename, name=None):
+    if (name or backend) == 'lxml':
+        parser = lxml_etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+        return lxml_etree.parse(filename, parser)
+    return ElementTree.parse(filename)
+
+########################################################################
+# Text
+########################################################################
+
+'''
+Text content of an element and its tail.
+
+This is the same as ElementTree.tostring(element, method="text").decode()
+(including the conversion of non-ASCII characters to character
+references such as "&#8217;") but does not serialise the element.
+'''
+def elementText(element):
+    parts = list(element.itertext())
+    if element.tail: parts.append(element.tail)
+    text = ''.join(parts)
+    if not text.isascii():
+        text = text.encode('ascii', 'xmlcharrefreplace').decode('ascii')
+    return text
+
+'''
+Text of each paragraph of ARM's proprietary notice (notice.xml)
+'''
+def noticeParagraphs(filename, name=None):
+    return [ elementText(p).rstrip() for p in parseXML(filename, name).iter('para') ]
+
+########################################################################
+# End
+########################################################################
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+'''
+Check that extractors with different options that share a cache
+produce the same output as extractors with their own caches.
+
+Usage: check_shared_cache.py <dir>...
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+from incremental import Cache
+from instrs2asl import Extractor
+
+# options that change how the XML files are parsed
+configurations = [
+    [],
+    ['--include', 'NOMATCH'],
+    ['--altslicesyntax'],
+    ['--demangle', '--exclude', 'NOMATCH'],
+    ['--arch', 'AArch32'],
+    [],
+]
+
+def run(argv, cache):
+    x = Extractor(argv + ['--output', 'arch'] + dirs, cache)
+    return x.emit(x.filter(x.parse()))
+
+def main():
+    global dirs
+    dirs = sys.argv[1:]
+    if dirs == []:
+        print(__doc__.strip())
+        return 1
+    expected = [ run(argv, Cache()) for argv in configurations ]
+    status = 0
+    for order in [configurations, list(reversed(configurations))]:
+        shared = Cache()
+        for argv in order:
+            if run(argv, shared) != expected[configurations.index(argv)]:
+                print("Error: output differs with a shared cache:", " ".join(argv))
+                status = 1
+    if status == 0: print("Shared cache produces the same output for", len(configurations), "configurations")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())